@@ -0,0 +1,186 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""Benchmark of log_analyzer.py
+
+Reports time of every stage (read, parse, aggregate, render), lines/sec
+and peak RSS on a logfile, which is generated by log_generator.py unless
+it is given. Results can be saved into JSON file to compare between
+commits.
+"""
+
+import os
+import json
+import time
+import argparse
+import itertools
+import resource
+import shutil
+import subprocess
+import tempfile
+from datetime import datetime as dt
+
+import log_analyzer as la
+import log_generator
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+
+
+def load_lines(log_path, lines_count):
+    """function to get lines_count lines repeating lines of logfile"""
+    sample = list(la.read_log(log_path))
+    return list(itertools.islice(itertools.cycle(sample), lines_count))
+
+
+def bench_parser(parser, lines, repeat):
+    """function to get the best lines/sec of parser over repeat runs"""
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for line in lines:
+            parser(line)
+        elapsed = time.perf_counter() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return len(lines) / best
+
+
+def bench_parsers(log_path, lines_count, repeat):
+    lines = load_lines(log_path, lines_count)
+    print("{0} lines from {1}".format(len(lines), log_path))
+    for name, parser in (("fast path", la.parse_line),
+                         ("regex", la.parse_line_regex)):
+        rate = bench_parser(parser, lines, repeat)
+        print("{0:>10}: {1:,.0f} lines/sec".format(name, rate))
+
+
+def bench_stages(config, log_path, report_dir):
+    """function to get stats of every stage of log_analyzer.main"""
+    stats = la.PipelineStats()
+    start = time.perf_counter()
+    aggregator = la.aggregate_log(config, log_path, stats)
+    with stats.measure("render"):
+        report_data = la.build_report_data(config, aggregator)
+        la.create_report_html(report_data, report_dir, "report.html")
+    total = time.perf_counter() - start
+
+    lines = stats.stage("parse").lines_in
+    stages = {name: stage.wall_time for name, stage in stats.stages.items()}
+    return lines, stages, total
+
+
+def get_peak_rss():
+    """function to get peak RSS of this process and its children in MB"""
+    peak = max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+               resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss)
+    return peak / 1024
+
+
+def get_commit():
+    try:
+        return subprocess.check_output(
+            ["git", "rev-parse", "--short", "HEAD"], cwd=BASE_DIR,
+            stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def load_results(path):
+    if not os.path.exists(path):
+        return []
+    with open(path, 'r', encoding='utf-8') as f:
+        return json.load(f)
+
+
+def save_result(path, result):
+    """function to append result to the list of results in JSON file"""
+    results = load_results(path)
+    results.append(result)
+    with open(path, 'w', encoding='utf-8') as f:
+        json.dump(results, f, indent=2)
+
+
+def print_result(result, previous=None):
+    """function to print result and its change against previous result"""
+    previous = previous or {"stages": {}}
+
+    def change(value, old):
+        if not old:
+            return ""
+        return " ({0:+.1f}%)".format((value - old) / old * 100)
+
+    print("{0} lines, commit {1}".format(result["lines"], result["commit"]))
+    for name, value in result["stages"].items():
+        print("{0:>10}: {1:.3f} s{2}".format(
+            name, value, change(value, previous["stages"].get(name))))
+    print("{0:>10}: {1:,.0f} lines/sec{2}".format(
+        "total", result["lines_per_sec"],
+        change(result["lines_per_sec"], previous.get("lines_per_sec"))))
+    print("{0:>10}: {1:.1f} MB{2}".format(
+        "peak rss", result["peak_rss_mb"],
+        change(result["peak_rss_mb"], previous.get("peak_rss_mb"))))
+
+
+def main(args):
+    work_dir = tempfile.mkdtemp()
+    try:
+        log_path = args.log
+        if not log_path:
+            log_path = os.path.join(work_dir, "nginx-access-ui.log.gz")
+            log_generator.write_log(log_path, args.lines,
+                                    cardinality=args.urls, zipf=args.zipf,
+                                    malformed=args.malformed, seed=args.seed)
+
+        if args.parsers:
+            bench_parsers(log_path, args.lines, args.repeat)
+            return
+
+        config = dict(la.primary_config, THRESHOLD_ERR=1,
+                      WORKERS=args.workers)
+        lines, stages, total = bench_stages(config, log_path, work_dir)
+        result = {
+            "commit": get_commit(),
+            "date": dt.now().strftime('%Y-%m-%d %H:%M:%S'),
+            "log": args.log,
+            "lines": lines,
+            "workers": args.workers,
+            "stages": stages,
+            "lines_per_sec": lines / total,
+            "peak_rss_mb": get_peak_rss()
+        }
+    finally:
+        shutil.rmtree(work_dir)
+
+    previous = None
+    if args.compare:
+        results = load_results(args.compare)
+        previous = results[-1] if results else None
+    print_result(result, previous)
+    if args.save:
+        save_result(args.save, result)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--log', type=str, default=None,
+                        help="Path to logfile, generated if not given.")
+    parser.add_argument('--lines', type=int, default=1000000,
+                        help="Number of lines to generate.")
+    parser.add_argument('--urls', type=int, default=10000,
+                        help="Number of unique urls to generate.")
+    parser.add_argument('--zipf', type=float, default=1.1,
+                        help="Exponent of Zipf distribution of urls.")
+    parser.add_argument('--malformed', type=float, default=0.01,
+                        help="Fraction of malformed lines to generate.")
+    parser.add_argument('--seed', type=int, default=1,
+                        help="Seed of the random generator.")
+    parser.add_argument('--workers', type=int, default=1,
+                        help="Number of processes to parse the log.")
+    parser.add_argument('--save', type=str, default=None,
+                        help="Append results to JSON file.")
+    parser.add_argument('--compare', type=str, default=None,
+                        help="Compare with the last results in JSON file.")
+    parser.add_argument('--parsers', action='store_true',
+                        help="Compare speed of the line parsers only.")
+    parser.add_argument('--repeat', type=int, default=3,
+                        help="Number of runs of the parsers comparison.")
+    main(parser.parse_args())
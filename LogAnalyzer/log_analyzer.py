@@ -16,9 +16,18 @@ import json
 import time
 import logging
 import argparse
+import resource
+import math
+import heapq
 import shutil
-from collections import defaultdict, namedtuple
-from datetime import datetime as dt
+import queue
+import subprocess
+import threading
+import zlib
+import multiprocessing as mp
+from collections import OrderedDict, deque, namedtuple
+from contextlib import contextmanager
+from datetime import datetime as dt, timedelta
 from statistics import median
 
 primary_config = {
@@ -26,7 +35,19 @@ primary_config = {
     "REPORT_DIR": "./reports",
     "LOG_DIR": "./log",
     "TS_DIR": "./ts",
-    "THRESHOLD_ERR": 0.3
+    "THRESHOLD_ERR": 0.3,
+    "WORKERS": 1,
+    "MEDIAN_ACCURACY": 0.01,
+    "MEDIAN_EXACT_LIMIT": 64,
+    "URL_NORMALIZE": False,
+    "URL_BUDGET": 0,
+    "CACHE_DIR": "./cache",
+    "REPORT_DAYS": 1,
+    "STATS": False,
+    "REPORT_PAGE_SIZE": 0,
+    "REPORT_EMBED_ALL": False,
+    "WATCH_INTERVAL": 60,
+    "LIVE_LOG": None
 }
 
 config_path = '/usr/local/etc/log_analyzer.conf'
@@ -35,20 +56,148 @@ LogInfo = namedtuple('LogInfo', 'date, path')
 
 BASE_DIR = os.path.dirname(os.path.abspath(__file__))
 JS_NAME = 'jquery.tablesorter.min.js'
+LIVE_REPORT_NAME = 'report_live.html'
+TEMPLATE_NAME = 'report.html'
+# templates split around $table_json and $table_rows, cached by path and mtime
+template_cache = {}
+CHUNK_SIZE = 4 * 1024 * 1024
+READ_BLOCK_SIZE = 1024 * 1024
+# max number of decompressed blocks waiting for the parser
+READ_QUEUE_SIZE = 8
+PIGZ = shutil.which('pigz')
 
+LOG_PATTERN = re.compile(
+    rb'"[A-Z]+\s(?P<url>\S+)\sHTTP[^"]*".*\s(?P<t_request>\d+\.\d+)$')
 
-def create_report_html(report_data, report_dir, report_name):
-    """function to save report in html"""
+# pairs of (pattern, replacement) to collapse urls into route templates
+URL_RULES = [
+    (r'[0-9a-fA-F]{8}-[0-9a-fA-F]{4}-[0-9a-fA-F]{4}-[0-9a-fA-F]{4}-'
+     r'[0-9a-fA-F]{12}', '{uuid}'),
+    # short numbers are rather versions like /api/1/ than ids
+    (r'/\d{3,}(?=/|\?|$)', '/{id}'),
+    (r'([?&][^=&]*)=[^&]*', r'\1={}'),
+]
+NORMALIZE_CACHE_SIZE = 100000
+# aggregates in cache can be merged only if they are built with same values
+CACHE_SETTINGS = ("MEDIAN_ACCURACY", "MEDIAN_EXACT_LIMIT", "URL_NORMALIZE")
+# version of the format of cached aggregates, bumped when it changes
+CACHE_VERSION = 1
+
+
+class StageStats:
+    """Wall time, CPU time, counters and peak memory of a pipeline stage"""
+
+    FIELDS = ('wall_time', 'cpu_time', 'bytes_in', 'lines_in',
+              'lines_rejected', 'peak_rss_mb')
+
+    def __init__(self):
+        for field in self.FIELDS:
+            setattr(self, field, 0)
+
+    def merge(self, other):
+        for field in self.FIELDS[:-1]:
+            setattr(self, field, getattr(self, field) + getattr(other, field))
+        self.peak_rss_mb = max(self.peak_rss_mb, other.peak_rss_mb)
+
+    def to_json(self):
+        return {field: getattr(self, field) for field in self.FIELDS}
+
+
+class PipelineStats:
+    """Stats of the stages of main() to find out where time goes
+
+    Stages are measured per chunk of log, not per line, so the overhead of
+    measuring is negligible.
+    """
+
+    def __init__(self):
+        self.stages = OrderedDict()
+
+    def stage(self, name):
+        if name not in self.stages:
+            self.stages[name] = StageStats()
+        return self.stages[name]
+
+    @contextmanager
+    def measure(self, name):
+        """Add time spent in the block to the stage name"""
+        stage = self.stage(name)
+        wall_start = time.perf_counter()
+        cpu_start = time.process_time()
+        try:
+            yield stage
+        finally:
+            stage.wall_time += time.perf_counter() - wall_start
+            stage.cpu_time += time.process_time() - cpu_start
+            stage.peak_rss_mb = max(stage.peak_rss_mb, get_peak_rss())
+
+    def merge(self, other):
+        """Merge stats collected by another process"""
+        for name, stage in other.stages.items():
+            self.stage(name).merge(stage)
+
+    def to_json(self):
+        return OrderedDict((name, stage.to_json())
+                           for name, stage in self.stages.items())
+
+    def log(self):
+        for name, stage in self.stages.items():
+            logging.info("stage {0}: wall {1:.3f} s, cpu {2:.3f} s, "
+                         "bytes in {3}, lines in {4}, lines rejected {5}, "
+                         "peak rss {6:.1f} MB"
+                         .format(name, stage.wall_time, stage.cpu_time,
+                                 stage.bytes_in, stage.lines_in,
+                                 stage.lines_rejected, stage.peak_rss_mb))
+
+
+def get_peak_rss():
+    """function to get peak RSS of the process in MB"""
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def get_report_template(path=TEMPLATE_NAME):
+    """function to get parts of report template around the table and
+    around the embedded rows after the first page
+
+    Template is read again only if it was modified.
+    """
     try:
-        with open('report.html', 'r', encoding='utf-8') as template:
+        mtime = os.path.getmtime(path)
+        cached = template_cache.get(path)
+        if cached is not None and cached[0] == mtime:
+            return cached[1]
+        with open(path, 'r', encoding='utf-8') as template:
             template_data = template.read()
     except Exception:
-        logging.error("An error occured while opening report.html")
+        logging.error("An error occured while opening {0}".format(path))
         raise
 
-    json_data = json.dumps(report_data)
+    head, tail = template_data.split('$table_json', 1)
+    parts = [head] + tail.split('$table_rows', 1)
+    template_cache[path] = (mtime, parts)
+    return parts
 
-    ready_data = template_data.replace('$table_json', json_data)
+
+def write_report_data(rows, data_path):
+    """function to save rows of report into gzipped file, one json per line"""
+    with gzip.open(data_path, 'wt', encoding='utf-8') as data_file:
+        for row in rows:
+            data_file.write(json.dumps(row))
+            data_file.write('\n')
+
+
+def create_report_html(report_data, report_dir, report_name, page_size=0,
+                       embed_all=False):
+    """function to save report in html
+
+    The table is written into the report row by row instead of building
+    the whole page in memory. If page_size is set, only the first page of
+    the table is embedded into the report as its data and the rest is saved
+    into gzipped data file next to it, which the report loads lazily. With
+    embed_all the rest is embedded instead as text parsed lazily, for
+    reports opened from files where the data file can't be fetched.
+    """
+    head, middle, tail = get_report_template()
 
     if not os.path.exists(report_dir):
         os.makedirs(report_dir)
@@ -56,35 +205,337 @@ def create_report_html(report_data, report_dir, report_name):
     if not os.path.exists(os.path.join(report_dir, JS_NAME)):
         shutil.copy(os.path.join(BASE_DIR, JS_NAME), report_dir)
 
+    data_url = 'null'
+    data_path = os.path.join(report_dir,
+                             os.path.splitext(report_name)[0] + '.json.gz')
+    rest = []
+    if page_size and len(report_data) > page_size:
+        rest = report_data[page_size:]
+        report_data = report_data[:page_size]
+    if rest and not embed_all:
+        write_report_data(rest, data_path)
+        data_url = json.dumps(os.path.basename(data_path))
+        rest = []
+    elif os.path.exists(data_path):
+        # data file of the report generated before with paging
+        os.remove(data_path)
+
     report_path = os.path.join(report_dir, report_name)
     try:
         with open(report_path, 'w', encoding='utf-8') as html_report:
-            html_report.write(ready_data)
+            html_report.write(head.replace('$table_data_url', data_url))
+            html_report.write('[')
+            for n, row in enumerate(report_data):
+                if n:
+                    html_report.write(', ')
+                html_report.write(json.dumps(row))
+            html_report.write(']')
+            html_report.write(middle.replace('$table_data_url', data_url))
+            for row in rest:
+                # "</" would end the script element
+                html_report.write(json.dumps(row).replace('</', '<\\/'))
+                html_report.write('\n')
+            html_report.write(tail)
     except Exception:
         logging.error("An error occured while opening {0}".
                       format(report_path))
         raise
 
 
+class TimeSketch:
+    """Mergeable sketch of request times to estimate their median.
+
+    Up to `exact_limit` samples are kept as is and the median is exact.
+    After that samples are counted in logarithmic buckets, which keeps the
+    estimated median within `accuracy` relative error of the real one
+    while memory depends on the range of values, not on their number.
+    """
+
+    __slots__ = ('log_gamma', 'exact_limit', 'samples', 'buckets', 'zeros')
+
+    def __init__(self, accuracy, exact_limit):
+        self.log_gamma = math.log((1 + accuracy) / (1 - accuracy))
+        self.exact_limit = exact_limit
+        self.samples = []
+        self.buckets = None
+        self.zeros = 0
+
+    def add(self, value):
+        if self.buckets is None:
+            self.samples.append(value)
+            if len(self.samples) > self.exact_limit:
+                self._to_buckets()
+        else:
+            self._add_bucket(value, 1)
+
+    def merge(self, other):
+        """Add all values counted by other sketch"""
+        if self.buckets is None and other.buckets is None:
+            self.samples.extend(other.samples)
+            if len(self.samples) > self.exact_limit:
+                self._to_buckets()
+            return
+        if self.buckets is None:
+            self._to_buckets()
+        if other.buckets is None:
+            for value in other.samples:
+                self._add_bucket(value, 1)
+        else:
+            self.zeros += other.zeros
+            for key, count in other.buckets.items():
+                self.buckets[key] = self.buckets.get(key, 0) + count
+
+    def to_json(self):
+        if self.buckets is None:
+            return {"samples": self.samples}
+        return {"zeros": self.zeros, "buckets": list(self.buckets.items())}
+
+    @classmethod
+    def from_json(cls, data, accuracy, exact_limit):
+        sketch = cls(accuracy, exact_limit)
+        if "samples" in data:
+            sketch.samples = data["samples"]
+        else:
+            sketch.zeros = data["zeros"]
+            sketch.buckets = dict(data["buckets"])
+        return sketch
+
+    def median(self):
+        if self.buckets is None:
+            return median(self.samples)
+
+        count = self.zeros + sum(self.buckets.values())
+        lower = self._value_at((count - 1) // 2)
+        upper = self._value_at(count // 2)
+        return (lower + upper) / 2
+
+    def _to_buckets(self):
+        self.buckets = {}
+        for value in self.samples:
+            self._add_bucket(value, 1)
+        self.samples = []
+
+    def _add_bucket(self, value, count):
+        if value <= 0:
+            self.zeros += count
+            return
+        key = math.ceil(math.log(value) / self.log_gamma)
+        self.buckets[key] = self.buckets.get(key, 0) + count
+
+    def _value_at(self, rank):
+        """Get estimated value of sample with rank in sorted samples"""
+        if rank < self.zeros:
+            return 0.0
+        rank -= self.zeros
+        gamma = math.exp(self.log_gamma)
+        for key in sorted(self.buckets):
+            rank -= self.buckets[key]
+            if rank < 0:
+                return 2 * gamma ** key / (gamma + 1)
+
+
+class UrlStats:
+    """Count, sum, max and median sketch of request times of one url
+
+    `error` is the total time the url could have before it was tracked,
+    it is inherited from the evicted url in heavy-hitters mode. Sums are
+    integer milliseconds, the resolution of nginx $request_time, so they
+    don't depend on the order the times are added in.
+    """
+
+    __slots__ = ('count', 'time_sum', 'time_max', 'sketch', 'error')
+
+    def __init__(self, accuracy, exact_limit, error=0):
+        self.count = 0
+        self.time_sum = 0
+        self.time_max = 0
+        self.sketch = TimeSketch(accuracy, exact_limit)
+        self.error = error
+
+    @property
+    def estimate(self):
+        """Upper bound of the total time of the url"""
+        return self.time_sum + self.error
+
+    def add(self, r_time):
+        self.count += 1
+        self.time_sum += round(r_time * 1000)
+        if r_time > self.time_max:
+            self.time_max = r_time
+        self.sketch.add(r_time)
+
+    def to_json(self):
+        return [self.count, self.time_sum, self.time_max,
+                self.sketch.to_json(), self.error]
+
+    @classmethod
+    def from_json(cls, data, accuracy, exact_limit):
+        stats = cls.__new__(cls)
+        stats.count, stats.time_sum, stats.time_max, sketch = data[:4]
+        # aggregates cached before errors were tracked have no error
+        stats.error = data[4] if len(data) > 4 else 0
+        stats.sketch = TimeSketch.from_json(sketch, accuracy, exact_limit)
+        return stats
+
+    def merge(self, other):
+        self.count += other.count
+        self.time_sum += other.time_sum
+        if other.time_max > self.time_max:
+            self.time_max = other.time_max
+        self.sketch.merge(other.sketch)
+        self.error += other.error
+
+
+class ReportAggregator:
+    """Streaming aggregate of request times grouped by url
+
+    Memory usage is O(unique urls) regardless of the number of lines.
+    With URL_BUDGET set it works in heavy-hitters mode by the Space-Saving
+    algorithm weighted by request time: when the budget is exhausted a new
+    url replaces the url with the least estimated total time and inherits
+    that estimate as its error. So at most URL_BUDGET urls are tracked, the
+    total time of a tracked url is between its time_sum and estimate, and
+    every url with more than 1/URL_BUDGET of the total time is tracked.
+    """
+
+    def __init__(self, config):
+        self.accuracy = config.get("MEDIAN_ACCURACY",
+                                   primary_config["MEDIAN_ACCURACY"])
+        self.exact_limit = config.get("MEDIAN_EXACT_LIMIT",
+                                      primary_config["MEDIAN_EXACT_LIMIT"])
+        self.budget = config.get("URL_BUDGET", primary_config["URL_BUDGET"])
+        self.urls = {}
+        self.count = 0
+        self.evicted = 0
+        # min-heap of (estimate, url) of tracked urls, estimates in it may
+        # be lower than the current ones, None if it is to be rebuilt
+        self.heap = None
+
+    def update(self, parsed_lines):
+        """Add tuples(url, request_time) to the aggregate"""
+        urls = self.urls
+        budget = self.budget
+        count = 0
+        for url, r_time in parsed_lines:
+            stats = urls.get(url)
+            if stats is None:
+                if budget and len(urls) >= budget:
+                    stats = self.replace_min(url)
+                else:
+                    stats = urls[url] = UrlStats(self.accuracy,
+                                                 self.exact_limit)
+            stats.add(r_time)
+            count += 1
+        self.count += count
+        return self
+
+    def replace_min(self, url):
+        """Evict the url with the least estimate, track url in its place"""
+        urls = self.urls
+        if self.heap is None:
+            self.heap = [(stats.estimate, key) for key, stats in urls.items()]
+            heapq.heapify(self.heap)
+        while True:
+            estimate, key = heapq.heappop(self.heap)
+            current = urls[key].estimate
+            if current == estimate:
+                break
+            # the url got requests since it was pushed
+            heapq.heappush(self.heap, (current, key))
+        evicted = urls.pop(key)
+        self.evicted += evicted.count
+        stats = urls[url] = UrlStats(self.accuracy, self.exact_limit,
+                                     error=estimate)
+        heapq.heappush(self.heap, (estimate, url))
+        return stats
+
+    def min_estimate(self):
+        """Upper bound of the total time of any url which is not tracked"""
+        if not self.evicted or not self.urls:
+            return 0
+        return min(stats.estimate for stats in self.urls.values())
+
+    def prune(self):
+        """Evict urls with the least estimates down to the budget"""
+        excess = len(self.urls) - self.budget
+        lightest = heapq.nsmallest(excess, self.urls.items(),
+                                   key=lambda item: item[1].estimate)
+        for url, stats in lightest:
+            del self.urls[url]
+            self.evicted += stats.count
+        self.heap = None
+
+    def merge_urls(self, other_urls, other_min):
+        """Merge UrlStats by url of an aggregate, which doesn't track urls
+        with total time over other_min"""
+        urls = self.urls
+        self_min = self.min_estimate()
+        for url, stats in urls.items():
+            if url not in other_urls:
+                stats.error += other_min
+        for url, other_stats in other_urls.items():
+            stats = urls.get(url)
+            if stats is None:
+                other_stats.error += self_min
+                urls[url] = other_stats
+            else:
+                stats.merge(other_stats)
+        self.heap = None
+
+    def merge(self, other):
+        """Merge the aggregate built by another process"""
+        self.merge_urls(other.urls, other.min_estimate())
+        self.count += other.count
+        self.evicted += other.evicted
+        if self.budget and len(self.urls) > self.budget:
+            self.prune()
+        return self
+
+    def to_json(self):
+        return {
+            "count": self.count,
+            "evicted": self.evicted,
+            "urls": {url: stats.to_json() for url, stats in self.urls.items()}
+        }
+
+    def load_json(self, data):
+        """Merge the aggregate saved by to_json"""
+        other_urls = {url: UrlStats.from_json(stats_data, self.accuracy,
+                                              self.exact_limit)
+                      for url, stats_data in data["urls"].items()}
+        other_min = 0
+        if data["evicted"] and other_urls:
+            other_min = min(stats.estimate for stats in other_urls.values())
+        self.merge_urls(other_urls, other_min)
+        self.count += data["count"]
+        self.evicted += data["evicted"]
+        if self.budget and len(self.urls) > self.budget:
+            self.prune()
+        return self
+
+
 def get_report_data(config, parsed_lines):
     """function to get report data in json format"""
-    all_count = 0
-    all_time = 0
+    aggregator = ReportAggregator(config).update(parsed_lines)
+    return build_report_data(config, aggregator)
+
+
+def build_report_data(config, aggregator):
+    """function to get report data from aggregated request times"""
     report_size = config["REPORT_SIZE"]
+    all_count = aggregator.count
+    if aggregator.evicted:
+        logging.info("{0} requests of rare urls were evicted from the report"
+                     .format(aggregator.evicted))
 
-    grouped_urls = defaultdict(list)
-    for url, r_time in parsed_lines:
-        grouped_urls[url].append(r_time)
-        all_time += r_time
-        all_count += 1
     table = []
-    for url, time_col in grouped_urls.items():
-        time_sum = sum(time_col)
-        count = len(time_col)
+    for url, stats in aggregator.urls.items():
+        time_sum = stats.time_sum / 1000
+        count = stats.count
         time_avg = time_sum / count
         count_p = (count / all_count) * 100
-        time_max = max(time_col)
-        time_med = median(time_col)
+        time_max = stats.time_max
+        time_med = stats.sketch.median()
         time_perc = (time_sum / all_count) * 1
 
         row = {
@@ -105,25 +556,69 @@ def get_report_data(config, parsed_lines):
     return sorted_table[:report_size]
 
 
-def parse_log(config, lines):
-    """generator to get tuples(logdate,logpath) by splitting lines"""
-    threshold_err = config["THRESHOLD_ERR"]
-    total = error = 0
-    pat = '.+"(GET|POST)\s(?P<url>\S+)\sHTTP.+(?P<t_request>\d+\.\d+)$'
-    patc = re.compile(pat)
+def get_url_normalizer(config):
+    """function to get a function collapsing url into its route template"""
+    rules = [(re.compile(pattern), repl)
+             for pattern, repl in config.get("URL_RULES", URL_RULES)]
+    cache = {}
 
-    for line in lines:
-        total += 1
-        try:
-            m = patc.search(line)
-            if not m:
-                raise Exception
-            url = m.group('url')
-            r_time = float(m.group('t_request'))
-            yield url, r_time
-        except Exception:
-            error += 1
+    def normalize(url):
+        template = cache.get(url)
+        if template is None:
+            template = url
+            for patc, repl in rules:
+                template = patc.sub(repl, template)
+            if len(cache) >= NORMALIZE_CACHE_SIZE:
+                cache.clear()
+            cache[url] = template
+        return template
+
+    return normalize
+
+
+def normalize_urls(config, parsed_lines):
+    """function to replace urls of parsed lines with route templates
+
+    IDs, UUIDs and values of query params are collapsed, so requests to
+    the same route are grouped together. Does nothing unless URL_NORMALIZE
+    is set in config.
+    """
+    if not config.get("URL_NORMALIZE"):
+        return parsed_lines
+    normalize = get_url_normalizer(config)
+    return ((normalize(url), r_time) for url, r_time in parsed_lines)
+
+
+def parse_line(line):
+    """function to get tuple(url, request_time) from line, None if malformed
+
+    Splits the line of bytes on the fixed delimiters of ui_short format:
+    the url is taken from the quoted request field and the request time
+    from after the last space. Only the url is decoded. Lines which can't
+    be split that way are passed to parse_line_regex.
+    """
+    try:
+        method, url, protocol = line.split(b'"', 2)[1].split(b' ')
+        r_time = float(line[line.rindex(b' ') + 1:])
+    except (ValueError, IndexError):
+        return parse_line_regex(line)
+    if not method or not url or not protocol.startswith(b'HTTP'):
+        return parse_line_regex(line)
+    return url.decode('utf-8', 'replace'), r_time
 
+
+def parse_line_regex(line):
+    """function to get tuple(url, request_time) from line using LOG_PATTERN"""
+    m = LOG_PATTERN.search(line)
+    if not m:
+        return None
+    return m.group('url').decode('utf-8', 'replace'), \
+        float(m.group('t_request'))
+
+
+def check_error_rate(config, total, error):
+    """raise RuntimeError if too many lines were parsed with errors"""
+    threshold_err = config["THRESHOLD_ERR"]
     ftotal = float(total)
     rate = error/ftotal
     if rate > threshold_err:
@@ -132,21 +627,359 @@ def parse_log(config, lines):
         raise RuntimeError
 
 
+def parse_log(config, lines):
+    """generator to get tuples(url, request_time) by splitting lines"""
+    total = error = 0
+
+    for line in lines:
+        total += 1
+        parsed = parse_line(line)
+        if parsed is None:
+            error += 1
+            continue
+        yield parsed
+
+    check_error_rate(config, total, error)
+
+
+def parse_chunk(chunk):
+    """function to parse a line-aligned chunk of log
+
+    Returns list of tuples(url, request_time), number of lines and number of
+    malformed lines.
+    """
+    lines = chunk.split(b'\n')
+    if not lines[-1]:
+        lines.pop()
+
+    error = 0
+    parsed_lines = []
+    for line in lines:
+        parsed = parse_line(line)
+        if parsed is None:
+            error += 1
+            continue
+        parsed_lines.append(parsed)
+
+    return parsed_lines, len(lines), error
+
+
+def aggregate_chunk(config, chunk, aggregator, stats):
+    """function to parse and aggregate a line-aligned chunk of log
+
+    Returns number of lines and number of malformed lines.
+    """
+    with stats.measure("parse") as stage:
+        parsed_lines, total, error = parse_chunk(chunk)
+        stage.bytes_in += len(chunk)
+        stage.lines_in += total
+        stage.lines_rejected += error
+
+    with stats.measure("aggregate") as stage:
+        aggregator.update(normalize_urls(config, parsed_lines))
+        stage.lines_in += len(parsed_lines)
+
+    return total, error
+
+
+def aggregate_chunk_worker(config, chunk):
+    """function to aggregate a chunk of log in a worker process"""
+    aggregator = ReportAggregator(config)
+    stats = PipelineStats()
+    total, error = aggregate_chunk(config, chunk, aggregator, stats)
+    return aggregator, total, error, stats
+
+
+def read_chunks_measured(log_path, chunk_size, stats):
+    """generator for reading line-aligned chunks of logfile with stats"""
+    chunks = read_chunks(log_path, chunk_size)
+    stats.stage("read").bytes_in += os.path.getsize(log_path)
+    while True:
+        with stats.measure("read"):
+            chunk = next(chunks, None)
+        if chunk is None:
+            break
+        yield chunk
+
+
+def parse_log_parallel(config, log_path, chunk_size=CHUNK_SIZE, stats=None):
+    """function to parse logfile in a pool of worker processes
+
+    Every worker aggregates its chunk, the aggregates are merged in the
+    order the chunks were read.
+    """
+    workers = config["WORKERS"]
+    stats = stats or PipelineStats()
+    total = error = 0
+    aggregator = ReportAggregator(config)
+    pending = deque()
+
+    def merge_next():
+        nonlocal total, error
+        chunk_aggregator, chunk_total, chunk_error, chunk_stats = \
+            pending.popleft().get()
+        with stats.measure("merge"):
+            aggregator.merge(chunk_aggregator)
+        stats.merge(chunk_stats)
+        total += chunk_total
+        error += chunk_error
+
+    with mp.Pool(workers) as pool:
+        for chunk in read_chunks_measured(log_path, chunk_size, stats):
+            pending.append(pool.apply_async(aggregate_chunk_worker,
+                                            (config, chunk)))
+            # keep only a few chunks in flight to bound memory usage
+            if len(pending) >= workers * 2:
+                merge_next()
+        while pending:
+            merge_next()
+
+    check_error_rate(config, total, error)
+    return aggregator
+
+
+def aggregate_log(config, log_path, stats=None):
+    """function to parse logfile and aggregate its request times
+
+    The logfile is read, parsed and aggregated by line-aligned chunks.
+    """
+    if config["WORKERS"] > 1:
+        logging.info("parse the log file in {0} worker processes"
+                     .format(config["WORKERS"]))
+        return parse_log_parallel(config, log_path, stats=stats)
+
+    stats = stats or PipelineStats()
+    total = error = 0
+    aggregator = ReportAggregator(config)
+    logging.info("read, parse and aggregate lines of the log file")
+    for chunk in read_chunks_measured(log_path, CHUNK_SIZE, stats):
+        chunk_total, chunk_error = aggregate_chunk(config, chunk,
+                                                   aggregator, stats)
+        total += chunk_total
+        error += chunk_error
+
+    check_error_rate(config, total, error)
+    return aggregator
+
+
+def get_cache_settings(config):
+    """function to get settings the cached aggregates depend on"""
+    settings = {key: config.get(key, primary_config[key])
+                for key in CACHE_SETTINGS}
+    settings["URL_RULES"] = config.get("URL_RULES", URL_RULES)
+    settings["VERSION"] = CACHE_VERSION
+    return json.dumps(settings, sort_keys=True)
+
+
+def get_cache_path(config, date):
+    return os.path.join(config["CACHE_DIR"],
+                        "aggregate_{0}.json.gz".format(date))
+
+
+def save_aggregate(config, date, aggregator):
+    """function to save aggregate of the log for date into the cache dir"""
+    cache_dir = config["CACHE_DIR"]
+    if not os.path.exists(cache_dir):
+        os.makedirs(cache_dir)
+
+    data = aggregator.to_json()
+    data["date"] = str(date)
+    data["settings"] = get_cache_settings(config)
+
+    cache_path = get_cache_path(config, date)
+    tmp_path = cache_path + ".tmp"
+    with gzip.open(tmp_path, 'wt', encoding='utf-8') as f:
+        json.dump(data, f, separators=(',', ':'))
+    os.replace(tmp_path, cache_path)
+
+
+def load_aggregate(config, date):
+    """function to load aggregate of the log for date from the cache dir
+
+    Returns None if there is no aggregate or it was built with other
+    settings.
+    """
+    cache_path = get_cache_path(config, date)
+    if not os.path.exists(cache_path):
+        return None
+
+    try:
+        with gzip.open(cache_path, 'rt', encoding='utf-8') as f:
+            data = json.load(f)
+    except (OSError, ValueError):
+        logging.error("cache file {0} is broken".format(cache_path))
+        return None
+
+    if data.get("settings") != get_cache_settings(config):
+        logging.info("cache file {0} was built with other settings"
+                     .format(cache_path))
+        return None
+
+    return ReportAggregator(config).load_json(data)
+
+
+def get_aggregate(config, date, logfile, stats=None):
+    """function to get aggregate for date from the cache or the logfile
+
+    The logfile is read only if there is no aggregate for date in the cache,
+    the result is saved into the cache.
+    """
+    stats = stats or PipelineStats()
+    if config["CACHE_DIR"]:
+        with stats.measure("cache"):
+            aggregator = load_aggregate(config, date)
+        if aggregator is not None:
+            logging.info("aggregate for {0} is loaded from cache"
+                         .format(date))
+            return aggregator
+
+    if logfile is None:
+        logging.error("There is no logfile for {0}".format(date))
+        return None
+
+    logging.info("aggregate the log file {0}".format(logfile.path))
+    aggregator = aggregate_log(config, logfile.path, stats)
+    if config["CACHE_DIR"]:
+        with stats.measure("cache"):
+            save_aggregate(config, date, aggregator)
+    return aggregator
+
+
 def read_log(log_path):
-    """generator for reading lines of logfile"""
-    if log_path.endswith(".gz"):
-        log = gzip.open(log_path, 'rt')
+    """generator for reading lines of logfile as bytes without newlines"""
+    tail = b''
+    for block in read_blocks(log_path):
+        lines = (tail + block).split(b'\n')
+        tail = lines.pop()
+        yield from lines
+
+    if tail:
+        yield tail
+
+
+def read_chunks(log_path, chunk_size=CHUNK_SIZE):
+    """generator for reading line-aligned chunks of logfile as bytes"""
+    tail = b''
+    for block in read_blocks(log_path, chunk_size):
+        chunk = tail + block
+        end = chunk.rfind(b'\n') + 1
+        if not end:
+            tail = chunk
+            continue
+        tail = chunk[end:]
+        yield chunk[:end]
+
+    if tail:
+        yield tail
+
+
+def read_blocks(log_path, block_size=READ_BLOCK_SIZE):
+    """generator for reading decompressed logfile by blocks of bytes
+
+    Gzipped logfile is decompressed concurrently with parsing: by pigz in a
+    subprocess when it is installed, by zlib in a background thread
+    otherwise.
+    """
+    if not log_path.endswith(".gz"):
+        with open(log_path, 'rb') as log:
+            block = log.read(block_size)
+            while block:
+                yield block
+                block = log.read(block_size)
+    elif PIGZ:
+        yield from read_pigz_blocks(log_path, block_size)
     else:
-        log = open(log_path)
+        yield from read_inflated_blocks(log_path, block_size)
 
-    for line in log:
-        yield line
 
-    log.close()
+def read_pigz_blocks(log_path, block_size=READ_BLOCK_SIZE):
+    """generator for reading blocks of gzipped logfile decompressed by pigz"""
+    with subprocess.Popen([PIGZ, '-dc', log_path],
+                          stdout=subprocess.PIPE) as proc:
+        block = proc.stdout.read(block_size)
+        while block:
+            yield block
+            block = proc.stdout.read(block_size)
 
+    if proc.returncode:
+        raise OSError("pigz failed to decompress {0}".format(log_path))
 
-def get_latest_logfiles(log_folder):
-    """generator for getting logfiles"""
+
+def read_inflated_blocks(log_path, block_size=READ_BLOCK_SIZE):
+    """generator for reading blocks of gzipped logfile decompressed by zlib
+
+    zlib releases the GIL, so decompression in the background thread runs
+    in parallel with parsing.
+    """
+    blocks = queue.Queue(READ_QUEUE_SIZE)
+    stop = threading.Event()
+    inflater = threading.Thread(target=inflate_log,
+                                args=(log_path, block_size, blocks, stop))
+    inflater.daemon = True
+    inflater.start()
+
+    try:
+        while True:
+            block = blocks.get()
+            if block is None:
+                break
+            if isinstance(block, Exception):
+                raise block
+            yield block
+    finally:
+        stop.set()
+        inflater.join()
+
+
+def inflate_log(log_path, block_size, blocks, stop):
+    """function to put decompressed blocks of gzipped logfile into queue"""
+    def put(item):
+        while not stop.is_set():
+            try:
+                blocks.put(item, timeout=0.1)
+                return
+            except queue.Full:
+                continue
+
+    try:
+        with open(log_path, 'rb') as log:
+            inflater = zlib.decompressobj(16 + zlib.MAX_WBITS)
+            in_member = False
+            data = b''
+            while not stop.is_set():
+                if not data:
+                    data = log.read(block_size)
+                    if not data:
+                        break
+                if not in_member:
+                    # members may be followed by NUL padding, like gzip skips
+                    data = data.lstrip(b'\0')
+                    if not data:
+                        continue
+                in_member = True
+                block = inflater.decompress(data, block_size)
+                if block:
+                    put(block)
+                if inflater.eof:
+                    # gzip file may consist of several members
+                    data = inflater.unused_data
+                    inflater = zlib.decompressobj(16 + zlib.MAX_WBITS)
+                    in_member = False
+                else:
+                    data = inflater.unconsumed_tail
+            block = inflater.flush()
+            if block:
+                put(block)
+            if in_member and not inflater.eof and not stop.is_set():
+                raise EOFError("Compressed file ended before the "
+                               "end-of-stream marker was reached")
+        put(None)
+    except Exception as e:
+        put(e)
+
+
+def get_logfiles(log_folder):
+    """function for getting all logfiles"""
     patc = re.compile('^nginx-access-ui.log-(\d{8})(\.gz)?$')
     log_files = os.listdir(log_folder)
     filtered = []
@@ -156,7 +989,12 @@ def get_latest_logfiles(log_folder):
             path = os.path.join(log_folder, name)
             date = dt.strptime(match.group(1), '%Y%m%d').date()
             filtered.append(LogInfo(date, path))
+    return filtered
 
+
+def get_latest_logfiles(log_folder):
+    """function for getting the latest logfile"""
+    filtered = get_logfiles(log_folder)
     if not filtered:
         return None
 
@@ -184,6 +1022,26 @@ def update_ts(config):
     os.utime(file_path, (int(ts), int(ts)))
 
 
+def save_stats(config, stats, report_name):
+    """Save stats of the stages next to the timestamp of the last report"""
+    ts_dir = config["TS_DIR"]
+    file_path = os.path.join(ts_dir, "log_analyzer.stats.json")
+    tmp_path = file_path + ".tmp"
+
+    if not os.path.exists(ts_dir):
+        os.makedirs(ts_dir)
+
+    data = OrderedDict([
+        ("ts", dt.now().strftime('%Y-%m-%d %H:%M:%S')),
+        ("report", report_name),
+        ("workers", config["WORKERS"]),
+        ("stages", stats.to_json())
+    ])
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(data, f, indent=2)
+    os.replace(tmp_path, file_path)
+
+
 def get_config_dict(path_to_config):
     try:
         with open(path_to_config, 'r') as f:
@@ -193,6 +1051,129 @@ def get_config_dict(path_to_config):
         raise Exception("please, check your config file")
 
 
+class LogDirWatcher:
+    """Polls folder with logfiles for the new ones
+
+    A logfile is reported once it stops growing between two polls, so
+    files which are still being rotated or compressed are not read.
+    """
+
+    def __init__(self, log_folder):
+        self.log_folder = log_folder
+        self.sizes = {}
+        self.ready = set()
+
+    def poll(self):
+        """Get logfiles which appeared since the last poll"""
+        new_logfiles = []
+        for logfile in get_logfiles(self.log_folder):
+            if logfile.path in self.ready:
+                continue
+            try:
+                size = os.path.getsize(logfile.path)
+            except OSError:
+                continue
+            if self.sizes.get(logfile.path) == size:
+                self.ready.add(logfile.path)
+                new_logfiles.append(logfile)
+            else:
+                self.sizes[logfile.path] = size
+        return new_logfiles
+
+
+class LogTail:
+    """Live aggregate of the current logfile which is still being written
+
+    Every update reads only lines appended since the previous one. When
+    the logfile is rotated the aggregate starts over.
+    """
+
+    def __init__(self, config, log_path):
+        self.config = config
+        self.log_path = log_path
+        self.inode = None
+        self.reset()
+
+    def reset(self):
+        self.offset = 0
+        self.tail = b''
+        self.aggregator = ReportAggregator(self.config)
+        self.stats = PipelineStats()
+
+    def update(self):
+        """Aggregate new lines, return True if there were any"""
+        try:
+            st = os.stat(self.log_path)
+        except FileNotFoundError:
+            return False
+
+        if st.st_ino != self.inode or st.st_size < self.offset:
+            logging.info("start live aggregate of {0}".format(self.log_path))
+            self.inode = st.st_ino
+            self.reset()
+        if st.st_size == self.offset:
+            return False
+
+        with open(self.log_path, 'rb') as log:
+            log.seek(self.offset)
+            while self.offset < st.st_size:
+                data = log.read(min(CHUNK_SIZE, st.st_size - self.offset))
+                if not data:
+                    break
+                self.offset += len(data)
+                chunk = self.tail + data
+                end = chunk.rfind(b'\n') + 1
+                self.tail = chunk[end:]
+                if end:
+                    aggregate_chunk(self.config, chunk[:end],
+                                    self.aggregator, self.stats)
+        return True
+
+    def create_report(self):
+        report_data = build_report_data(self.config, self.aggregator)
+        create_report_html(report_data, self.config["REPORT_DIR"],
+                           LIVE_REPORT_NAME, self.config["REPORT_PAGE_SIZE"],
+                           self.config["REPORT_EMBED_ALL"])
+
+
+def watch(config, polls=None):
+    """Process new logfiles as soon as they appear in LOG_DIR
+
+    LOG_DIR is polled every WATCH_INTERVAL seconds, the compiled patterns
+    and the report template stay loaded between polls. If LIVE_LOG is set,
+    that logfile is tailed and report_live.html is updated with its partial
+    aggregate.
+    """
+    watcher = LogDirWatcher(config["LOG_DIR"])
+    live = LogTail(config, config["LIVE_LOG"]) if config["LIVE_LOG"] else None
+    logging.info("watch for logfiles in {0}".format(config["LOG_DIR"]))
+
+    poll = 0
+    while polls is None or poll < polls:
+        if poll:
+            time.sleep(config["WATCH_INTERVAL"])
+        poll += 1
+        try:
+            new_logfiles = watcher.poll()
+            if new_logfiles:
+                logging.info("new log files: {0}".format(
+                    ", ".join(logfile.path for logfile in new_logfiles)))
+            # every logfile gets its report, even if several appeared
+            # between polls or were there at start
+            for logfile in sorted(new_logfiles, key=lambda log: log.date):
+                try:
+                    create_report(config, logfile)
+                except Exception as e:
+                    logging.error("report for {0} has failed".format(
+                        logfile.path))
+                    logging.exception(e)
+            if live is not None and live.update():
+                live.create_report()
+                logging.info("live report has updated")
+        except Exception as e:
+            logging.exception(e)
+
+
 def main(config):
     logging.info("search for logfiles")
     log_folder = config["LOG_DIR"]
@@ -205,7 +1186,19 @@ def main(config):
         logging.error("There are not logfiles in {0}".format(log_folder))
 
     logging.info("the latest log file is {0}".format(latest_logfile.path))
-    report_name = "report_{0}.html".format(latest_logfile.date)
+    create_report(config, latest_logfile)
+
+
+def create_report(config, logfile):
+    """function to create report for REPORT_DAYS up to the date of logfile"""
+    log_folder = config["LOG_DIR"]
+    report_days = config["REPORT_DAYS"]
+    dates = [logfile.date - timedelta(days=days)
+             for days in reversed(range(report_days))]
+    if report_days == 1:
+        report_name = "report_{0}.html".format(logfile.date)
+    else:
+        report_name = "report_{0}_{1}.html".format(dates[0], dates[-1])
     report_dir = config["REPORT_DIR"]
     report_path = os.path.join(report_dir, report_name)
 
@@ -213,25 +1206,37 @@ def main(config):
 
     if os.path.exists(report_path):
         logging.info("Report for date  {0} already exists"
-                     .format(latest_logfile.date))
+                     .format(logfile.date))
         update_ts(config)
         return
 
-    logging.info("read lines from the log file")
-    lines = read_log(latest_logfile.path)
-
-    logging.info("get parsed lines")
-    parsed_lines = parse_log(config, lines)
+    stats = PipelineStats()
+    logfiles = {log.date: log for log in get_logfiles(log_folder)}
+    aggregator = ReportAggregator(config)
+    for date in dates:
+        date_aggregator = get_aggregate(config, date, logfiles.get(date),
+                                        stats)
+        if date_aggregator is not None:
+            with stats.measure("merge"):
+                aggregator.merge(date_aggregator)
 
     logging.info("get report data")
-    report_data = get_report_data(config, parsed_lines)
+    with stats.measure("render"):
+        report_data = build_report_data(config, aggregator)
 
-    logging.info("generating html report...")
-    create_report_html(report_data, report_dir, report_name)
+        logging.info("generating html report...")
+        create_report_html(report_data, report_dir, report_name,
+                           config["REPORT_PAGE_SIZE"],
+                           config["REPORT_EMBED_ALL"])
     logging.info("report html has created successfully!")
     update_ts(config)
     logging.info("timestamp has updated")
 
+    if config["STATS"]:
+        stats.log()
+        save_stats(config, stats, report_name)
+        logging.info("stats of the stages have saved")
+
 
 if __name__ == "__main__":
 
@@ -243,11 +1248,49 @@ if __name__ == "__main__":
         help="Path for configuration file.",
         default=config_path
     )
+    parser.add_argument(
+        '--workers',
+        "-w",
+        type=int,
+        help="Number of processes to parse the log file in parallel.",
+        default=None
+    )
+    parser.add_argument(
+        '--days',
+        "-d",
+        type=int,
+        help="Number of days up to the latest log to build report for.",
+        default=None
+    )
+    parser.add_argument(
+        '--stats',
+        action='store_true',
+        help="Log stats of the stages and save them next to the timestamp."
+    )
+    parser.add_argument(
+        '--watch',
+        action='store_true',
+        help="Keep running and process new log files as they appear."
+    )
+    parser.add_argument(
+        '--live',
+        type=str,
+        help="Path of the current log file to tail in watch mode.",
+        default=None
+    )
 
     args = parser.parse_args()
     arg_config = get_config_dict(args.config)
 
     primary_config.update(arg_config)
+    if args.workers is not None:
+        primary_config["WORKERS"] = args.workers
+    if args.days is not None:
+        primary_config["REPORT_DAYS"] = args.days
+    if args.stats:
+        primary_config["STATS"] = True
+    if args.live:
+        primary_config["LIVE_LOG"] = args.live
 
     logging.basicConfig(
         level=logging.INFO,
@@ -259,7 +1302,12 @@ if __name__ == "__main__":
     logging.info("======start=======")
 
     try:
-        main(primary_config)
+        if args.watch:
+            watch(primary_config)
+        else:
+            main(primary_config)
+    except KeyboardInterrupt:
+        logging.info("interrupted")
     except Exception as e:
         logging.exception(e)
 
@@ -0,0 +1,148 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""Generator of synthetic logs in ui_short format for benchmarks"""
+
+import gzip
+import random
+import argparse
+import itertools
+from datetime import datetime as dt, timedelta
+
+ROUTES = [
+    "/api/v2/banner/{0}",
+    "/api/v2/banner/{0}/statistic/",
+    "/api/v2/group/{0}/banners",
+    "/api/v2/slot/{0}/groups",
+    "/api/v2/internal/banner/{0}/info",
+    "/api/1/photogenic_banners/list/?server_name=WIN{0}",
+    "/export/appinstall_raw/{0}/",
+]
+METHODS = ["GET"] * 8 + ["POST", "HEAD"]
+AGENTS = [
+    "Lynx/2.8.8dev.9 libwww-FM/2.14 SSL-MM/1.4.1 GNUTLS/2.10.5",
+    "Python-urllib/2.7",
+    "Slotovod",
+    "-",
+]
+HEAD_FORMAT = '{ip} {user}  - ['
+TAIL_FORMAT = (' HTTP/1.1" {status} {size} "-" "{agent}" "-" "{request_id}" '
+               '"{rb_user}" ')
+# number of lines drawn from the distributions at once
+BATCH_SIZE = 10000
+# fields other than url and request time are taken from pools of 2 ** N
+POOL_BITS = 10
+
+
+def make_urls(cardinality, rnd):
+    """function to get list of unique urls with mean request time of each"""
+    urls = []
+    for n in range(cardinality):
+        route = ROUTES[n % len(ROUTES)]
+        url = route.format(rnd.randint(1, 10 ** 8) * cardinality + n)
+        urls.append((url, rnd.lognormvariate(-2, 1)))
+    return urls
+
+
+def make_heads(rnd):
+    """function to get pool of beginnings of lines up to the time"""
+    return [HEAD_FORMAT.format(
+        ip="1.{0}.{1}.{2}".format(rnd.randrange(256), rnd.randrange(256),
+                                  rnd.randrange(256)),
+        user=rnd.choice(["-", "3b81f63526fa8"])
+    ) for _ in range(2 ** POOL_BITS)]
+
+
+def make_methods(rnd):
+    """function to get pool of methods"""
+    return [rnd.choice(METHODS) for _ in range(2 ** POOL_BITS)]
+
+
+def make_tails(rnd):
+    """function to get pool of parts of lines between url and request time"""
+    return [TAIL_FORMAT.format(
+        status=rnd.choice([200, 200, 200, 404, 500]),
+        size=rnd.randrange(20000),
+        agent=rnd.choice(AGENTS),
+        request_id="1498780800-{0}-4708-9752759".format(rnd.getrandbits(32)),
+        rb_user=rnd.choice(["-", "dc7161be3", "712e90144abee9"])
+    ) for _ in range(2 ** POOL_BITS)]
+
+
+def make_malformed(line, rnd):
+    """function to spoil valid line of log"""
+    kind = rnd.randint(0, 2)
+    request = line.index('"') + 1
+    if kind == 0:
+        # request without method
+        return line[:request] + line[line.index(' ', request):]
+    if kind == 1:
+        # line cut in the request
+        return line[:rnd.randint(1, line.index(' HTTP/', request))] + '\n'
+    return "garbage\n"
+
+
+def generate_lines(lines, cardinality=1000, zipf=1.1, malformed=0.0,
+                   seed=None):
+    """generator of lines of log in ui_short format
+
+    Urls are drawn from cardinality unique urls with Zipf distribution
+    with exponent zipf, malformed is the fraction of malformed lines.
+    """
+    rnd = random.Random(seed)
+    urls = make_urls(cardinality, rnd)
+    cum_weights = list(itertools.accumulate(
+        1 / rank ** zipf for rank in range(1, cardinality + 1)))
+    heads = make_heads(rnd)
+    methods = make_methods(rnd)
+    tails = make_tails(rnd)
+    start = dt(2017, 6, 30)
+    second = None
+
+    for offset in range(0, lines, BATCH_SIZE):
+        batch = rnd.choices(urls, cum_weights=cum_weights,
+                            k=min(lines - offset, BATCH_SIZE))
+        for n, (url, mean_time) in enumerate(batch, offset):
+            if n * 86400 // lines != second:
+                second = n * 86400 // lines
+                timestamp = start + timedelta(seconds=second)
+                time_local = timestamp.strftime("%d/%b/%Y:%H:%M:%S +0300")
+            line = '{0}{1}] "{2} {3}{4}{5:.3f}\n'.format(
+                heads[rnd.getrandbits(POOL_BITS)], time_local,
+                methods[rnd.getrandbits(POOL_BITS)], url,
+                tails[rnd.getrandbits(POOL_BITS)],
+                rnd.expovariate(1 / mean_time))
+            if malformed and rnd.random() < malformed:
+                line = make_malformed(line, rnd)
+            yield line
+
+
+def write_log(path, lines, **kwargs):
+    """function to write generated log into path, gzipped if it ends with .gz"""
+    if path.endswith(".gz"):
+        log = gzip.open(path, 'wt', encoding='utf-8', compresslevel=6)
+    else:
+        log = open(path, 'w', encoding='utf-8')
+
+    with log:
+        for line in generate_lines(lines, **kwargs):
+            log.write(line)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('output', type=str,
+                        help="Path of the log, gzipped if it ends with .gz")
+    parser.add_argument('--lines', type=int, default=1000000,
+                        help="Number of lines.")
+    parser.add_argument('--urls', type=int, default=10000,
+                        help="Number of unique urls.")
+    parser.add_argument('--zipf', type=float, default=1.1,
+                        help="Exponent of Zipf distribution of urls.")
+    parser.add_argument('--malformed', type=float, default=0.01,
+                        help="Fraction of malformed lines.")
+    parser.add_argument('--seed', type=int, default=None,
+                        help="Seed of the random generator.")
+    args = parser.parse_args()
+
+    write_log(args.output, args.lines, cardinality=args.urls, zipf=args.zipf,
+              malformed=args.malformed, seed=args.seed)
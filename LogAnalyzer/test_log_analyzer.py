@@ -1,7 +1,15 @@
 import os
+import gzip
+import json
 import unittest
 import log_analyzer as la
+import log_generator
 import uuid
+import shutil
+import tempfile
+import random
+import collections
+from statistics import median
 
 config = {
     "REPORT_SIZE": 100,
@@ -61,10 +69,374 @@ class TestLogAnalyzer(unittest.TestCase):
              parsed_lines = la.parse_log(config, lines)
              list(parsed_lines)
 
+    def test_read_log(self):
+        for name in sorted(os.listdir(config["LOG_DIR"])):
+            log_path = os.path.join(config["LOG_DIR"], name)
+            with gzip.open(log_path, 'rb') as log:
+                expected = log.read().splitlines()
+            self.assertListEqual(list(la.read_log(log_path)), expected)
+            blocks = la.read_inflated_blocks(log_path, block_size=100)
+            self.assertEqual(b''.join(blocks), b'\n'.join(expected) + b'\n')
+
+    def test_read_inflated_blocks_multiple_members(self):
+        log_path = os.path.join(self.empty_dir, "multi.log.gz")
+        with open(log_path, 'wb') as log:
+            log.write(gzip.compress(b'first\nsec'))
+            log.write(gzip.compress(b'ond\nthird\n'))
+        self.assertListEqual(list(la.read_log(log_path)),
+                             [b'first', b'second', b'third'])
+        self.assertEqual(b''.join(la.read_inflated_blocks(log_path, 7)),
+                         b'first\nsecond\nthird\n')
+        self.assertListEqual(list(la.read_chunks(log_path, 7)),
+                             [b'first\n', b'second\n', b'third\n'])
+        with open(log_path, 'wb') as log:
+            log.write(gzip.compress(b'a\nb\n') + b'\0' * 8)
+            log.write(gzip.compress(b'c\n') + b'\0' * 8)
+        self.assertListEqual(list(la.read_log(log_path)), [b'a', b'b', b'c'])
+        self.assertEqual(b''.join(la.read_inflated_blocks(log_path, 7)),
+                         b'a\nb\nc\n')
+        self.assertEqual(b''.join(la.read_inflated_blocks(log_path, 3)),
+                         b'a\nb\nc\n')
+        os.remove(log_path)
+
+    def test_read_inflated_blocks_truncated(self):
+        log_path = os.path.join(self.empty_dir, "truncated.log.gz")
+        with open(log_path, 'wb') as log:
+            log.write(gzip.compress(b'first\nsecond\n' * 100)[:-20])
+        with self.assertRaises(EOFError):
+            list(la.read_inflated_blocks(log_path))
+        os.remove(log_path)
+
+    def test_parse_log_parallel(self):
+        log_path = config["LOG_DIR"] + "/nginx-access-ui.log-20170627.gz"
+        serial_data = la.get_report_data(config,
+                                         la.parse_log(config,
+                                                      la.read_log(log_path)))
+        parallel_config = dict(config, WORKERS=3)
+        aggregator = la.parse_log_parallel(parallel_config, log_path,
+                                           chunk_size=512)
+        parallel_data = la.build_report_data(parallel_config, aggregator)
+        self.assertListEqual(serial_data, parallel_data)
+
+    def test_parse_log_parallel_generated(self):
+        log_path = os.path.join(self.empty_dir, "generated.log.gz")
+        log_generator.write_log(log_path, 300000, cardinality=2000, seed=3)
+        report_config = dict(config, REPORT_SIZE=2000, WORKERS=1)
+        serial_data = la.build_report_data(
+            report_config, la.aggregate_log(report_config, log_path))
+        parallel_config = dict(report_config, WORKERS=2)
+        parallel_data = la.build_report_data(
+            parallel_config, la.aggregate_log(parallel_config, log_path))
+        self.assertGreater(len(serial_data), 1000)
+        self.assertListEqual(serial_data, parallel_data)
+        os.remove(log_path)
+
+    def test_parse_log_parallel_exceed_error_threshold(self):
+        log_path = config["LOG_DIR"] + "/nginx-access-ui.log-20170629.gz"
+        parallel_config = dict(config, WORKERS=2)
+        with self.assertRaises(RuntimeError):
+            la.parse_log_parallel(parallel_config, log_path, chunk_size=512)
+
     def test_get_report_data(self):
         report_data = la.get_report_data(config, self.parsed_lines)
         self.assertListEqual(report_data, self.report_data)
 
+    def test_parse_line(self):
+        line = (b'1.196.116.32 -  - [29/Jun/2017:03:50:22 +0300] '
+                b'"%s /api/v2/banner/25019354 HTTP/1.1" 200 927 "-" '
+                b'"Lynx/2.8.8dev.9 libwww-FM/2.14" "-" '
+                b'"1498697422-2190034393-4708-9752759" "dc7161be3" 10.390')
+        for method in (b'GET', b'POST', b'PUT', b'DELETE', b'HEAD'):
+            self.assertEqual(la.parse_line(line % method),
+                             ('/api/v2/banner/25019354', 10.39))
+            self.assertEqual(la.parse_line_regex(line % method),
+                             ('/api/v2/banner/25019354', 10.39))
+        self.assertIsNone(la.parse_line(line % b''))
+        self.assertIsNone(la.parse_line(b''))
+        self.assertIsNone(la.parse_line(b'garbage'))
+
+    def test_parse_line_matches_regex(self):
+        for name in sorted(os.listdir(config["LOG_DIR"])):
+            for line in la.read_log(os.path.join(config["LOG_DIR"], name)):
+                self.assertEqual(la.parse_line(line),
+                                 la.parse_line_regex(line))
+
+    def test_normalize_urls(self):
+        normalize_config = dict(config, URL_NORMALIZE=True)
+        parsed_lines = [
+            ('/api/v2/banner/25019354', 0.39),
+            ('/api/v2/banner/16852664/', 0.2),
+            ('/api/1/photogenic_banners/list/?server_name=WIN7RB4', 0.133),
+            ('/api/v2/group/7786679/statistic/sites/?date_type=day&date_from='
+             '2017-06-28&date_to=2017-06-28', 0.07),
+            ('/export/appinstall_raw/2017-06-29/', 0.001),
+            ('/accounts/3b81f635-26fa-4d3c-9a2b-0c1e5f6a7b8c/info', 0.5),
+        ]
+        normalized = list(la.normalize_urls(normalize_config, parsed_lines))
+        self.assertListEqual(normalized, [
+            ('/api/v2/banner/{id}', 0.39),
+            ('/api/v2/banner/{id}/', 0.2),
+            ('/api/1/photogenic_banners/list/?server_name={}', 0.133),
+            ('/api/v2/group/{id}/statistic/sites/?date_type={}&date_from={}'
+             '&date_to={}', 0.07),
+            ('/export/appinstall_raw/2017-06-29/', 0.001),
+            ('/accounts/{uuid}/info', 0.5),
+        ])
+        self.assertIs(la.normalize_urls(config, parsed_lines), parsed_lines)
+
+    def test_url_budget(self):
+        budget_config = dict(config, URL_BUDGET=20)
+        parsed_lines = []
+        for i in range(1000):
+            parsed_lines.append(('/heavy/{0}'.format(i % 3), 1.0))
+            parsed_lines.append(('/rare/{0}'.format(i), 0.01))
+        aggregator = la.ReportAggregator(budget_config).update(parsed_lines)
+        self.assertLessEqual(len(aggregator.urls), 20)
+        self.assertEqual(aggregator.count, 2000)
+        report_data = la.build_report_data(dict(budget_config, REPORT_SIZE=3),
+                                           aggregator)
+        self.assertListEqual(sorted(row['url'] for row in report_data),
+                             ['/heavy/0', '/heavy/1', '/heavy/2'])
+        self.assertEqual(report_data[0]['count_perc'], 16.7)
+
+    def test_url_budget_bounds(self):
+        budget = 10
+        budget_config = dict(config, URL_BUDGET=budget)
+        rnd = random.Random(1)
+        parsed_lines = [('/rare/{0}'.format(rnd.randrange(500)), 0.01)
+                        for _ in range(3000)]
+        # heavy url which appears late
+        for i in range(1000):
+            parsed_lines.append(('/rare/{0}'.format(rnd.randrange(500)), 0.01))
+            if i % 2 == 0:
+                parsed_lines.append(('/late', 0.01))
+        totals = collections.Counter()
+        for url, r_time in parsed_lines:
+            totals[url] += round(r_time * 1000)
+        aggregators = [la.ReportAggregator(budget_config).update(part)
+                       for part in (parsed_lines[::2], parsed_lines[1::2])]
+        merged = la.ReportAggregator(budget_config)
+        merged.load_json(aggregators[0].to_json())
+        merged.merge(aggregators[1])
+        for aggregator in [la.ReportAggregator(budget_config).update(
+                parsed_lines), merged]:
+            self.assertEqual(len(aggregator.urls), budget)
+            self.assertIn('/late', aggregator.urls)
+            for url, stats in aggregator.urls.items():
+                self.assertLessEqual(stats.time_sum, totals[url])
+                self.assertLessEqual(totals[url], stats.estimate)
+
+    def test_aggregate_cache(self):
+        cache_config = dict(config, CACHE_DIR=self.empty_dir, WORKERS=1)
+        log_path = config["LOG_DIR"] + "/nginx-access-ui.log-20170627.gz"
+        date = la.dt(2017, 6, 27).date()
+        aggregator = la.aggregate_log(cache_config, log_path)
+        la.save_aggregate(cache_config, date, aggregator)
+
+        loaded = la.load_aggregate(cache_config, date)
+        self.assertListEqual(la.build_report_data(cache_config, aggregator),
+                             la.build_report_data(cache_config, loaded))
+        self.assertIsNone(la.load_aggregate(
+            dict(cache_config, MEDIAN_ACCURACY=0.05), date))
+        self.assertIsNone(la.load_aggregate(cache_config,
+                                            la.dt(2017, 6, 26).date()))
+        os.remove(la.get_cache_path(cache_config, date))
+
+    def test_main_report_days(self):
+        work_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, work_dir)
+        main_config = dict(la.primary_config,
+                           LOG_DIR=config["LOG_DIR"],
+                           THRESHOLD_ERR=1,
+                           REPORT_DAYS=3,
+                           STATS=True,
+                           REPORT_DIR=os.path.join(work_dir, "reports"),
+                           TS_DIR=os.path.join(work_dir, "ts"),
+                           CACHE_DIR=os.path.join(work_dir, "cache"))
+        la.main(main_config)
+
+        self.assertTrue(os.path.exists(os.path.join(
+            work_dir, "reports", "report_2017-06-28_2017-06-30.html")))
+        self.assertListEqual(sorted(os.listdir(main_config["CACHE_DIR"])), [
+            "aggregate_2017-06-28.json.gz",
+            "aggregate_2017-06-29.json.gz",
+            "aggregate_2017-06-30.json.gz"])
+
+        aggregator = la.ReportAggregator(main_config)
+        for day in (28, 29, 30):
+            aggregator.merge(la.load_aggregate(main_config,
+                                               la.dt(2017, 6, day).date()))
+        self.assertEqual(aggregator.count, 76 + 1 + 6)
+
+        stats_path = os.path.join(work_dir, "ts", "log_analyzer.stats.json")
+        with open(stats_path, 'r', encoding='utf-8') as f:
+            stats = json.load(f)
+        self.assertListEqual(list(stats["stages"]), [
+            "cache", "read", "parse", "aggregate", "merge", "render"])
+        self.assertEqual(stats["stages"]["parse"]["lines_in"], 77 + 77 + 6)
+        self.assertEqual(stats["stages"]["parse"]["lines_rejected"],
+                         1 + 76 + 0)
+        self.assertEqual(stats["stages"]["aggregate"]["lines_in"], 83)
+
+    def test_log_generator(self):
+        log_path = os.path.join(self.empty_dir, "nginx-access-ui.log.gz")
+        log_generator.write_log(log_path, 5000, cardinality=50, zipf=1.5,
+                                malformed=0.2, seed=1)
+        lines = list(la.read_log(log_path))
+        self.assertEqual(len(lines), 5000)
+        parsed_lines = [la.parse_line(line) for line in lines]
+        errors = sum(1 for parsed in parsed_lines if parsed is None)
+        self.assertAlmostEqual(errors / 5000, 0.2, delta=0.03)
+
+        aggregator = la.ReportAggregator(config).update(
+            parsed for parsed in parsed_lines if parsed is not None)
+        self.assertLessEqual(len(aggregator.urls), 50)
+        counts = sorted((stats.count for stats in aggregator.urls.values()),
+                        reverse=True)
+        self.assertGreater(counts[0], 10 * counts[-1])
+        os.remove(log_path)
+
+    def test_create_report_html(self):
+        with open('report.html', 'r', encoding='utf-8') as template:
+            template_data = template.read()
+        la.create_report_html(self.report_data, self.empty_dir, "r.html")
+        with open(os.path.join(self.empty_dir, "r.html"),
+                  encoding='utf-8') as report:
+            self.assertEqual(report.read(), template_data
+                             .replace('$table_json',
+                                      json.dumps(self.report_data))
+                             .replace('$table_data_url', 'null')
+                             .replace('$table_rows', ''))
+        self.assertFalse(os.path.exists(os.path.join(self.empty_dir,
+                                                     "r.json.gz")))
+        os.remove(os.path.join(self.empty_dir, "r.html"))
+        os.remove(os.path.join(self.empty_dir, la.JS_NAME))
+
+    def test_create_report_html_paged(self):
+        report_data = [dict(self.report_data[0], url='/url/{0}'.format(n))
+                       for n in range(10)]
+        la.create_report_html(report_data, self.empty_dir, "r.html",
+                              page_size=3)
+        with open(os.path.join(self.empty_dir, "r.html"),
+                  encoding='utf-8') as report:
+            html = report.read()
+        self.assertIn('var table = ' + json.dumps(report_data[:3]), html)
+        self.assertIn('var dataUrl = "r.json.gz";', html)
+        self.assertIn('id="report-table-data"></script>', html)
+        data_path = os.path.join(self.empty_dir, "r.json.gz")
+        with gzip.open(data_path, 'rt', encoding='utf-8') as data:
+            self.assertListEqual([json.loads(line) for line in data],
+                                 report_data[3:])
+
+        # with embed_all the rest is embedded instead of the data file
+        la.create_report_html(report_data, self.empty_dir, "r.html",
+                              page_size=3, embed_all=True)
+        with open(os.path.join(self.empty_dir, "r.html"),
+                  encoding='utf-8') as report:
+            html = report.read()
+        self.assertIn('var table = ' + json.dumps(report_data[:3]), html)
+        self.assertIn('var dataUrl = null;', html)
+        embedded = html.split('id="report-table-data">')[1]
+        embedded = embedded.split('</script>')[0]
+        self.assertListEqual([json.loads(line)
+                              for line in embedded.splitlines()],
+                             report_data[3:])
+        self.assertFalse(os.path.exists(data_path))
+        la.create_report_html(report_data, self.empty_dir, "r.html",
+                              page_size=3)
+
+        # the data file is removed when the report is generated again
+        # without paging
+        la.create_report_html(report_data, self.empty_dir, "r.html")
+        self.assertFalse(os.path.exists(data_path))
+        for name in ("r.html", la.JS_NAME):
+            os.remove(os.path.join(self.empty_dir, name))
+
+    def test_log_dir_watcher(self):
+        watcher = la.LogDirWatcher(self.empty_dir)
+        log_path = os.path.join(self.empty_dir, "nginx-access-ui.log-20170701")
+        with open(log_path, 'wb') as log:
+            log.write(b'line\n')
+        self.assertListEqual(watcher.poll(), [])
+        with open(log_path, 'ab') as log:
+            log.write(b'line\n')
+        self.assertListEqual(watcher.poll(), [])
+        self.assertListEqual([logfile.path for logfile in watcher.poll()],
+                             [log_path])
+        self.assertListEqual(watcher.poll(), [])
+        os.remove(log_path)
+
+    def test_log_tail(self):
+        log_path = os.path.join(self.empty_dir, "nginx-access-ui.log")
+        with gzip.open(config["LOG_DIR"] + "/nginx-access-ui.log-20170630.gz",
+                       'rb') as log:
+            lines = log.read().splitlines(True)
+        tail = la.LogTail(config, log_path)
+        self.assertFalse(tail.update())
+
+        with open(log_path, 'wb') as log:
+            log.write(b''.join(lines[:3]) + lines[3][:20])
+        self.assertTrue(tail.update())
+        self.assertEqual(tail.aggregator.count, 3)
+        self.assertFalse(tail.update())
+
+        with open(log_path, 'ab') as log:
+            log.write(b''.join([lines[3][20:]] + lines[4:]))
+        self.assertTrue(tail.update())
+        self.assertListEqual(la.build_report_data(config, tail.aggregator),
+                             self.report_data)
+
+        # rotated logfile starts a new aggregate
+        os.rename(log_path, log_path + "-20170630")
+        with open(log_path, 'wb') as log:
+            log.write(lines[0])
+        self.assertTrue(tail.update())
+        self.assertEqual(tail.aggregator.count, 1)
+        os.remove(log_path)
+        os.remove(log_path + "-20170630")
+
+    def test_watch(self):
+        work_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, work_dir)
+        watch_config = dict(la.primary_config,
+                            LOG_DIR=config["LOG_DIR"],
+                            WATCH_INTERVAL=0,
+                            REPORT_DIR=os.path.join(work_dir, "reports"),
+                            TS_DIR=os.path.join(work_dir, "ts"),
+                            CACHE_DIR=os.path.join(work_dir, "cache"))
+        la.watch(watch_config, polls=1)
+        self.assertFalse(os.path.exists(watch_config["REPORT_DIR"]))
+        la.watch(watch_config, polls=2)
+        # every log gets a report, except the one with too many errors
+        self.assertListEqual(sorted(os.listdir(watch_config["REPORT_DIR"])),
+                             [la.JS_NAME, "report_2017-06-27.html",
+                              "report_2017-06-28.html",
+                              "report_2017-06-30.html"])
+
+    def test_time_sketch_median_accuracy(self):
+        values = [random.expovariate(5) for _ in range(10001)]
+        sketch = la.TimeSketch(accuracy=0.01, exact_limit=64)
+        for value in values:
+            sketch.add(value)
+        self.assertIsNotNone(sketch.buckets)
+        self.assertAlmostEqual(sketch.median() / median(values), 1,
+                               delta=0.01)
+
+    def test_time_sketch_merge(self):
+        values = [random.expovariate(5) for _ in range(1000)] + [0.0] * 10
+        sketch = la.TimeSketch(accuracy=0.01, exact_limit=64)
+        for value in values:
+            sketch.add(value)
+        merged = la.TimeSketch(accuracy=0.01, exact_limit=64)
+        for start in range(0, len(values), 50):
+            part = la.TimeSketch(accuracy=0.01, exact_limit=64)
+            for value in values[start:start + 50]:
+                part.add(value)
+            merged.merge(part)
+        self.assertEqual(sketch.buckets, merged.buckets)
+        self.assertEqual(sketch.zeros, merged.zeros)
+        self.assertEqual(sketch.median(), merged.median())
+
     def tearDown(self):
         os.rmdir(self.empty_dir)
 
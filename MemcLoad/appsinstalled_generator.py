@@ -0,0 +1,87 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Generator of synthetic appsinstalled logs for benchmarks"""
+import gzip
+import uuid
+import random
+from optparse import OptionParser
+
+DEV_TYPES = ["idfa"] * 4 + ["gaid"] * 4 + ["adid", "dvid"]
+# app ids are skewed to small ids, popular apps are installed more often
+MAX_APP = 100000
+APP_SKEW = 3
+# lengths of app lists are lognormal with median exp(APPS_MU)
+APPS_MU = 3.0
+APPS_SIGMA = 0.8
+MAX_APPS = 500
+
+
+def make_dev_id(dev_type, rnd):
+    raw = uuid.UUID(int=rnd.getrandbits(128), version=4)
+    if dev_type == "idfa":
+        return str(raw).upper()
+    if dev_type == "gaid":
+        return str(raw)
+    return raw.hex[:16]
+
+
+def make_apps(rnd):
+    length = min(int(rnd.lognormvariate(APPS_MU, APPS_SIGMA)) + 1, MAX_APPS)
+    return ",".join(str(int(MAX_APP * rnd.random() ** APP_SKEW) + 1)
+                    for _ in xrange(length))
+
+
+def make_malformed(line, rnd):
+    """function to spoil valid line"""
+    kind = rnd.randint(0, 2)
+    parts = line.split("\t")
+    if kind == 0:
+        # line without apps
+        return "\t".join(parts[:4])
+    if kind == 1:
+        # not digit app id
+        return line + ",app"
+    # invalid coordinates
+    return "\t".join(parts[:2] + ["", "-"] + parts[4:])
+
+
+def generate_lines(lines, malformed=0.0, seed=None):
+    """generator of lines of appsinstalled logs
+
+    malformed is the fraction of lines which can't be loaded or loaded
+    partially.
+    """
+    rnd = random.Random(seed)
+    for _ in xrange(lines):
+        dev_type = rnd.choice(DEV_TYPES)
+        line = "%s\t%s\t%.6f\t%.6f\t%s" % (
+            dev_type, make_dev_id(dev_type, rnd), rnd.uniform(-90, 90),
+            rnd.uniform(-180, 180), make_apps(rnd))
+        if malformed and rnd.random() < malformed:
+            line = make_malformed(line, rnd)
+        yield line + "\n"
+
+
+def write_log(path, lines, **kwargs):
+    """function to write generated lines into path, gzipped if it ends with .gz"""
+    if path.endswith(".gz"):
+        log = gzip.open(path, "wb", compresslevel=6)
+    else:
+        log = open(path, "wb")
+    with log:
+        for line in generate_lines(lines, **kwargs):
+            log.write(line)
+
+
+if __name__ == "__main__":
+    op = OptionParser(usage="%prog [options] output")
+    op.add_option("--lines", action="store", type="int", default=1000000,
+                  help="Number of lines.")
+    op.add_option("--malformed", action="store", type="float", default=0.001,
+                  help="Fraction of malformed lines.")
+    op.add_option("--seed", action="store", type="int", default=None,
+                  help="Seed of the random generator.")
+    (opts, args) = op.parse_args()
+    if len(args) != 1:
+        op.error("output path is required")
+    write_log(args[0], opts.lines, malformed=opts.malformed, seed=opts.seed)
@@ -0,0 +1,96 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Benchmark of memc_load.py modes against fake memcached servers
+
+Every mode loads its own copy of a generated appsinstalled log and the
+records/sec, p99 set latency and CPU seconds per stage are printed from
+the stats file of the loader.
+"""
+import os
+import json
+import time
+import shutil
+import logging
+import tempfile
+from optparse import OptionParser
+
+import memc_load
+from appsinstalled_generator import write_log
+from fake_memcached import FakeMemcached
+
+DEV_TYPES = ("idfa", "gaid", "adid", "dvid")
+MODES = {
+    "threaded": [],
+    "pipelined": ["--pipeline"],
+    "staged": ["--parsers=1"],
+    "staged-pipelined": ["--parsers=1", "--pipeline"],
+}
+
+
+def run_mode(mode, source, servers, workdir, extra_args):
+    """function to load a copy of source in mode, returns the stats report"""
+    path = os.path.join(workdir, mode + ".tsv.gz")
+    shutil.copy(source, path)
+    stats_file = os.path.join(workdir, mode + ".json")
+    args = ["--pattern=" + path, "--stats-file=" + stats_file]
+    args += ["--%s=%s" % (dev_type, servers[dev_type].addr)
+             for dev_type in DEV_TYPES]
+    options, _ = memc_load.get_option_parser().parse_args(
+        args + MODES[mode] + extra_args)
+    started = time.time()
+    memc_load.main(options)
+    elapsed = time.time() - started
+    with open(stats_file) as f:
+        report = json.load(f)
+    os.remove(os.path.join(workdir, "." + mode + ".tsv.gz"))
+    report["elapsed"] = elapsed
+    return report
+
+
+def print_report(mode, report):
+    totals = report["totals"]
+    latency = totals.get("set_latency", {})
+    cpu = ", ".join("%s %.2fs" % item for item in sorted(report["cpu"].items()))
+    print("%-17s %8d lines %6.1fs %9.0f rec/s  p99 set %7.2fms  cpu: %s" % (
+        mode, totals["lines"], report["elapsed"],
+        totals["lines"] / report["elapsed"],
+        latency.get("p99", 0) * 1000, cpu))
+
+
+if __name__ == "__main__":
+    op = OptionParser(usage="%prog [options] [memc_load options]")
+    op.add_option("--file", action="store", default=None,
+                  help="Log to load, generated if not given.")
+    op.add_option("--lines", action="store", type="int", default=100000)
+    op.add_option("--malformed", action="store", type="float", default=0.001)
+    op.add_option("--latency", action="store", type="float", default=0,
+                  help="Round trip of fake memcached servers in seconds.")
+    op.add_option("--fail-rate", action="store", type="float", default=0,
+                  help="Fraction of failed sets.")
+    op.add_option("--modes", action="store", default=",".join(sorted(MODES)))
+    op.add_option("--save", action="store", default=None,
+                  help="Save reports of modes as json.")
+    (opts, args) = op.parse_args()
+    # malformed lines are logged by the loader on every run
+    logging.basicConfig(level=logging.CRITICAL)
+
+    workdir = tempfile.mkdtemp(prefix="memc_bench")
+    servers = dict((dev_type, FakeMemcached(latency=opts.latency,
+                                            fail_rate=opts.fail_rate).start())
+                   for dev_type in DEV_TYPES)
+    reports = {}
+    try:
+        source = opts.file
+        if source is None:
+            source = os.path.join(workdir, "source.tsv.gz")
+            write_log(source, opts.lines, malformed=opts.malformed, seed=1)
+        for mode in opts.modes.split(","):
+            reports[mode] = run_mode(mode, source, servers, workdir, args)
+            print_report(mode, reports[mode])
+    finally:
+        for server in servers.values():
+            server.stop()
+        shutil.rmtree(workdir)
+    if opts.save:
+        with open(opts.save, "w") as f:
+            json.dump(reports, f, indent=2, sort_keys=True)
@@ -0,0 +1,129 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""In-process fake memcached server speaking the text protocol
+
+Supports set, get, delete and quit, enough for memc_load.py and
+python-memcached. Used by tests and benchmark.py in place of real
+memcached servers, with optional latency and failures of sets.
+"""
+import time
+import random
+import threading
+import SocketServer
+
+RECV_SIZE = 64 * 1024
+
+
+class FakeMemcacheHandler(SocketServer.BaseRequestHandler):
+    """Serves commands of a connection
+
+    Commands which came in one read are answered at once after latency
+    seconds, like a server behind a network with round trip of latency.
+    """
+    def handle(self):
+        data = ""
+        while True:
+            chunk = self.request.recv(RECV_SIZE)
+            if not chunk:
+                break
+            if self.server.latency:
+                time.sleep(self.server.latency)
+            replies = []
+            data, closed = self.process(data + chunk, replies)
+            if replies:
+                self.request.sendall("".join(replies))
+            if closed:
+                break
+
+    def process(self, data, replies):
+        """Run complete commands of data, return (rest of data, closed)"""
+        while True:
+            end = data.find("\r\n")
+            if end < 0:
+                return data, False
+            parts = data[:end].split()
+            rest = data[end + 2:]
+            if parts and parts[0] == "set":
+                length = int(parts[4]) if len(parts) > 4 else 0
+                if len(rest) < length + 2:
+                    return data, False
+                replies.append(self.do_set(parts[1:], rest[:length]))
+                rest = rest[length + 2:]
+            elif parts and parts[0] == "get":
+                replies.append(self.do_get(parts[1:]))
+            elif parts and parts[0] == "delete":
+                replies.append(self.do_delete(parts[1:]))
+            elif parts and parts[0] == "quit":
+                return "", True
+            else:
+                replies.append("ERROR\r\n")
+            data = rest
+
+    def do_set(self, args, value):
+        key, flags = args[0], int(args[1])
+        noreply = args[-1] == "noreply"
+        if self.server.failed():
+            return "" if noreply else "SERVER_ERROR out of memory\r\n"
+        self.server.data[key] = (flags, value)
+        return "" if noreply else "STORED\r\n"
+
+    def do_get(self, keys):
+        values = []
+        for key in keys:
+            if key in self.server.data:
+                flags, value = self.server.data[key]
+                values.append("VALUE %s %d %d\r\n%s\r\n" %
+                              (key, flags, len(value), value))
+        return "".join(values) + "END\r\n"
+
+    def do_delete(self, args):
+        deleted = self.server.data.pop(args[0], None) is not None
+        if args[-1] == "noreply":
+            return ""
+        return "DELETED\r\n" if deleted else "NOT_FOUND\r\n"
+
+
+class FakeMemcached(SocketServer.ThreadingTCPServer):
+    """Fake memcached server on a free port of 127.0.0.1
+
+    Served from a daemon thread started by start(), the stored values are
+    in data as {key: (flags, value)}. Replies are delayed by latency
+    seconds and fail_rate of sets fail with SERVER_ERROR.
+    """
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, host="127.0.0.1", port=0, latency=0, fail_rate=0,
+                 seed=None):
+        SocketServer.ThreadingTCPServer.__init__(self, (host, port),
+                                                 FakeMemcacheHandler)
+        self.data = {}
+        self.thread = None
+        self.latency = latency
+        self.fail_rate = fail_rate
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+
+    @property
+    def addr(self):
+        return "%s:%d" % self.server_address
+
+    def failed(self):
+        if not self.fail_rate:
+            return False
+        with self.lock:
+            return self.random.random() < self.fail_rate
+
+    def get(self, key):
+        return self.data.get(key, (None, None))[1]
+
+    def start(self):
+        self.thread = threading.Thread(target=self.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+        self.thread.join()
@@ -6,6 +6,8 @@ import sys
 import glob
 import logging
 import collections
+import heapq
+import itertools
 from optparse import OptionParser
 # brew install protobuf
 # protoc  --python_out=. ./appsinstalled.proto
@@ -17,39 +19,821 @@ import multiprocessing as mp
 import Queue
 import time
 import threading
+import select
+import socket
+import struct
+import mmap
+import json
+import errno
+import BaseHTTPServer
+import bisect
+import hashlib
+import fcntl
+import math
+import resource
+import shutil
+import tempfile
+import copy
 
 SENTINEL = object()
+# makes MemcacheClient write everything queued before and report results
+FLUSH = object()
 WORKERS_NUM = 3
 NORMAL_ERR_RATE = 0.01
+BATCH_SIZE = 500
+BATCH_TIMEOUT = 0.1
+MAX_ATTEMPTS = 3
+RETRY_BACKOFF = 0.1
+PIPELINE_DEPTH = 1000
+PIPELINE_CONNECTIONS = 2
+SOCKET_TIMEOUT = 1
+RECONNECT_DELAY = 1
+WRITE_BUFFER_SIZE = 64 * 1024
+RECV_SIZE = 64 * 1024
+MAX_KEY_LENGTH = 250
+QUEUE_SIZE = 4
+SERIALIZE_BATCH_SIZE = 1000
+# UserApps wire format: apps = 1 is a repeated varint, not packed in proto2,
+# lat = 2 and lon = 3 are fixed64
+APP_TAG = chr(1 << 3 | 0)
+GEO_FIELDS = struct.Struct("<BdBd")
+LAT_TAG = 2 << 3 | 1
+LON_TAG = 3 << 3 | 1
+MAX_APP = 2 ** 32 - 1
+APP_TABLE_SIZE = 2 ** 16
+LOG_EXT = ".tsv.gz"
+COLUMNAR_EXT = ".col"
+# rows buffered by convert_file and unpacked at once by iter_rows
+COLUMNAR_CHUNK = 10000
+COLUMNAR_MAGIC = "APPSCOL1"
+# magic, rows, errors, apps, offsets of 8 sections
+COLUMNAR_HEADER = struct.Struct("<8s3Q8Q")
+CHECKPOINT_EVERY = 100000
+METRICS_INTERVAL = 10
+RING_REPLICAS = 160
+# latency histograms have buckets growing by LATENCY_BASE from LATENCY_MIN
+LATENCY_MIN = 1e-5
+LATENCY_BASE = 1.05
+# resource.RUSAGE_THREAD of Linux, missing in Python 2
+RUSAGE_THREAD = 1 if sys.platform.startswith("linux") else resource.RUSAGE_SELF
+FINGERPRINT_MAGIC = "APPSFP01"
+# magic, capacity, number of used slots
+FINGERPRINT_HEADER = struct.Struct("<8sQQ")
+# key hash, value hash
+FINGERPRINT_SLOT = struct.Struct("<QQ")
+FINGERPRINT_CAPACITY = 2 ** 24
+FINGERPRINT_MAX_LOAD = 0.8
+METRICS_COUNTERS = ("lines", "errors", "skipped", "sets", "bytes", "retries",
+                    "failures")
 AppsInstalled = collections.namedtuple("AppsInstalled", ["dev_type", "dev_id", "lat", "lon", "apps"])
+# offset is position in decompressed tsv.gz file or row of columnar file
+Checkpoint = collections.namedtuple("Checkpoint", ["offset", "processed", "errors"])
+
+
+class Metrics(object):
+    """Counters and gauges of the loader by scope, file or memcached server
+
+    Counters are totals since the start of the process. Worker processes
+    send them to the queue of MetricsCollector of the main process, gauges
+    such as queue depth are sampled on sending.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counters = collections.defaultdict(int)
+        self.histograms = collections.defaultdict(
+            lambda: collections.defaultdict(int))
+        self.gauges = {}
+        self.queue = None
+
+    def incr(self, scope, name, value=1):
+        with self.lock:
+            self.counters[scope, name] += value
+
+    def observe(self, scope, name, values, count=1):
+        """Add values, every count times, to histogram of scope"""
+        buckets = [get_bucket(value) for value in values]
+        with self.lock:
+            histogram = self.histograms[scope, name]
+            for bucket in buckets:
+                histogram[bucket] += count
+
+    def gauge(self, scope, name, func):
+        self.gauges[scope, name] = func
+
+    def remove_gauge(self, scope, name):
+        self.gauges.pop((scope, name), None)
+
+    def snapshot(self):
+        """Get {scope: {name: value}} of counters and gauges"""
+        scopes = collections.defaultdict(dict)
+        with self.lock:
+            for (scope, name), value in self.counters.items():
+                scopes[scope][name] = value
+            for (scope, name), histogram in self.histograms.items():
+                scopes[scope][name] = dict(histogram)
+        for (scope, name), func in self.gauges.items():
+            try:
+                scopes[scope][name] = func()
+            except (NotImplementedError, IOError, OSError):
+                pass
+        return dict(scopes)
+
+    def send(self):
+        if self.queue is not None:
+            self.queue.put((os.getpid(), self.snapshot()))
+
+
+def get_bucket(value):
+    if value <= LATENCY_MIN:
+        return 0
+    return int(math.log(value / LATENCY_MIN, LATENCY_BASE)) + 1
+
+
+def get_percentile(histogram, percent):
+    """Get upper bound of bucket of percentile of histogram"""
+    rank = sum(histogram.values()) * percent / 100.0
+    seen = 0
+    for bucket in sorted(histogram):
+        seen += histogram[bucket]
+        if seen >= rank:
+            return LATENCY_MIN * LATENCY_BASE ** bucket
+    return None
+
+
+def merge_histogram(target, histogram):
+    for bucket, count in histogram.items():
+        target[bucket] = target.get(bucket, 0) + count
+    return target
+
+
+def get_thread_cpu():
+    usage = resource.getrusage(RUSAGE_THREAD)
+    return usage.ru_utime + usage.ru_stime
+
+
+def count_cpu(stage, started):
+    """Count CPU time of this thread since started in stage"""
+    METRICS.incr("cpu", stage, get_thread_cpu() - started)
+
+
+METRICS = Metrics()
+
+
+def init_worker(metrics_queue, interval):
+    """Set up metrics of a new worker process, sent every interval"""
+    global METRICS
+    METRICS = Metrics()
+    METRICS.queue = metrics_queue
+
+    def send():
+        while True:
+            time.sleep(interval)
+            METRICS.send()
+
+    thread = threading.Thread(target=send)
+    thread.daemon = True
+    thread.start()
+
+
+def run_worker(metrics_queue, interval, stage, target, *args):
+    init_worker(metrics_queue, interval)
+    started = get_thread_cpu()
+    target(*args)
+    count_cpu(stage, started)
+    METRICS.send()
+
+
+class MetricsCollector(threading.Thread):
+    """Sums metrics of worker processes and reports them every interval
+
+    The report with totals and rates per second of counters by scope,
+    percentiles of latencies and CPU time by stage is logged, written into
+    stats_file and served as JSON on stats_port of 127.0.0.1 if they are
+    given.
+    """
+    def __init__(self, interval=METRICS_INTERVAL, stats_file=None,
+                 stats_port=None):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.interval = interval
+        self.stats_file = stats_file
+        self.queue = mp.Queue()
+        self.workers = {}
+        self.report = {}
+        self.totals = {}
+        self.last_time = self.start_time = time.time()
+        self.stopped = threading.Event()
+        self.server = None
+        if stats_port is not None:
+            self.server = BaseHTTPServer.HTTPServer(("127.0.0.1", stats_port),
+                                                    MetricsHandler)
+            self.server.collector = self
+
+    def run(self):
+        if self.server is not None:
+            thread = threading.Thread(target=self.server.serve_forever)
+            thread.daemon = True
+            thread.start()
+        next_report = time.time() + self.interval
+        while not self.stopped.is_set():
+            self.receive(max(next_report - time.time(), 0))
+            if time.time() >= next_report:
+                self.make_report()
+                next_report += self.interval
+
+    def receive(self, timeout):
+        try:
+            message = self.queue.get(timeout=timeout)
+        except Queue.Empty:
+            return
+        if message is not None:
+            pid, snapshot = message
+            self.workers[pid] = snapshot
+
+    def stop(self):
+        self.stopped.set()
+        # wake up the thread waiting for metrics
+        self.queue.put(None)
+        self.join()
+        while not self.queue.empty():
+            self.receive(0)
+        self.make_report()
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
+
+    def make_report(self):
+        now = time.time()
+        elapsed = max(now - self.last_time, 1e-6)
+        scopes = collections.defaultdict(dict)
+        for snapshot in self.workers.values() + [METRICS.snapshot()]:
+            for scope, values in snapshot.items():
+                for name, value in values.items():
+                    if isinstance(value, dict):
+                        merge_histogram(scopes[scope].setdefault(name, {}),
+                                        value)
+                    else:
+                        scopes[scope][name] = scopes[scope].get(name, 0) + value
+        cpu = scopes.pop("cpu", {})
+        totals = dict.fromkeys(METRICS_COUNTERS + ("queue",), 0)
+        totals.update((name + "_per_sec", 0) for name in METRICS_COUNTERS)
+        histograms = {}
+        for scope, values in scopes.items():
+            for name in METRICS_COUNTERS:
+                if name not in values:
+                    continue
+                previous = self.totals.get((scope, name), 0)
+                values[name + "_per_sec"] = (values[name] - previous) / elapsed
+                self.totals[scope, name] = values[name]
+            for name, value in values.items():
+                if isinstance(value, dict):
+                    merge_histogram(histograms.setdefault(name, {}), value)
+                    values[name] = get_summary(value)
+                else:
+                    totals[name] = totals.get(name, 0) + value
+        for name, histogram in histograms.items():
+            totals[name] = get_summary(histogram)
+        self.last_time = now
+        self.report = {"time": now, "uptime": now - self.start_time,
+                       "totals": totals, "cpu": cpu,
+                       "scopes": dict(scopes)}
+        logging.info("Loaded %d lines (%.0f/s), %d sets (%.0f/s), %d bytes, "
+                     "%d retries, %d failures, queue depth %d" % (
+                         totals["lines"], totals["lines_per_sec"],
+                         totals["sets"], totals["sets_per_sec"],
+                         totals["bytes"], totals["retries"],
+                         totals["failures"], totals["queue"]))
+        if self.stats_file:
+            with open(self.stats_file + ".tmp", "w") as f:
+                json.dump(self.report, f, indent=2, sort_keys=True)
+            os.rename(self.stats_file + ".tmp", self.stats_file)
+
+
+def get_summary(histogram):
+    return {"count": sum(histogram.values()),
+            "p50": get_percentile(histogram, 50),
+            "p99": get_percentile(histogram, 99)}
+
+
+class MetricsHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    def do_GET(self):
+        body = json.dumps(self.server.collector.report, indent=2,
+                          sort_keys=True)
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
 
 
 class MemcacheClient(threading.Thread):
-    def __init__(self, memc_addr, line_queue, result_queue, dry_run):
+    """Writes packed records from the queue to one memcached server
+
+    Records are sent by batches with set_multi. A batch is sent when it has
+    batch_size keys or batch_timeout seconds passed since its first key.
+    Only failed keys are retried, with backoff, together with the next
+    batches, so a retry doesn't hold back the records behind it. A retry
+    of a key is dropped when a newer record of the key comes.
+    """
+    def __init__(self, memc_addr, line_queue, result_queue, dry_run,
+                 batch_size=BATCH_SIZE, batch_timeout=BATCH_TIMEOUT,
+                 fingerprints=None):
         threading.Thread.__init__(self)
         self.daemon = True
         self.memc_addr = memc_addr
         self.line_queue = line_queue
         self.result_queue = result_queue
         self.dry_run = dry_run
+        self.batch_size = batch_size
+        self.batch_timeout = batch_timeout
+        self.fingerprints = fingerprints
         self.processed = 0
         self.errors = 0
+        self.batch = {}
+        self.batch_started = None
+        # heap of (due time, seq, attempt, {key: packed}) to retry
+        self.retries = []
+        self.retry_seq = itertools.count()
+        # seq of the retry which is to write a key
+        self.retry_keys = {}
+
+    def make_client(self):
+        return memcache.Client([self.memc_addr], socket_timeout=1)
 
     def run(self):
-        client = memcache.Client([self.memc_addr], socket_timeout=1)
+        started = get_thread_cpu()
+        client = self.make_client()
+        METRICS.gauge(self.memc_addr, "queue", self.line_queue.qsize)
         while True:
             try:
-                key_packed = self.line_queue.get()
-                if key_packed == SENTINEL:
-                    self.result_queue.put((self.processed, self.errors))
-                    break
-                else:
-                    self.processed += 1
-                    ok = insert_appsinstalled(client, key_packed, self.dry_run)
-                    if not ok:
-                        self.errors += 1
+                key_packed = self.line_queue.get(timeout=self.get_timeout())
             except Queue.Empty:
+                self.flush(client)
+                continue
+            if key_packed is SENTINEL or key_packed is FLUSH:
+                self.flush(client, force=True)
+                while self.retries:
+                    time.sleep(max(self.retries[0][0] - time.time(), 0))
+                    self.flush(client, force=True)
+                self.result_queue.put((self.processed, self.errors))
+                self.processed = self.errors = 0
+                if key_packed is FLUSH:
+                    continue
+                METRICS.remove_gauge(self.memc_addr, "queue")
+                count_cpu("write", started)
+                break
+            self.processed += 1
+            key, packed = key_packed
+            if not self.batch:
+                self.batch_started = time.time()
+            self.batch[key] = packed
+            # the retry would overwrite the newer record
+            self.retry_keys.pop(key, None)
+            self.flush(client)
+
+    def get_timeout(self):
+        """Get time to wait for the next record before a flush is due"""
+        due = []
+        if self.batch:
+            due.append(self.batch_started + self.batch_timeout)
+        if self.retries:
+            due.append(self.retries[0][0])
+        if not due:
+            return None
+        return max(min(due) - time.time(), 0)
+
+    def flush(self, client, force=False):
+        """Send the batch if it is full or expired, with due retries"""
+        now = time.time()
+        batch_due = self.batch and (
+            force or len(self.batch) >= self.batch_size or
+            now - self.batch_started >= self.batch_timeout)
+        retry_due = self.retries and self.retries[0][0] <= now
+        if not batch_due and not retry_due:
+            return
+
+        attempts = {}
+        records = {}
+        while self.retries and self.retries[0][0] <= now:
+            _, seq, attempt, retry_records = heapq.heappop(self.retries)
+            for key, packed in retry_records.items():
+                if self.retry_keys.get(key) == seq:
+                    del self.retry_keys[key]
+                    records[key] = packed
+                    attempts[key] = attempt
+        if batch_due:
+            records.update(self.batch)
+            attempts.update(dict.fromkeys(self.batch, 1))
+            self.batch = {}
+        if not records:
+            return
+
+        failed = insert_appsinstalled(client, records, self.dry_run)
+        METRICS.observe(self.memc_addr, "set_latency", [time.time() - now],
+                        len(records))
+        count_writes(self.memc_addr, records, failed)
+        if self.fingerprints is not None and not self.dry_run:
+            self.fingerprints.update(self.memc_addr,
+                                     get_written(records, failed))
+
+        retry_by_attempt = collections.defaultdict(dict)
+        for key in failed:
+            attempt = attempts[key]
+            if attempt >= MAX_ATTEMPTS:
+                self.errors += 1
+                METRICS.incr(self.memc_addr, "failures")
+            else:
+                retry_by_attempt[attempt + 1][key] = records[key]
+                METRICS.incr(self.memc_addr, "retries")
+        for attempt, retry_records in retry_by_attempt.items():
+            due = now + RETRY_BACKOFF * 2 ** (attempt - 2)
+            seq = next(self.retry_seq)
+            self.retry_keys.update(dict.fromkeys(retry_records, seq))
+            heapq.heappush(self.retries, (due, seq, attempt, retry_records))
+
+
+class MemcacheConnection(object):
+    """Non-blocking memcached connection pipelining set commands
+
+    Commands are appended to the output buffer and written when the socket
+    is writable, replies are matched to the keys in the order of sending.
+    """
+    def __init__(self, addr):
+        self.addr = addr
+        self.sock = None
+        self.out = bytearray()
+        self.data = ""
+        self.pending = collections.deque()
+        self.stored = []
+        self.failed = 0
+        self.down_until = 0
+        self.last_reply = 0
+
+    def fileno(self):
+        return self.sock.fileno()
+
+    def connect(self):
+        host, port = self.addr.rsplit(":", 1)
+        self.sock = socket.create_connection((host, int(port)), SOCKET_TIMEOUT)
+        self.sock.setblocking(False)
+        self.last_reply = time.time()
+
+    def set(self, key, packed, attempt=1):
+        METRICS.incr(self.addr, "bytes", len(key) + len(packed))
+        self.out += "set %s 0 0 %d\r\n" % (key, len(packed))
+        self.out += packed
+        self.out += "\r\n"
+        now = time.time()
+        if not self.pending:
+            self.last_reply = now
+        self.pending.append((key, packed, attempt, now))
+
+    def write(self):
+        sent = self.sock.send(self.out)
+        del self.out[:sent]
+
+    def read(self):
+        data = self.sock.recv(RECV_SIZE)
+        if not data:
+            raise socket.error("Connection closed")
+        self.last_reply = time.time()
+        replies = (self.data + data).split("\r\n")
+        self.data = replies.pop()
+        failed = self.failed
+        latencies = []
+        for reply in replies:
+            if not self.pending:
+                raise socket.error("Unexpected reply: %s" % reply)
+            key, packed, _, sent = self.pending.popleft()
+            latencies.append(self.last_reply - sent)
+            if reply == "STORED":
+                self.stored.append((key, packed))
+            else:
+                self.failed += 1
+                logging.error("Cannot write %s to memc %s: %s" %
+                              (key, self.addr, reply))
+        METRICS.observe(self.addr, "set_latency", latencies)
+        METRICS.incr(self.addr, "sets", len(replies) - self.failed + failed)
+        METRICS.incr(self.addr, "failures", self.failed - failed)
+
+    def close(self):
+        """Close the socket, return (key, packed, attempt) left unanswered"""
+        lost = [(key, packed, attempt)
+                for key, packed, attempt, _ in self.pending]
+        if self.sock is not None:
+            self.sock.close()
+        self.sock = None
+        self.out = bytearray()
+        self.data = ""
+        self.pending.clear()
+        return lost
+
+
+class PipelineLoader(object):
+    """Writes records to memcached servers by pipelined set commands
+
+    Every server of addrs gets a pool of non-blocking connections served by
+    select, a record goes to the connection with the fewest commands in
+    flight. When depth commands to a server are unanswered set waits for
+    replies, so memory used for buffers stays bounded. Records left
+    unanswered on a dropped connection are sent again with backoff, unless
+    a newer record of the key comes before.
+    """
+    def __init__(self, addrs, dry_run=False,
+                 connections=PIPELINE_CONNECTIONS, depth=PIPELINE_DEPTH,
+                 fingerprints=None):
+        self.pools = dict(
+            (addr, [MemcacheConnection(addr) for _ in range(connections)])
+            for addr in addrs)
+        for addr, pool in self.pools.items():
+            METRICS.gauge(addr, "queue", lambda pool=pool:
+                          self.in_flight(pool))
+        self.dry_run = dry_run
+        self.depth = depth
+        self.fingerprints = fingerprints
+        self.errors = 0
+        # {key: (addr, packed, attempt, due time)} to send again
+        self.retries = {}
+
+    def set(self, addr, key, packed):
+        pool = self.pools[addr]
+        if self.dry_run:
+            logging.debug("%s - %s -> %s" % (pool[0].addr, key, packed))
+            return
+        if " " in key or len(key) > MAX_KEY_LENGTH:
+            logging.error("Invalid memc key: %s" % key)
+            self.errors += 1
+            return
+        # the retry would overwrite the newer record
+        self.retries.pop(key, None)
+        if self.in_flight(pool) >= self.depth:
+            while self.in_flight(pool) > self.depth // 2:
+                self.poll()
+        conn = min(pool, key=lambda c: len(c.pending))
+        if conn.sock is None and not self.connect(conn):
+            self.errors += 1
+            METRICS.incr(conn.addr, "failures")
+            return
+        conn.set(key, packed)
+        if len(conn.out) >= WRITE_BUFFER_SIZE:
+            self.poll(0)
+
+    def in_flight(self, pool):
+        return sum(len(conn.pending) for conn in pool)
+
+    def connect(self, conn):
+        if time.time() < conn.down_until:
+            return False
+        try:
+            conn.connect()
+        except socket.error as e:
+            logging.error("Cannot connect to memc %s: %s" % (conn.addr, e))
+            conn.down_until = time.time() + RECONNECT_DELAY
+            conn.close()
+            return False
+        return True
+
+    def drop(self, conn, reason):
+        lost = conn.close()
+        logging.error("Dropped connection to memc %s with %d records: %s" %
+                      (conn.addr, len(lost), reason))
+        for key, packed, attempt in lost:
+            self.retry(conn.addr, key, packed, attempt)
+
+    def retry(self, addr, key, packed, attempt):
+        """Schedule record to send again, count it lost after attempts"""
+        if attempt >= MAX_ATTEMPTS:
+            self.errors += 1
+            METRICS.incr(addr, "failures")
+            return
+        due = time.time() + RETRY_BACKOFF * 2 ** (attempt - 1)
+        self.retries[key] = (addr, packed, attempt + 1, due)
+        METRICS.incr(addr, "retries")
+
+    def send_retries(self):
+        """Send due retries, return seconds until the next one is due"""
+        now = time.time()
+        next_due = None
+        for key, (addr, packed, attempt, due) in self.retries.items():
+            if due > now:
+                next_due = min(next_due or due, due)
+                continue
+            del self.retries[key]
+            conn = min(self.pools[addr], key=lambda c: len(c.pending))
+            if conn.sock is None and not self.connect(conn):
+                self.retry(addr, key, packed, attempt)
+                continue
+            conn.set(key, packed, attempt)
+        return None if next_due is None else next_due - now
+
+    def poll(self, timeout=SOCKET_TIMEOUT):
+        """Write buffered commands and read replies ready in timeout"""
+        retry_timeout = self.send_retries() if self.retries else None
+        conns = [conn for pool in self.pools.values() for conn in pool
+                 if conn.sock is not None and conn.pending]
+        if not conns:
+            if retry_timeout is not None:
+                time.sleep(min(retry_timeout, timeout))
+            return
+        readable, writable, _ = select.select(
+            conns, [conn for conn in conns if conn.out], [], timeout)
+        for conn in writable:
+            try:
+                conn.write()
+            except socket.error as e:
+                self.drop(conn, e)
+        for conn in readable:
+            if conn.sock is None:
                 continue
+            try:
+                conn.read()
+            except socket.error as e:
+                self.drop(conn, e)
+            if self.fingerprints is not None and conn.stored:
+                self.fingerprints.update(conn.addr, conn.stored)
+            del conn.stored[:]
+        if timeout:
+            now = time.time()
+            for conn in conns:
+                if conn.sock is not None and now - conn.last_reply > timeout:
+                    self.drop(conn, "timeout")
+
+    def flush(self):
+        """Wait for replies to all commands, return errors since last flush"""
+        while self.retries or any(conn.pending for pool in self.pools.values()
+                                  for conn in pool):
+            self.poll()
+        errors = self.errors
+        for pool in self.pools.values():
+            for conn in pool:
+                errors += conn.failed
+                conn.failed = 0
+        self.errors = 0
+        return errors
+
+    def close(self):
+        """Flush and close connections, return number of errors"""
+        errors = self.flush()
+        for pool in self.pools.values():
+            for conn in pool:
+                conn.close()
+                METRICS.remove_gauge(conn.addr, "queue")
+        return errors
+
+
+def ring_hash(key):
+    return struct.unpack_from("<Q", hashlib.md5(key).digest())[0]
+
+
+class HashRing(object):
+    """Consistent hash ring of memcached servers
+
+    Every server has replicas points on the ring, a key goes to the server
+    of the first point after the hash of the key. Adding a server to n
+    servers moves about 1/(n + 1) of keys to it, others stay in place.
+    """
+    def __init__(self, nodes, replicas=RING_REPLICAS):
+        points = sorted((ring_hash("%s-%d" % (node, n)), node)
+                        for node in nodes for n in range(replicas))
+        self.hashes = [point for point, _ in points]
+        self.nodes = [node for _, node in points]
+        self.single = nodes[0] if len(set(nodes)) == 1 else None
+
+    def get_node(self, key):
+        if self.single is not None:
+            return self.single
+        index = bisect.bisect(self.hashes, ring_hash(key))
+        return self.nodes[index % len(self.nodes)]
+
+
+def fingerprint(data):
+    """Get non-zero 64-bit hash of data"""
+    return ring_hash(data) or 1
+
+
+class FingerprintStore(object):
+    """Memory-mapped hash table of fingerprints of records in memcached
+
+    Maps 64-bit hash of a server address and a key to 64-bit hash of the
+    packed value by open addressing with linear probing, zero key hash marks
+    an empty slot. A key moved to another server by a change of the ring is
+    not found, so its record is sent to the new server.
+    Processes read the table without locks and update it under flock. The
+    table doesn't grow: keys which don't fit are not stored, so their
+    records are always sent.
+    """
+    def __init__(self, path, capacity=FINGERPRINT_CAPACITY):
+        if not os.path.exists(path):
+            self.create(path, capacity)
+        self.path = path
+        self.file = open(path, "r+b")
+        self.mm = mmap.mmap(self.file.fileno(), 0)
+        magic, self.capacity, _ = FINGERPRINT_HEADER.unpack_from(self.mm)
+        if magic != FINGERPRINT_MAGIC:
+            raise ValueError("Not a fingerprint store: %s" % path)
+        self.mask = self.capacity - 1
+        self.max_used = int(self.capacity * FINGERPRINT_MAX_LOAD)
+
+    @staticmethod
+    def create(path, capacity):
+        """Create empty sparse table of capacity rounded up to power of 2"""
+        capacity = 1 << max(capacity - 1, 1).bit_length()
+        with open(path + ".tmp", "wb") as f:
+            f.write(FINGERPRINT_HEADER.pack(FINGERPRINT_MAGIC, capacity, 0))
+            f.truncate(FINGERPRINT_HEADER.size +
+                       capacity * FINGERPRINT_SLOT.size)
+        os.rename(path + ".tmp", path)
+
+    def find(self, key_hash):
+        """Get (offset, value hash) of slot of key_hash
+
+        Value hash is None if there is no key_hash and the slot is empty,
+        offset is None if the table is full.
+        """
+        index = key_hash & self.mask
+        for _ in xrange(self.capacity):
+            offset = FINGERPRINT_HEADER.size + index * FINGERPRINT_SLOT.size
+            slot_key, value = FINGERPRINT_SLOT.unpack_from(self.mm, offset)
+            if slot_key == key_hash:
+                return offset, value
+            if not slot_key:
+                return offset, None
+            index = (index + 1) & self.mask
+        return None, None
+
+    def changed(self, addr, key, packed):
+        """Check if record is not in memcached addr according to the store"""
+        key_hash = fingerprint(addr + " " + key)
+        return self.find(key_hash)[1] != fingerprint(packed)
+
+    def update(self, addr, records):
+        """Store fingerprints of (key, packed) records written to addr"""
+        fcntl.flock(self.file, fcntl.LOCK_EX)
+        try:
+            used = FINGERPRINT_HEADER.unpack_from(self.mm)[2]
+            for key, packed in records:
+                key_hash = fingerprint(addr + " " + key)
+                offset, value = self.find(key_hash)
+                if offset is None:
+                    continue
+                if value is None:
+                    if used >= self.max_used:
+                        continue
+                    used += 1
+                FINGERPRINT_SLOT.pack_into(self.mm, offset, key_hash,
+                                           fingerprint(packed))
+            FINGERPRINT_HEADER.pack_into(self.mm, 0, FINGERPRINT_MAGIC,
+                                         self.capacity, used)
+        finally:
+            fcntl.flock(self.file, fcntl.LOCK_UN)
+
+    def close(self):
+        self.mm.close()
+        self.file.close()
+
+
+# fingerprint stores opened by this process
+FINGERPRINTS = {}
+
+
+def get_fingerprints(options):
+    """Get FingerprintStore of --diff option, None if it is not given"""
+    if not options.diff:
+        return None
+    if options.diff not in FINGERPRINTS:
+        FINGERPRINTS[options.diff] = FingerprintStore(options.diff,
+                                                      options.diff_capacity)
+    return FINGERPRINTS[options.diff]
+
+
+def is_unchanged(fingerprints, addr, key, packed):
+    """Check if record is in memcached already, count skipped records"""
+    if fingerprints is None or fingerprints.changed(addr, key, packed):
+        return False
+    METRICS.incr(addr, "skipped")
+    return True
+
+
+def get_written(records, failed):
+    """Get list of (key, packed) of {key: packed} records but failed keys"""
+    failed = set(failed)
+    return [(key, packed) for key, packed in records.items()
+            if key not in failed]
+
+
+def get_rings(device_memc):
+    """Get {dev_type: HashRing} of {dev_type: list of servers}"""
+    return dict((dev_type, HashRing(addrs))
+                for dev_type, addrs in device_memc.items())
+
+
+def get_addrs(device_memc):
+    """Get sorted list of all servers of {dev_type: list of servers}"""
+    return sorted(set(addr for addrs in device_memc.values()
+                      for addr in addrs))
 
 
 def dot_rename(path):
@@ -60,25 +844,34 @@ def dot_rename(path):
     os.rename(path, os.path.join(head, "." + fn))
 
 
-def insert_appsinstalled(memc, key_packed, dry_run=False):
-    key, packed = key_packed
-    current = 1
-    allowed = 3
-    timeout = 0.3
+def insert_appsinstalled(memc, records, dry_run=False):
+    """Write {key: packed} records to memc, return list of failed keys
+
+    The whole batch fails on any error: set_multi doesn't report keys whose
+    replies were not read when the server was marked dead on a socket error.
+    """
     try:
         if dry_run:
-            logging.debug("%s - %s -> %s" % (memc.servers[0], key, packed))
+            for key, packed in records.items():
+                logging.debug("%s - %s -> %s" % (memc.servers[0], key, packed))
         else:
-            res = memc.set(key, packed)
-            while res == 0 and (current < allowed):
-                time.sleep(timeout)
-                current += 1
-                res = memc.set(key, packed)
-            return bool(res)
+            failed = memc.set_multi(records)
+            if any(getattr(server, "deaduntil", 0) for server in memc.servers):
+                raise IOError("server is marked dead")
+            return failed
     except Exception as e:
         logging.exception("Cannot write to memc %s: %s" % (memc.servers[0], e))
-        return False
-    return True
+        return list(records)
+    return []
+
+
+def count_writes(addr, records, failed):
+    """Count sets and bytes of records written to addr but failed keys"""
+    failed = set(failed)
+    METRICS.incr(addr, "sets", len(records) - len(failed))
+    METRICS.incr(addr, "bytes", sum(len(key) + len(packed)
+                                    for key, packed in records.items()
+                                    if key not in failed))
 
 
 def parse_appsinstalled(line):
@@ -91,7 +884,7 @@ def parse_appsinstalled(line):
     try:
         apps = [int(a.strip()) for a in raw_apps.split(",")]
     except ValueError:
-        apps = [int(a.strip()) for a in raw_apps.split(",") if a.isidigit()]
+        apps = [int(a.strip()) for a in raw_apps.split(",") if a.isdigit()]
         logging.info("Not all user apps are digits: `%s`" % line)
     try:
         lat, lon = float(lat), float(lon)
@@ -100,6 +893,52 @@ def parse_appsinstalled(line):
     return AppsInstalled(dev_type, dev_id, lat, lon, apps)
 
 
+def encode_varint(value):
+    out = []
+    while value > 0x7f:
+        out.append(chr(value & 0x7f | 0x80))
+        value >>= 7
+    out.append(chr(value))
+    return "".join(out)
+
+
+def encode_app_field(app):
+    if not 0 <= app <= MAX_APP:
+        raise ValueError("App id is out of uint32 range: %s" % app)
+    return APP_TAG + encode_varint(app)
+
+
+# encoded apps fields of small app ids
+APP_FIELDS = [encode_app_field(app) for app in range(APP_TABLE_SIZE)]
+
+
+def serialize_batch(rows):
+    """Serialize AppsInstalled rows into list of (key, packed)
+
+    Writes UserApps wire format directly, byte-identical to
+    serialize_appsinstalled, with apps fields taken from the table of
+    encoded small ids. packed is None for rows which can't be serialized.
+    """
+    app_field = APP_FIELDS.__getitem__
+    pack_geo = GEO_FIELDS.pack
+    records = []
+    for row in rows:
+        key = "%s:%s" % (row.dev_type, row.dev_id)
+        try:
+            if row.apps and min(row.apps) < 0:
+                raise ValueError("Negative app id")
+            try:
+                apps = "".join(map(app_field, row.apps))
+            except IndexError:
+                apps = "".join(map(encode_app_field, row.apps))
+            packed = apps + pack_geo(LAT_TAG, row.lat, LON_TAG, row.lon)
+        except (ValueError, struct.error) as e:
+            logging.error("Cannot serialize %s: %s" % (key, e))
+            packed = None
+        records.append((key, packed))
+    return records
+
+
 def serialize_appsinstalled(appsinstalled):
     ua = appsinstalled_pb2.UserApps()
     ua.lat = appsinstalled.lat
@@ -110,87 +949,741 @@ def serialize_appsinstalled(appsinstalled):
     return (key, packed)
 
 
-def process_file(opt):
-    fn, device_memc, dry = opt
-    result_queue = Queue.Queue()
-    threads = []
-    queue_dict = {}
-
-    for dev_type, addr in device_memc.items():
-        queue_dict[dev_type] = Queue.Queue()
-        thread = MemcacheClient(queue_dict[dev_type], result_queue, addr, dry)
-        threads.append(thread)
-
-    for thread in threads:
-        thread.start()
-
-    processed = errors = 0
-    logging.info('Pr.Name: %s. Processing %s' % (mp.current_process().name, fn))
-    fd = gzip.open(fn)
-    for line in fd:
-        processed += 1
-        logging.info('Pr. Name: %s. Processing %s' %
-                     (mp.current_process().name, line))
+def iter_parsed(lines):
+    """Yield AppsInstalled of lines, None for invalid ones"""
+    for line in lines:
         line = line.strip()
         if not line:
-            errors += 1
+            yield None
             continue
-        appsinstalled = parse_appsinstalled(line)
-        dev_type = appsinstalled.dev_type
+        yield parse_appsinstalled(line)
+
+
+def iter_records(rows, device_memc, batch_size=SERIALIZE_BATCH_SIZE,
+                 scope=None):
+    """Yield (dev_type, key, packed) of AppsInstalled rows, None for invalid
+
+    Valid rows are serialized by batches of batch_size, so records can
+    come in other order than rows. Lines and errors are counted in metrics
+    of scope by batches.
+    """
+    batch = []
+    lines = errors = 0
+    for appsinstalled in rows:
+        lines += 1
         if not appsinstalled:
             errors += 1
+            yield None
             continue
+        dev_type = appsinstalled.dev_type
         if dev_type not in device_memc:
-            errors += 1
             logging.error("Pr. Name: %s. Unknow device type: %s"
                           % (mp.current_process().name, dev_type))
+            errors += 1
+            yield None
             continue
-        key_packed = serialize_appsinstalled(appsinstalled)
-        queue_dict[dev_type].put(key_packed)
+        batch.append(appsinstalled)
+        if len(batch) >= batch_size:
+            for record in iter_serialized(batch, scope):
+                yield record
+            METRICS.incr(scope, "lines", lines)
+            METRICS.incr(scope, "errors", errors)
+            batch = []
+            lines = errors = 0
+    for record in iter_serialized(batch, scope):
+        yield record
+    METRICS.incr(scope, "lines", lines)
+    METRICS.incr(scope, "errors", errors)
+
+
+def iter_serialized(rows, scope=None):
+    for row, (key, packed) in zip(rows, serialize_batch(rows)):
+        if packed is None:
+            METRICS.incr(scope, "errors")
+            yield None
+        else:
+            yield row.dev_type, key, packed
+
+
+def is_columnar(fn):
+    return fn.endswith(COLUMNAR_EXT)
+
+
+def get_columnar_path(fn):
+    """Get path of columnar file converted from fn, name.tsv.gz -> name.col"""
+    head, name = os.path.split(fn)
+    if name.endswith(LOG_EXT):
+        name = name[:-len(LOG_EXT)]
+    return os.path.join(head, name + COLUMNAR_EXT)
+
+
+def pack_column(fmt, values):
+    return struct.pack("<%d%s" % (len(values), fmt), *values)
+
+
+class ColumnBuffer(object):
+    """Section of columnar file written to a temporary file by chunks
+
+    Values are packed by fmt, None fmt means byte strings.
+    """
+    def __init__(self, fmt, values=()):
+        self.fmt = fmt
+        self.values = list(values)
+        self.file = tempfile.TemporaryFile()
+        self.size = 0
+
+    def append(self, value):
+        self.values.append(value)
+        if len(self.values) >= COLUMNAR_CHUNK:
+            self.flush()
+
+    def extend(self, values):
+        self.values.extend(values)
+        if len(self.values) >= COLUMNAR_CHUNK:
+            self.flush()
+
+    def flush(self):
+        if self.fmt is None:
+            data = "".join(self.values)
+        else:
+            data = pack_column(self.fmt, self.values)
+        self.file.write(data)
+        self.size += len(data)
+        del self.values[:]
 
-    for dev_type in device_memc:
-        queue_dict[dev_type].put(SENTINEL)
+    def copy_to(self, f):
+        self.flush()
+        self.file.seek(0)
+        shutil.copyfileobj(self.file, f)
+        self.file.close()
 
-    for thread in threads:
-        thread.join()
 
-    while not result_queue.empty():
-        thread_processed, thread_errors = result_queue.get()
-        processed += thread_processed
-        errors += thread_errors
+def convert_file(fn, path, dev_types):
+    """Convert tsv.gz file fn into columnar file at path
 
-    if processed:
-        err_rate = float(errors) / processed
-        if err_rate < NORMAL_ERR_RATE:
-            logging.info("Prn: %s. Fn: %s. Acceptable error rate (%s). \
-                     Successfull load" % (mp.current_process().name, fn, err_rate))
+    Columns are dev_type dictionary codes, offsets of dev_ids and their
+    bytes, float64 lat and lon, offsets of apps of every row and app ids
+    as uint32. Lines which can't be loaded, as well as lines of device types
+    not in dev_types, are only counted. Columns are buffered in temporary
+    files, so memory used doesn't grow with the file.
+    """
+    if len(dev_types) > 256:
+        raise ValueError("Too many device types for uint8 codes")
+    type_codes = {}
+    codes = ColumnBuffer("B")
+    dev_ids = ColumnBuffer(None)
+    id_offsets = ColumnBuffer("Q", [0])
+    lats = ColumnBuffer("d")
+    lons = ColumnBuffer("d")
+    app_offsets = ColumnBuffer("Q", [0])
+    apps = ColumnBuffer("I")
+    rows = id_offset = app_offset = errors = 0
+    fd = gzip.open(fn)
+    for appsinstalled in iter_parsed(fd):
+        try:
+            if not appsinstalled:
+                raise ValueError("Invalid line")
+            dev_type, dev_id, lat, lon, row_apps = appsinstalled
+            if dev_type not in dev_types:
+                raise ValueError("Unknown device type: %s" % dev_type)
+            if not isinstance(lat, float) or not isinstance(lon, float):
+                raise ValueError("Invalid geo coords")
+            if row_apps and not 0 <= min(row_apps) <= max(row_apps) <= MAX_APP:
+                raise ValueError("App id is out of uint32 range")
+        except ValueError as e:
+            logging.error("Cannot convert line of %s: %s" % (fn, e))
+            errors += 1
+            continue
+        codes.append(type_codes.setdefault(dev_type, len(type_codes)))
+        dev_ids.append(dev_id)
+        id_offset += len(dev_id)
+        id_offsets.append(id_offset)
+        lats.append(lat)
+        lons.append(lon)
+        apps.extend(row_apps)
+        app_offset += len(row_apps)
+        app_offsets.append(app_offset)
+        rows += 1
+    fd.close()
+
+    types = sorted(type_codes, key=type_codes.get)
+    sections = ["\t".join(types), codes, id_offsets, dev_ids, lats, lons,
+                app_offsets, apps]
+    offsets = []
+    offset = COLUMNAR_HEADER.size
+    for section in sections:
+        offsets.append(offset)
+        if isinstance(section, ColumnBuffer):
+            section.flush()
+            offset += section.size
         else:
-            logging.error("Process name: %s. File name: %s. \
-                          High error rate (%s> %s). \
-                          Failed load" % (mp.current_process().name,
-                          fn, err_rate, NORMAL_ERR_RATE))
+            offset += len(section)
+        # sections are aligned to 8 bytes
+        offset += -offset % 8
+
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(COLUMNAR_HEADER.pack(COLUMNAR_MAGIC, rows, errors,
+                                     app_offset, *offsets))
+        for section in sections:
+            if isinstance(section, ColumnBuffer):
+                section.copy_to(f)
+            else:
+                f.write(section)
+            f.write("\0" * (-f.tell() % 8))
+    os.rename(tmp_path, path)
+    return rows, errors
+
+
+class ColumnarFile(object):
+    """Memory-mapped columnar file made by convert_file"""
+    def __init__(self, path):
+        self.path = path
+        with open(path, "rb") as f:
+            self.mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        header = COLUMNAR_HEADER.unpack_from(self.mm)
+        if header[0] != COLUMNAR_MAGIC:
+            raise ValueError("Not a columnar file: %s" % path)
+        self.rows, self.errors, self.apps = header[1:4]
+        (types, self.codes, self.id_offsets, self.dev_ids, self.lats,
+         self.lons, self.app_offsets, self.app_ids) = header[4:]
+        self.dev_types = self.mm[types:self.codes].rstrip("\0").split("\t")
+
+    def column(self, fmt, offset, start, stop):
+        size = struct.calcsize(fmt)
+        return struct.unpack_from("<%d%s" % (stop - start, fmt), self.mm,
+                                  offset + start * size)
+
+    def iter_rows(self, start=0, stop=None):
+        """Yield AppsInstalled of rows from start to stop
+
+        Columns are unpacked by chunks of COLUMNAR_CHUNK rows, so memory
+        used doesn't grow with the range.
+        """
+        if stop is None:
+            stop = self.rows
+        for chunk_start in xrange(start, stop, COLUMNAR_CHUNK):
+            chunk_stop = min(chunk_start + COLUMNAR_CHUNK, stop)
+            for row in self.iter_chunk(chunk_start, chunk_stop):
+                yield row
+
+    def iter_chunk(self, start, stop):
+        """Yield AppsInstalled of rows from start to stop unpacked at once"""
+        dev_types = self.dev_types
+        codes = self.column("B", self.codes, start, stop)
+        id_offsets = self.column("Q", self.id_offsets, start, stop + 1)
+        dev_ids = self.mm[self.dev_ids + id_offsets[0]:
+                          self.dev_ids + id_offsets[-1]]
+        lats = self.column("d", self.lats, start, stop)
+        lons = self.column("d", self.lons, start, stop)
+        app_offsets = self.column("Q", self.app_offsets, start, stop + 1)
+        apps = self.column("I", self.app_ids, app_offsets[0], app_offsets[-1])
+        id_base = id_offsets[0]
+        app_base = app_offsets[0]
+        for n in xrange(stop - start):
+            yield AppsInstalled(
+                dev_types[codes[n]],
+                dev_ids[id_offsets[n] - id_base:id_offsets[n + 1] - id_base],
+                lats[n], lons[n],
+                apps[app_offsets[n] - app_base:app_offsets[n + 1] - app_base])
+
+    def close(self):
+        self.mm.close()
+
+
+def iter_batches(fn, offset, batch_size):
+    """Yield (batch, end offset) of batches of batch_size lines from offset
+
+    Batch is list of lines of tsv.gz file or (start, stop) range of rows
+    of columnar file.
+    """
+    if is_columnar(fn):
+        columnar = ColumnarFile(fn)
+        rows = columnar.rows
+        columnar.close()
+        for start in xrange(offset, rows, batch_size):
+            stop = min(start + batch_size, rows)
+            yield (start, stop), stop
+        return
+    fd = gzip.open(fn)
+    fd.seek(offset)
+    while True:
+        lines = list(itertools.islice(fd, batch_size))
+        if not lines:
+            break
+        offset += sum(map(len, lines))
+        yield lines, offset
     fd.close()
+
+
+def get_checkpoint_path(fn):
+    head, name = os.path.split(fn)
+    return os.path.join(head, "." + name + ".checkpoint")
+
+
+def get_file_id(fn):
+    stat = os.stat(fn)
+    return [stat.st_size, stat.st_mtime]
+
+
+def load_checkpoint(fn):
+    """Get checkpoint of fn, start of file if there is no valid one"""
+    try:
+        with open(get_checkpoint_path(fn)) as f:
+            data = json.load(f)
+        if data["file"] == get_file_id(fn):
+            return Checkpoint(data["offset"], data["processed"],
+                              data["errors"])
+        logging.info("Checkpoint of %s is outdated" % fn)
+    except (IOError, ValueError, KeyError) as e:
+        if getattr(e, "errno", None) != errno.ENOENT:
+            logging.error("Cannot read checkpoint of %s: %s" % (fn, e))
+    return Checkpoint(0, 0, 0)
+
+
+def save_checkpoint(fn, checkpoint):
+    """Write checkpoint of fn atomically"""
+    path = get_checkpoint_path(fn)
+    data = dict(checkpoint._asdict(), file=get_file_id(fn))
+    with open(path + ".tmp", "w") as f:
+        json.dump(data, f)
+    os.rename(path + ".tmp", path)
+
+
+def remove_checkpoint(fn):
+    try:
+        os.remove(get_checkpoint_path(fn))
+    except OSError:
+        pass
+
+
+def open_rows(fn, offset=0):
+    """Get (rows, close) of file fn, tsv.gz or columnar, from offset"""
+    if is_columnar(fn):
+        columnar = ColumnarFile(fn)
+        return columnar.iter_rows(offset), columnar.close
+    fd = gzip.open(fn)
+    fd.seek(offset)
+    return iter_parsed(fd), fd.close
+
+
+class ThreadedLoader(object):
+    """Writes records to memcached servers by MemcacheClient thread per server
+
+    Has the interface of PipelineLoader: flush waits until records set
+    before are written, so threads and connections live across flushes.
+    """
+    def __init__(self, addrs, dry_run=False, batch_size=BATCH_SIZE,
+                 batch_timeout=BATCH_TIMEOUT, fingerprints=None):
+        self.result_queue = Queue.Queue()
+        self.queues = {}
+        self.threads = []
+        for addr in addrs:
+            self.queues[addr] = Queue.Queue()
+            thread = MemcacheClient(addr, self.queues[addr],
+                                    self.result_queue, dry_run, batch_size,
+                                    batch_timeout, fingerprints)
+            thread.start()
+            self.threads.append(thread)
+
+    def set(self, addr, key, packed):
+        self.queues[addr].put((key, packed))
+
+    def wait(self, marker):
+        for queue in self.queues.values():
+            queue.put(marker)
+        errors = 0
+        for _ in self.threads:
+            errors += self.result_queue.get()[1]
+        return errors
+
+    def flush(self):
+        """Wait for all records to be written, return errors since last flush"""
+        return self.wait(FLUSH)
+
+    def close(self):
+        """Flush and stop threads, return number of errors"""
+        errors = self.wait(SENTINEL)
+        for thread in self.threads:
+            thread.join()
+        return errors
+
+
+def make_loader(device_memc, options, fingerprints):
+    """Get ThreadedLoader or PipelineLoader of servers of device_memc"""
+    addrs = get_addrs(device_memc)
+    if options.pipeline:
+        return PipelineLoader(addrs, options.dry,
+                              options.pipeline_connections,
+                              options.pipeline_depth,
+                              None if options.dry else fingerprints)
+    return ThreadedLoader(addrs, options.dry, options.batch_size,
+                          options.batch_timeout, fingerprints)
+
+
+def load_records(records, rings, loader, fingerprints):
+    """Set records by loader, return (processed, errors) of invalid records
+
+    Errors of writes are returned by flush and close of the loader.
+    """
+    processed = errors = 0
+    for record in records:
+        processed += 1
+        if record is None:
+            errors += 1
+            continue
+        dev_type, key, packed = record
+        addr = rings[dev_type].get_node(key)
+        if not is_unchanged(fingerprints, addr, key, packed):
+            loader.set(addr, key, packed)
+    return processed, errors
+
+
+def load(records, device_memc, options):
+    """Load records, return (processed, errors)"""
+    fingerprints = get_fingerprints(options)
+    loader = make_loader(device_memc, options, fingerprints)
+    processed, errors = load_records(records, get_rings(device_memc), loader,
+                                     fingerprints)
+    return processed, errors + loader.close()
+
+
+def load_threaded(records, device_memc, options):
+    """Load records by thread per server, return (processed, errors)"""
+    options = copy.copy(options)
+    options.pipeline = False
+    return load(records, device_memc, options)
+
+
+def load_pipelined(records, device_memc, options):
+    """Load records by pipelined connections, return (processed, errors)"""
+    options = copy.copy(options)
+    options.pipeline = True
+    return load(records, device_memc, options)
+
+
+def read_batches(fn_queue, batch_queue, result_queue, batch_size):
+    """Reader stage: split files from fn_queue into batches of lines"""
+    for fn, offset in iter(fn_queue.get, None):
+        # rows which were not converted are counted on the first load
+        errors = 0
+        if is_columnar(fn) and not offset:
+            columnar = ColumnarFile(fn)
+            errors = columnar.errors
+            columnar.close()
+        batches = 0
+        for batch, end in iter_batches(fn, offset, batch_size):
+            batch_queue.put((fn, batches, end, batch))
+            batches += 1
+        result_queue.put(("read", fn, batches, errors))
+
+
+def parse_batches(batch_queue, rings, node_queues, result_queue, options):
+    """Parser stage: serialize batches of lines into per server batches"""
+    fingerprints = get_fingerprints(options)
+    columnar = None
+    for fn, index, end, lines in iter(batch_queue.get, None):
+        # parsers read rows of columnar files by ranges themselves
+        if isinstance(lines, tuple):
+            if columnar is None or columnar.path != fn:
+                if columnar is not None:
+                    columnar.close()
+                columnar = ColumnarFile(fn)
+            rows = columnar.iter_rows(*lines)
+        else:
+            rows = iter_parsed(lines)
+        node_records = collections.defaultdict(list)
+        processed = errors = 0
+        for record in iter_records(rows, rings, scope=fn):
+            processed += 1
+            if record is None:
+                errors += 1
+                continue
+            dev_type, key, packed = record
+            addr = rings[dev_type].get_node(key)
+            if not is_unchanged(fingerprints, addr, key, packed):
+                node_records[addr].append((key, packed))
+        for addr, records in node_records.items():
+            node_queues[addr].put((fn, index, records))
+        result_queue.put(("parsed", fn, index, end, processed, errors,
+                          len(node_records)))
+
+
+def write_records(memc, records, dry_run=False, fingerprints=None):
+    """Write records retrying failed keys, return number of errors"""
+    addr = "%s:%d" % memc.servers[0].address
+    records = dict(records)
+    for attempt in range(MAX_ATTEMPTS):
+        if attempt:
+            METRICS.incr(addr, "retries", len(records))
+            time.sleep(RETRY_BACKOFF * 2 ** (attempt - 1))
+        started = time.time()
+        failed = insert_appsinstalled(memc, records, dry_run)
+        METRICS.observe(addr, "set_latency", [time.time() - started],
+                        len(records))
+        count_writes(addr, records, failed)
+        if fingerprints is not None and not dry_run:
+            fingerprints.update(addr, get_written(records, failed))
+        records = dict((key, records[key]) for key in failed)
+        if not records:
+            break
+    METRICS.incr(addr, "failures", len(records))
+    return len(records)
+
+
+def write_batches(addr, record_queue, result_queue, options):
+    """Writer stage: write batches of records to memcached server addr"""
+    fingerprints = get_fingerprints(options)
+    if options.pipeline:
+        loader = PipelineLoader([addr], options.dry,
+                                options.pipeline_connections,
+                                options.pipeline_depth,
+                                None if options.dry else fingerprints)
+    else:
+        memc = memcache.Client([addr], socket_timeout=SOCKET_TIMEOUT)
+    for fn, index, records in iter(record_queue.get, None):
+        if options.pipeline:
+            for key, packed in records:
+                loader.set(addr, key, packed)
+            errors = loader.flush()
+        else:
+            errors = write_records(memc, records, options.dry, fingerprints)
+        result_queue.put(("written", fn, index, errors))
+    if options.pipeline:
+        loader.close()
+
+
+class FileProgress(object):
+    """Batches of a file passed through the stages
+
+    Batches are confirmed in order of reading when all their records are
+    written, the checkpoint of the file is moved to the end of the last
+    confirmed batch and saved every checkpoint_every records.
+    """
+    def __init__(self, fn, checkpoint, checkpoint_every=CHECKPOINT_EVERY):
+        self.fn = fn
+        self.checkpoint = checkpoint
+        self.checkpoint_every = checkpoint_every
+        self.saved = checkpoint.processed
+        self.batches = None
+        self.confirmed = 0
+        self.pending = collections.defaultdict(
+            lambda: {"end": None, "writes": None, "processed": 0,
+                     "errors": 0})
+
+    def update(self, stage, *counts):
+        if stage == "read":
+            self.batches, errors = counts
+            self.checkpoint = self.checkpoint._replace(
+                processed=self.checkpoint.processed + errors,
+                errors=self.checkpoint.errors + errors)
+        elif stage == "parsed":
+            index, end, processed, errors, writes = counts
+            batch = self.pending[index]
+            batch["end"] = end
+            batch["processed"] += processed
+            batch["errors"] += errors
+            batch["writes"] = (batch["writes"] or 0) + writes
+        else:
+            index, errors = counts
+            batch = self.pending[index]
+            batch["errors"] += errors
+            batch["writes"] = (batch["writes"] or 0) - 1
+        self.confirm()
+
+    def confirm(self):
+        while self.confirmed in self.pending:
+            batch = self.pending[self.confirmed]
+            if batch["end"] is None or batch["writes"]:
+                break
+            del self.pending[self.confirmed]
+            self.confirmed += 1
+            self.checkpoint = Checkpoint(
+                batch["end"], self.checkpoint.processed + batch["processed"],
+                self.checkpoint.errors + batch["errors"])
+        if (self.checkpoint_every and not self.done and
+                self.checkpoint.processed - self.saved >= self.checkpoint_every):
+            save_checkpoint(self.fn, self.checkpoint)
+            self.saved = self.checkpoint.processed
+
+    @property
+    def done(self):
+        return self.confirmed == self.batches
+
+
+def log_load_result(fn, processed, errors):
+    if not processed:
+        return
+    err_rate = float(errors) / processed
+    if err_rate < NORMAL_ERR_RATE:
+        logging.info("Prn: %s. Fn: %s. Acceptable error rate (%s). \
+                 Successfull load" % (mp.current_process().name, fn, err_rate))
+    else:
+        logging.error("Process name: %s. File name: %s. \
+                      High error rate (%s> %s). \
+                      Failed load" % (mp.current_process().name,
+                      fn, err_rate, NORMAL_ERR_RATE))
+
+
+def main_staged(fns, device_memc, options, collector):
+    """Load files by stages of processes: readers split files into batches
+    of lines, parsers serialize them and writers of every memcached server
+    write them. A file is renamed when all its batches are written.
+    """
+    fn_queue = mp.Queue()
+    batch_queue = mp.Queue(QUEUE_SIZE * options.parsers)
+    result_queue = mp.Queue()
+    node_queues = dict((addr, mp.Queue(QUEUE_SIZE * options.writers))
+                       for addr in get_addrs(device_memc))
+
+    def stage(name, target, *args):
+        return mp.Process(target=run_worker,
+                          args=(collector.queue, collector.interval, name,
+                                target) + args)
+
+    readers = [stage("read", read_batches, fn_queue, batch_queue, result_queue,
+                     options.batch_size)
+               for _ in range(options.readers)]
+    parsers = [stage("parse", parse_batches, batch_queue, get_rings(device_memc),
+                     node_queues, result_queue, options)
+               for _ in range(options.parsers)]
+    writers = [stage("write", write_batches, addr, queue, result_queue, options)
+               for addr, queue in node_queues.items()
+               for _ in range(options.writers)]
+    processes = readers + parsers + writers
+    for process in processes:
+        process.daemon = True
+        process.start()
+    METRICS.gauge("batches", "queue", batch_queue.qsize)
+    for addr, queue in node_queues.items():
+        METRICS.gauge(addr, "queue", queue.qsize)
+
+    progress = dict((fn, FileProgress(fn, load_checkpoint(fn),
+                                      options.checkpoint))
+                    for fn in fns)
+    for fn in fns:
+        fn_queue.put((fn, progress[fn].checkpoint.offset))
+    for _ in readers:
+        fn_queue.put(None)
+
+    while progress:
+        try:
+            message = result_queue.get(timeout=SOCKET_TIMEOUT)
+        except Queue.Empty:
+            if any(process.exitcode for process in processes):
+                raise RuntimeError("Loader process failed")
+            continue
+        fn = message[1]
+        progress[fn].update(message[0], *message[2:])
+        if progress[fn].done:
+            checkpoint = progress.pop(fn).checkpoint
+            log_load_result(fn, checkpoint.processed, checkpoint.errors)
+            dot_rename(fn)
+            remove_checkpoint(fn)
+
+    for _ in parsers:
+        batch_queue.put(None)
+    for queue in node_queues.values():
+        for _ in range(options.writers):
+            queue.put(None)
+    for process in processes:
+        process.join()
+    METRICS.gauges.clear()
+
+
+def process_file(opt):
+    fn, device_memc, options = opt
+    logging.info('Pr.Name: %s. Processing %s' % (mp.current_process().name, fn))
+    # the pipelined loader reads and writes in one thread
+    stage = "load" if options.pipeline else "parse"
+    started = get_thread_cpu()
+    rings = get_rings(device_memc)
+    fingerprints = get_fingerprints(options)
+    loader = make_loader(device_memc, options, fingerprints)
+    # a load is resumed from the checkpoint even if checkpoints are not
+    # saved, like in main_staged
+    checkpoint = load_checkpoint(fn)
+    if checkpoint.offset:
+        logging.info("Resume %s from %s" % (fn, checkpoint))
+    columnar = ColumnarFile(fn) if is_columnar(fn) else None
+    if columnar and not checkpoint.offset:
+        # rows which were not converted are counted on the first load
+        checkpoint = Checkpoint(0, columnar.errors, columnar.errors)
+
+    if not options.checkpoint:
+        rows, close = open_rows(fn, checkpoint.offset)
+        processed, errors = load_records(
+            iter_records(rows, device_memc, scope=fn), rings, loader,
+            fingerprints)
+        close()
+        checkpoint = checkpoint._replace(
+            processed=checkpoint.processed + processed,
+            errors=checkpoint.errors + errors)
+    else:
+        # the checkpoint of a batch is saved when all its records are
+        # written, writers and connections of the loader are kept
+        for batch, end in iter_batches(fn, checkpoint.offset,
+                                       options.checkpoint):
+            rows = (columnar.iter_rows(*batch) if columnar
+                    else iter_parsed(batch))
+            processed, errors = load_records(
+                iter_records(rows, device_memc, scope=fn), rings, loader,
+                fingerprints)
+            errors += loader.flush()
+            checkpoint = Checkpoint(end, checkpoint.processed + processed,
+                                    checkpoint.errors + errors)
+            save_checkpoint(fn, checkpoint)
+    checkpoint = checkpoint._replace(
+        errors=checkpoint.errors + loader.close())
+    if columnar:
+        columnar.close()
+    log_load_result(fn, checkpoint.processed, checkpoint.errors)
+    count_cpu(stage, started)
+    METRICS.send()
     return fn
 
 
 def main(options):
     device_memc = {
-        "idfa": options.idfa,
-        "gaid": options.gaid,
-        "adid": options.adid,
-        "dvid": options.dvid,
+        "idfa": options.idfa.split(","),
+        "gaid": options.gaid.split(","),
+        "adid": options.adid.split(","),
+        "dvid": options.dvid.split(","),
     }
-    pool = mp.Pool(WORKERS_NUM)
-    func_args = []
-    for fn in glob.iglob(options.pattern):
-        func_args.append((fn, device_memc, options.dry))
-    func_args.sort(key=lambda x: x[0])
-    for fn in pool.imap(process_file, func_args):
-        dot_rename(fn)
+    fns = sorted(glob.iglob(options.pattern))
+    if options.convert:
+        for fn in fns:
+            rows, errors = convert_file(fn, get_columnar_path(fn),
+                                        device_memc)
+            logging.info("Converted %s: %s rows, %s errors" %
+                         (fn, rows, errors))
+        return
+    global METRICS
+    METRICS = Metrics()
+    if options.diff and not os.path.exists(options.diff):
+        FingerprintStore.create(options.diff, options.diff_capacity)
+    collector = MetricsCollector(options.metrics_interval, options.stats_file,
+                                 options.stats_port)
+    collector.start()
+    try:
+        if options.parsers:
+            main_staged(fns, device_memc, options, collector)
+            return
+        pool = mp.Pool(options.workers, init_worker,
+                       (collector.queue, collector.interval))
+        func_args = [(fn, device_memc, options) for fn in fns]
+        for fn in pool.imap(process_file, func_args):
+            dot_rename(fn)
+            remove_checkpoint(fn)
+        pool.close()
+        pool.join()
+    finally:
+        collector.stop()
 
 
 def prototest():
     sample = "idfa\t1rfw452y52g2gq4g\t55.55\t42.42\t1423,43,567,3,7,23\ngaid\t7rfw452y52g2gq4g\t55.55\t42.42\t7423,424"
+    rows = []
     for line in sample.splitlines():
         dev_type, dev_id, lat, lon, raw_apps = line.strip().split("\t")
         apps = [int(a) for a in raw_apps.split(",") if a.isdigit()]
@@ -203,9 +1696,15 @@ def prototest():
         unpacked = appsinstalled_pb2.UserApps()
         unpacked.ParseFromString(packed)
         assert ua == unpacked
+        rows.append(AppsInstalled(dev_type, dev_id, lat, lon, apps))
+    rows.append(AppsInstalled("adid", "1", -0.0, 1e-300,
+                              [0, 127, 128, APP_TABLE_SIZE, MAX_APP]))
+    rows.append(AppsInstalled("dvid", "2", 0.0, 0.0, []))
+    for row, record in zip(rows, serialize_batch(rows)):
+        assert record == serialize_appsinstalled(row)
 
 
-if __name__ == '__main__':
+def get_option_parser():
     op = OptionParser()
     op.add_option("-t", "--test", action="store_true", default=False)
     op.add_option("-l", "--log", action="store", default=None)
@@ -215,6 +1714,37 @@ if __name__ == '__main__':
     op.add_option("--gaid", action="store", default="127.0.0.1:33014")
     op.add_option("--adid", action="store", default="127.0.0.1:33015")
     op.add_option("--dvid", action="store", default="127.0.0.1:33016")
+    op.add_option("--batch-size", action="store", type="int",
+                  dest="batch_size", default=BATCH_SIZE)
+    op.add_option("--batch-timeout", action="store", type="float",
+                  dest="batch_timeout", default=BATCH_TIMEOUT)
+    op.add_option("--pipeline", action="store_true", default=False)
+    op.add_option("--convert", action="store_true", default=False)
+    op.add_option("--checkpoint", action="store", type="int",
+                  default=CHECKPOINT_EVERY)
+    op.add_option("--diff", action="store", default=None)
+    op.add_option("--diff-capacity", action="store", type="int",
+                  dest="diff_capacity", default=FINGERPRINT_CAPACITY)
+    op.add_option("--metrics-interval", action="store", type="float",
+                  dest="metrics_interval", default=METRICS_INTERVAL)
+    op.add_option("--stats-file", action="store", dest="stats_file",
+                  default=None)
+    op.add_option("--stats-port", action="store", type="int",
+                  dest="stats_port", default=None)
+    op.add_option("-w", "--workers", action="store", type="int",
+                  default=WORKERS_NUM)
+    op.add_option("--readers", action="store", type="int", default=1)
+    op.add_option("--parsers", action="store", type="int", default=0)
+    op.add_option("--writers", action="store", type="int", default=1)
+    op.add_option("--pipeline-connections", action="store", type="int",
+                  dest="pipeline_connections", default=PIPELINE_CONNECTIONS)
+    op.add_option("--pipeline-depth", action="store", type="int",
+                  dest="pipeline_depth", default=PIPELINE_DEPTH)
+    return op
+
+
+if __name__ == '__main__':
+    op = get_option_parser()
     (opts, args) = op.parse_args()
     logging.basicConfig(filename=opts.log, level=logging.INFO if not opts.dry else logging.DEBUG,
                         format='[%(asctime)s] %(levelname).1s %(message)s', datefmt='%Y.%m.%d %H:%M:%S')
@@ -1,21 +1,31 @@
 import unittest
 import memc_load
 import os
-from optparse import OptionParser
+import glob
+import gzip
+import shutil
+import tempfile
+import json
+import collections
+import Queue
+import time
+import socket
+import memcache
+from fake_memcached import FakeMemcached
+from appsinstalled_generator import generate_lines, write_log
+
+
+def get_options():
+    """Get default options of memc_load.py for a dry run of test_logs"""
+    (opts, args) = memc_load.get_option_parser().parse_args(
+        ["--dry", "--pattern", "test_logs/*.tsv.gz",
+         "--diff-capacity", str(2 ** 10)])
+    return opts
 
 
 class TestMemcLoad(unittest.TestCase):
     def setUp(self):
-        op = OptionParser()
-        op.add_option("-t", "--test", action="store_true", default=False)
-        op.add_option("-l", "--log", action="store", default=None)
-        op.add_option("--dry", action="store_true", default=True)
-        op.add_option("--pattern", action="store", default="test_logs/*.tsv.gz")
-        op.add_option("--idfa", action="store", default="127.0.0.1:33013")
-        op.add_option("--gaid", action="store", default="127.0.0.1:33014")
-        op.add_option("--adid", action="store", default="127.0.0.1:33015")
-        op.add_option("--dvid", action="store", default="127.0.0.1:33016")
-        (self.opts, args) = op.parse_args()
+        self.opts = get_options()
 
     def test_file_rename(self):
         memc_load.main(self.opts)
@@ -24,5 +34,531 @@ class TestMemcLoad(unittest.TestCase):
         self.assertEqual(True, os.path.isfile('test_logs/.sample2.tsv.gz'))
 
 
+class TestSerialize(unittest.TestCase):
+    def test_prototest(self):
+        memc_load.prototest()
+
+    def test_invalid_rows(self):
+        rows = [memc_load.AppsInstalled("idfa", "1", 1.0, 2.0, [-1]),
+                memc_load.AppsInstalled("idfa", "2", 1.0, 2.0, [2 ** 32]),
+                memc_load.AppsInstalled("idfa", "3", "x", 2.0, [1])]
+        self.assertEqual([("idfa:1", None), ("idfa:2", None),
+                          ("idfa:3", None)],
+                         memc_load.serialize_batch(rows))
+
+
+class TestColumnar(unittest.TestCase):
+    def setUp(self):
+        self.work_dir = tempfile.mkdtemp()
+        self.fn = os.path.join(self.work_dir, "sample.tsv.gz")
+        self.lines = ["idfa\t1rfw\t55.55\t42.42\t1423,43,567",
+                      "gaid\t7rfw\t-1.5\t0\t5,x",
+                      "bad line",
+                      "adid\tx\tlat\t42.42\t1",
+                      "idfa\t2rfw\t55.55\t42.42\t4294967295",
+                      "xxxx\t3rfw\t55.55\t42.42\t1"]
+        with gzip.open(self.fn, "w") as f:
+            f.write("\n".join(self.lines))
+
+    def tearDown(self):
+        shutil.rmtree(self.work_dir)
+
+    def test_convert(self):
+        path = memc_load.get_columnar_path(self.fn)
+        self.assertEqual(os.path.join(self.work_dir, "sample.col"), path)
+        self.assertEqual((3, 3), memc_load.convert_file(
+            self.fn, path, ["idfa", "gaid", "adid", "dvid"]))
+        columnar = memc_load.ColumnarFile(path)
+        self.assertEqual(3, columnar.rows)
+        self.assertEqual(3, columnar.errors)
+        expected = [memc_load.parse_appsinstalled(self.lines[n])
+                    for n in (0, 1, 4)]
+        rows = list(columnar.iter_rows())
+        self.assertEqual(expected, [row._replace(apps=list(row.apps))
+                                    for row in rows])
+        self.assertEqual(expected[1:], [row._replace(apps=list(row.apps))
+                                        for row in columnar.iter_rows(1, 3)])
+        self.assertEqual(memc_load.serialize_batch(expected),
+                         memc_load.serialize_batch(rows))
+        columnar.close()
+
+    def test_chunks(self):
+        chunk = memc_load.COLUMNAR_CHUNK
+        memc_load.COLUMNAR_CHUNK = 2
+        try:
+            path = memc_load.get_columnar_path(self.fn)
+            memc_load.convert_file(self.fn, path, ["idfa", "gaid"])
+            columnar = memc_load.ColumnarFile(path)
+            self.assertEqual(["1rfw", "7rfw", "2rfw"],
+                             [row.dev_id for row in columnar.iter_rows()])
+            self.assertEqual(["7rfw", "2rfw"],
+                             [row.dev_id for row in columnar.iter_rows(1, 3)])
+            columnar.close()
+        finally:
+            memc_load.COLUMNAR_CHUNK = chunk
+
+    def test_columnar_path(self):
+        self.assertEqual("/logs/app.2017.05.col",
+                         memc_load.get_columnar_path("/logs/app.2017.05.tsv.gz"))
+
+
+class TestLoadToMemcached(unittest.TestCase):
+    def setUp(self):
+        self.opts = get_options()
+        self.servers = dict((dev_type, FakeMemcached().start())
+                            for dev_type in ("idfa", "gaid", "adid", "dvid"))
+        for dev_type, server in self.servers.items():
+            setattr(self.opts, dev_type, server.addr)
+        self.opts.dry = False
+        self.device_memc = dict((dev_type, [server.addr])
+                                for dev_type, server in self.servers.items())
+        with open("sample.tsv") as f:
+            self.lines = f.read().splitlines()
+        self.work_dir = tempfile.mkdtemp()
+        with gzip.open(os.path.join(self.work_dir, "sample.tsv.gz"), "w") as f:
+            f.write("\n".join(self.lines))
+        self.opts.pattern = os.path.join(self.work_dir, "*.tsv.gz")
+
+    def tearDown(self):
+        for server in self.servers.values():
+            server.stop()
+        shutil.rmtree(self.work_dir)
+
+    def check_loaded(self):
+        self.assertEqual([], glob.glob(self.opts.pattern))
+        for line in self.lines:
+            appsinstalled = memc_load.parse_appsinstalled(line)
+            key, packed = memc_load.serialize_appsinstalled(appsinstalled)
+            server = self.servers[appsinstalled.dev_type]
+            self.assertEqual(packed, server.get(key))
+
+    def test_threaded(self):
+        memc_load.main(self.opts)
+        self.check_loaded()
+
+    def test_pipelined(self):
+        self.opts.pipeline = True
+        self.opts.pipeline_connections = 2
+        self.opts.pipeline_depth = 4
+        memc_load.main(self.opts)
+        self.check_loaded()
+
+    def test_staged(self):
+        self.opts.parsers = 2
+        self.opts.writers = 2
+        self.opts.batch_size = 3
+        memc_load.main(self.opts)
+        self.check_loaded()
+
+    def test_staged_pipelined(self):
+        self.opts.pipeline = True
+        self.opts.parsers = 2
+        self.opts.batch_size = 3
+        memc_load.main(self.opts)
+        self.check_loaded()
+
+    def convert(self):
+        self.opts.convert = True
+        memc_load.main(self.opts)
+        self.opts.convert = False
+        self.opts.pattern = os.path.join(self.work_dir, "*.col")
+
+    def test_columnar(self):
+        self.convert()
+        memc_load.main(self.opts)
+        self.check_loaded()
+
+    def test_columnar_staged(self):
+        self.convert()
+        self.opts.parsers = 2
+        self.opts.batch_size = 3
+        memc_load.main(self.opts)
+        self.check_loaded()
+
+    def resume(self):
+        fn = os.path.join(self.work_dir, "sample.tsv.gz")
+        batch, offset = next(memc_load.iter_batches(fn, 0, 4))
+        memc_load.save_checkpoint(fn, memc_load.Checkpoint(offset, 4, 0))
+        memc_load.main(self.opts)
+        self.assertFalse(os.path.exists(memc_load.get_checkpoint_path(fn)))
+        for line in self.lines[:4]:
+            dev_type, dev_id = line.split("\t")[:2]
+            key = "%s:%s" % (dev_type, dev_id)
+            self.assertEqual(None, self.servers[dev_type].get(key))
+        self.lines = self.lines[4:]
+        self.check_loaded()
+
+    def test_resume(self):
+        self.opts.checkpoint = 3
+        self.resume()
+
+    def test_resume_streamed(self):
+        self.opts.checkpoint = 0
+        self.resume()
+
+    def test_resume_staged(self):
+        self.opts.parsers = 2
+        self.opts.batch_size = 3
+        self.resume()
+
+    def check_stats(self):
+        with open(self.opts.stats_file) as f:
+            report = json.load(f)
+        fn = os.path.join(self.work_dir, "sample.tsv.gz")
+        self.assertEqual(len(self.lines), report["scopes"][fn]["lines"])
+        self.assertEqual(len(self.lines), report["totals"]["sets"])
+        self.assertEqual(0, report["totals"]["failures"])
+        idfa = report["scopes"][self.servers["idfa"].addr]
+        self.assertEqual(5, idfa["sets"])
+        self.assertTrue(idfa["bytes"] > 0)
+
+    def test_stats(self):
+        self.opts.stats_file = os.path.join(self.work_dir, "stats.json")
+        memc_load.main(self.opts)
+        self.check_stats()
+
+    def test_stats_staged(self):
+        self.opts.stats_file = os.path.join(self.work_dir, "stats.json")
+        self.opts.parsers = 2
+        self.opts.batch_size = 3
+        memc_load.main(self.opts)
+        self.check_stats()
+
+    def check_sharded(self):
+        shards = [self.servers["idfa"], FakeMemcached().start()]
+        self.opts.idfa = ",".join(shard.addr for shard in shards)
+        ring = memc_load.HashRing([shard.addr for shard in shards])
+        try:
+            memc_load.main(self.opts)
+            for line in self.lines:
+                if not line.startswith("idfa"):
+                    continue
+                appsinstalled = memc_load.parse_appsinstalled(line)
+                key, packed = memc_load.serialize_appsinstalled(appsinstalled)
+                for shard in shards:
+                    stored = shard.get(key)
+                    if shard.addr == ring.get_node(key):
+                        self.assertEqual(packed, stored)
+                    else:
+                        self.assertEqual(None, stored)
+        finally:
+            shards[1].stop()
+
+    def test_sharded(self):
+        self.check_sharded()
+
+    def test_sharded_staged_pipelined(self):
+        self.opts.pipeline = True
+        self.opts.parsers = 2
+        self.opts.batch_size = 3
+        self.check_sharded()
+
+    def check_diff(self):
+        self.opts.diff = os.path.join(self.work_dir, "fingerprints")
+        memc_load.main(self.opts)
+        self.check_loaded()
+        for server in self.servers.values():
+            server.data.clear()
+
+        self.lines[0] = self.lines[0].replace("55.55", "66.66")
+        self.lines.append("dvid\tnew\t1.0\t2.0\t3")
+        with gzip.open(os.path.join(self.work_dir, "next.tsv.gz"), "w") as f:
+            f.write("\n".join(self.lines))
+        memc_load.main(self.opts)
+        self.assertEqual(0, sum(len(self.servers[dev_type].data)
+                                for dev_type in ("gaid", "adid")))
+        self.assertEqual(1, len(self.servers["idfa"].data))
+        self.assertEqual(1, len(self.servers["dvid"].data))
+        self.lines = [self.lines[0], self.lines[-1]]
+        self.check_loaded()
+
+    def test_diff(self):
+        self.check_diff()
+
+    def test_diff_staged_pipelined(self):
+        self.opts.pipeline = True
+        self.opts.parsers = 2
+        self.opts.batch_size = 3
+        self.check_diff()
+
+    def check_diff_sharded(self):
+        self.opts.diff = os.path.join(self.work_dir, "fingerprints")
+        memc_load.main(self.opts)
+        self.check_loaded()
+
+        shards = [self.servers["idfa"], FakeMemcached().start()]
+        self.opts.idfa = ",".join(shard.addr for shard in shards)
+        ring = memc_load.HashRing([shard.addr for shard in shards])
+        with gzip.open(os.path.join(self.work_dir, "next.tsv.gz"), "w") as f:
+            f.write("\n".join(self.lines))
+        try:
+            memc_load.main(self.opts)
+            moved = 0
+            for line in self.lines:
+                if not line.startswith("idfa"):
+                    continue
+                appsinstalled = memc_load.parse_appsinstalled(line)
+                key, packed = memc_load.serialize_appsinstalled(appsinstalled)
+                if ring.get_node(key) == shards[1].addr:
+                    moved += 1
+                    self.assertEqual(packed, shards[1].get(key))
+            self.assertGreater(moved, 0)
+        finally:
+            shards[1].stop()
+
+    def test_diff_sharded(self):
+        self.check_diff_sharded()
+
+    def test_diff_sharded_staged_pipelined(self):
+        self.opts.pipeline = True
+        self.opts.parsers = 2
+        self.opts.batch_size = 3
+        self.check_diff_sharded()
+
+    def test_pipelined_errors(self):
+        down = self.servers["gaid"]
+        down.stop()
+        self.servers["gaid"] = FakeMemcached().start()
+        records = memc_load.iter_records(memc_load.iter_parsed(self.lines),
+                                         self.device_memc)
+        processed, errors = memc_load.load_pipelined(records, self.device_memc,
+                                                     self.opts)
+        self.assertEqual(len(self.lines), processed)
+        gaid = sum(1 for line in self.lines if line.startswith("gaid"))
+        self.assertEqual(gaid, errors)
+
+    def test_failing_servers(self):
+        for server in self.servers.values():
+            server.fail_rate = 0.2
+            server.random.seed(1)
+        self.opts.stats_file = os.path.join(self.work_dir, "stats.json")
+        memc_load.main(self.opts)
+        self.check_loaded()
+        with open(self.opts.stats_file) as f:
+            totals = json.load(f)["totals"]
+        self.assertGreater(totals["retries"], 0)
+        self.assertEqual(0, totals["failures"])
+
+
+class TestGenerator(unittest.TestCase):
+    def test_lines(self):
+        lines = list(generate_lines(1000, seed=1))
+        self.assertEqual(lines, list(generate_lines(1000, seed=1)))
+        for line in lines:
+            appsinstalled = memc_load.parse_appsinstalled(line.strip())
+            self.assertIsNotNone(appsinstalled)
+            self.assertTrue(1 <= len(appsinstalled.apps) <= 500)
+            memc_load.serialize_appsinstalled(appsinstalled)
+
+    def test_malformed(self):
+        lines = [line.strip() for line in generate_lines(1000, 0.5, seed=1)]
+        device_memc = dict.fromkeys(("idfa", "gaid", "adid", "dvid"))
+        records = memc_load.iter_records(memc_load.iter_parsed(lines),
+                                         device_memc)
+        valid = sum(1 for record in records if record)
+        self.assertTrue(300 < valid < 700)
+
+    def test_write_log(self):
+        work_dir = tempfile.mkdtemp()
+        try:
+            path = os.path.join(work_dir, "log.tsv.gz")
+            write_log(path, 10, seed=1)
+            with gzip.open(path) as f:
+                self.assertEqual(list(generate_lines(10, seed=1)), list(f))
+        finally:
+            shutil.rmtree(work_dir)
+
+
+class TestHashRing(unittest.TestCase):
+    def test_spread_and_move(self):
+        nodes = ["10.0.0.%d:11211" % n for n in range(4)]
+        keys = ["idfa:%d" % n for n in range(10000)]
+        ring = memc_load.HashRing(nodes)
+        placement = dict((key, ring.get_node(key)) for key in keys)
+        counts = collections.Counter(placement.values())
+        self.assertEqual(set(nodes), set(counts))
+        self.assertTrue(min(counts.values()) > len(keys) / 4 * 0.8)
+
+        grown = memc_load.HashRing(nodes + ["10.0.0.4:11211"])
+        moved = [key for key in keys if grown.get_node(key) != placement[key]]
+        self.assertTrue(len(moved) < len(keys) / 5 * 1.2)
+        self.assertEqual(set(["10.0.0.4:11211"]),
+                         set(grown.get_node(key) for key in moved))
+
+
+class TestFingerprintStore(unittest.TestCase):
+    def setUp(self):
+        self.work_dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.work_dir, "fingerprints")
+
+    def tearDown(self):
+        shutil.rmtree(self.work_dir)
+
+    def test_update(self):
+        store = memc_load.FingerprintStore(self.path, 100)
+        self.assertEqual(128, store.capacity)
+        self.assertTrue(store.changed("a:1", "idfa:1", "a"))
+        store.update("a:1", [("idfa:1", "a"), ("idfa:2", "b")])
+        self.assertFalse(store.changed("a:1", "idfa:1", "a"))
+        self.assertTrue(store.changed("a:1", "idfa:1", "b"))
+        self.assertTrue(store.changed("b:1", "idfa:1", "a"))
+        store.update("a:1", [("idfa:1", "b")])
+        store.close()
+
+        store = memc_load.FingerprintStore(self.path)
+        self.assertEqual(128, store.capacity)
+        self.assertFalse(store.changed("a:1", "idfa:1", "b"))
+        self.assertFalse(store.changed("a:1", "idfa:2", "b"))
+        store.close()
+
+    def test_full(self):
+        store = memc_load.FingerprintStore(self.path, 4)
+        records = [("idfa:%d" % n, "v") for n in range(10)]
+        store.update("a:1", records)
+        stored = [key for key, packed in records
+                  if not store.changed("a:1", key, packed)]
+        self.assertEqual(int(4 * memc_load.FINGERPRINT_MAX_LOAD),
+                         len(stored))
+        store.close()
+
+
+class TestFileProgress(unittest.TestCase):
+    def test_confirm_in_order(self):
+        fn = os.path.join(tempfile.mkdtemp(), "sample.tsv.gz")
+        open(fn, "w").close()
+        progress = memc_load.FileProgress(fn, memc_load.Checkpoint(0, 0, 0),
+                                          checkpoint_every=1)
+        progress.update("parsed", 1, 20, 10, 1, 1)
+        progress.update("written", 1, 0)
+        self.assertEqual(memc_load.Checkpoint(0, 0, 0), progress.checkpoint)
+        progress.update("written", 0, 2)
+        progress.update("parsed", 0, 10, 10, 0, 1)
+        progress.update("read", 2, 0)
+        self.assertEqual(memc_load.Checkpoint(20, 20, 3), progress.checkpoint)
+        self.assertTrue(progress.done)
+        self.assertEqual(memc_load.Checkpoint(20, 20, 3),
+                         memc_load.load_checkpoint(fn))
+        shutil.rmtree(os.path.dirname(fn))
+
+
+class FakeMemcache(object):
+    """Stores records, fails every key in fail_keys fail_times times"""
+    def __init__(self, fail_keys=(), fail_times=1):
+        self.servers = ["fake"]
+        self.data = {}
+        self.calls = []
+        self.fails = dict.fromkeys(fail_keys, fail_times)
+
+    def set_multi(self, records):
+        self.calls.append(sorted(records))
+        failed = []
+        for key, value in records.items():
+            if self.fails.get(key):
+                self.fails[key] -= 1
+                failed.append(key)
+            else:
+                self.data[key] = value
+        return failed
+
+
+class TestMemcacheClient(unittest.TestCase):
+    def run_client(self, memc, records, batch_size):
+        line_queue = Queue.Queue()
+        result_queue = Queue.Queue()
+        client = memc_load.MemcacheClient("fake", line_queue, result_queue,
+                                          False, batch_size, 10)
+        client.make_client = lambda: memc
+        for record in records:
+            line_queue.put(record)
+        line_queue.put(memc_load.SENTINEL)
+        client.start()
+        client.join(5)
+        return result_queue.get_nowait()
+
+    def test_batches(self):
+        memc = FakeMemcache()
+        records = [("k%d" % n, "v%d" % n) for n in range(5)]
+        self.assertEqual((5, 0), self.run_client(memc, records, 2))
+        self.assertEqual([["k0", "k1"], ["k2", "k3"], ["k4"]], memc.calls)
+        self.assertEqual(dict(records), memc.data)
+
+    def test_retry_failed_keys_only(self):
+        memc = FakeMemcache(fail_keys=["k1"])
+        records = [("k%d" % n, "v%d" % n) for n in range(3)]
+        self.assertEqual((3, 0), self.run_client(memc, records, 3))
+        self.assertEqual([["k0", "k1", "k2"], ["k1"]], memc.calls)
+        self.assertEqual(dict(records), memc.data)
+
+    def test_give_up_after_attempts(self):
+        memc = FakeMemcache(fail_keys=["k0"], fail_times=memc_load.MAX_ATTEMPTS)
+        self.assertEqual((1, 1), self.run_client(memc, [("k0", "v0")], 1))
+        self.assertEqual(memc_load.MAX_ATTEMPTS, len(memc.calls))
+        self.assertEqual({}, memc.data)
+
+    def test_drop_retry_of_newer_key(self):
+        memc = FakeMemcache(fail_keys=["k0"])
+        records = [("k0", "v0"), ("k0", "v1")]
+        self.assertEqual((2, 0), self.run_client(memc, records, 1))
+        self.assertEqual([["k0"], ["k0"]], memc.calls)
+        self.assertEqual({"k0": "v1"}, memc.data)
+
+    def test_flush(self):
+        memc = FakeMemcache(fail_keys=["k1"], fail_times=memc_load.MAX_ATTEMPTS)
+        line_queue = Queue.Queue()
+        result_queue = Queue.Queue()
+        client = memc_load.MemcacheClient("fake", line_queue, result_queue,
+                                          False, 10, 10)
+        client.make_client = lambda: memc
+        client.start()
+        line_queue.put(("k0", "v0"))
+        line_queue.put(("k1", "v1"))
+        line_queue.put(memc_load.FLUSH)
+        self.assertEqual((2, 1), result_queue.get(timeout=5))
+        self.assertEqual({"k0": "v0"}, memc.data)
+        self.assertTrue(client.is_alive())
+        line_queue.put(("k2", "v2"))
+        line_queue.put(memc_load.SENTINEL)
+        client.join(5)
+        self.assertEqual((1, 0), result_queue.get_nowait())
+        self.assertEqual(["k0", "k2"], sorted(memc.data))
+
+    def test_dead_server_fails_batch(self):
+        memc = FakeMemcache()
+        server = memcache._Host("127.0.0.1:1")
+        server.deaduntil = time.time() + 30
+        memc.servers = [server]
+        records = {"k0": "v0", "k1": "v1"}
+        self.assertEqual(["k0", "k1"],
+                         sorted(memc_load.insert_appsinstalled(memc, records)))
+
+
+class TestPipelineLoader(unittest.TestCase):
+    def setUp(self):
+        self.server = FakeMemcached().start()
+        self.loader = memc_load.PipelineLoader([self.server.addr],
+                                               connections=1)
+
+    def tearDown(self):
+        self.server.stop()
+
+    def test_resend_on_dropped_connection(self):
+        self.loader.set(self.server.addr, "k0", "v0")
+        self.loader.set(self.server.addr, "k1", "v1")
+        conn = self.loader.pools[self.server.addr][0]
+        self.loader.drop(conn, "test")
+        self.loader.set(self.server.addr, "k1", "v2")
+        self.assertEqual(0, self.loader.close())
+        self.assertEqual("v0", self.server.get("k0"))
+        self.assertEqual("v2", self.server.get("k1"))
+
+    def test_unexpected_reply(self):
+        conn = self.loader.pools[self.server.addr][0]
+        conn.sock, other = socket.socketpair()
+        other.sendall("STORED\r\n")
+        self.assertRaises(socket.error, conn.read)
+        other.close()
+        conn.close()
+
+
 if __name__ == "__main__":
     unittest.main()
@@ -1,13 +1,20 @@
 import sys
 import os
+import re
 import argparse
 import socket
 import logging
 import time
+import stat
+import errno
+import collections
+import datetime
 import email.utils
 import urllib.parse
 import posixpath
 import threading
+import uuid
+import selectors
 
 __version__ = "0.1"
 
@@ -28,12 +35,24 @@ DEFAULT_ERROR_MESSAGE = """\
 
 DEFAULT_ERROR_CONTENT_TYPE = "text/html;charset=utf-8"
 
+# Size of a chunk read from a client socket
+RECV_SIZE = 64 * 1024
+# Max size of a request head, connections sending larger ones are closed
+MAX_REQUEST_SIZE = 64 * 1024
+# Max bytes of a file sent to a connection at once by the event loop
+SENDFILE_CHUNK = 1024 * 1024
+# Max number of ranges of a request, Range header with more is ignored
+MAX_RANGES = 32
+
 
 class HTTPServer:
 
     address_family = socket.AF_INET
     socket_type = socket.SOCK_STREAM
     request_queue_size = 100
+    # Default keep_alive_timeout of handlers: an idle connection holds a
+    # worker, so it is short
+    keep_alive_timeout = 2
 
     def __init__(self, server_address, RequestHandlerClass,
                  max_workers,
@@ -76,7 +95,9 @@ class HTTPServer:
             self.process_request(conn)
 
     def process_request(self, conn):
-        request_handler = MainHTTPHandler(conn, self.document_root)
+        # a body is sent after the head, don't delay it by Nagle's algorithm
+        conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        request_handler = self.RequestHandlerClass(conn, self.document_root)
         request_handler.handle()
 
     def __enter__(self):
@@ -91,13 +112,432 @@ class HTTPServer:
         self.socket = None
 
 
+class FileRange:
+    """Part of a file queued for sending by a Connection
+
+    The file descriptor is a duplicate, so the file object given to
+    Connection.sendfile can be closed before the range is sent.
+    """
+
+    def __init__(self, file, offset=0, count=None):
+        self.fd = os.dup(file.fileno())
+        if count is None:
+            count = os.fstat(self.fd).st_size - offset
+        self.offset = offset
+        self.count = count
+        self.use_sendfile = hasattr(os, "sendfile")
+
+    def send(self, sock):
+        """Send a chunk of the range, return the number of bytes sent.
+
+        Zero bytes are sent if the file is shorter than the range.
+        """
+        size = min(self.count, SENDFILE_CHUNK)
+        if self.use_sendfile:
+            try:
+                sent = os.sendfile(sock.fileno(), self.fd, self.offset, size)
+            except OSError as e:
+                if e.errno not in (errno.EINVAL, errno.ENOSYS,
+                                   errno.EOPNOTSUPP):
+                    raise
+                # the file system doesn't support sendfile
+                self.use_sendfile = False
+        if not self.use_sendfile:
+            data = os.pread(self.fd, min(size, RECV_SIZE), self.offset)
+            sent = sock.send(data) if data else 0
+        self.offset += sent
+        self.count -= sent
+        return sent
+
+    def close(self):
+        os.close(self.fd)
+
+
+class FileReader:
+    """File which is not regular (a pipe, a device) queued for sending by
+    a Connection up to its end
+
+    The file is read without blocking, a chunk when the socket is writable,
+    so the file is not buffered in memory. When no data is ready the
+    connection waits for the file to become readable instead of the socket
+    to become writable.
+    """
+
+    def __init__(self, conn, file):
+        self.conn = conn
+        self.fd = os.dup(file.fileno())
+        os.set_blocking(self.fd, False)
+        self.data = b""
+
+    def send(self, sock):
+        """Send a chunk of the file, return False at the end of the file
+        and None if no data is ready"""
+        if not self.data:
+            try:
+                self.data = os.read(self.fd, RECV_SIZE)
+            except BlockingIOError:
+                return None
+            if not self.data:
+                return False
+        sent = sock.send(self.data)
+        self.data = self.data[sent:]
+        return True
+
+    def on_readable(self):
+        if self.conn.waiting is self:
+            self.conn.resume()
+
+    def close(self):
+        os.close(self.fd)
+
+
+class Connection:
+    """State of a client connection served by EventLoopHTTPServer
+
+    A connection is reading until the head of a request is received, then
+    the request is handled by the handler of the connection and the
+    connection is writing the response. Pipelined requests stay in the
+    input buffer until the response to the previous one is sent. The
+    connection acts as a socket for the handler: sendall and sendfile
+    queue data and file ranges for sending, sendstream queues a file which
+    is not regular, close closes the socket when the queue is sent.
+    """
+
+    READING, WRITING, CLOSED = "reading", "writing", "closed"
+
+    def __init__(self, server, sock, client_address):
+        self.server = server
+        self.sock = sock
+        self.client_address = client_address
+        self.handler = server.RequestHandlerClass(self, server.document_root)
+        self.state = self.READING
+        self.in_buffer = b""
+        self.output = collections.deque()
+        self.closing = False
+        self.last_active = time.time()
+        # FileReader waited for to become readable
+        self.waiting = None
+
+    def on_readable(self):
+        try:
+            data = self.sock.recv(RECV_SIZE)
+        except BlockingIOError:
+            return
+        except OSError as e:
+            logging.info("recv from {0} failed: {1}".format(
+                self.client_address, e))
+            self.close_socket()
+            return
+        if not data:
+            self.close_socket()
+            return
+        self.last_active = time.time()
+        self.in_buffer += data
+        self.process_requests()
+
+    def on_writable(self):
+        self.finish_response()
+        if self.state == self.READING:
+            self.server.modify(self, selectors.EVENT_READ)
+            self.process_requests()
+
+    def process_requests(self):
+        """Handle buffered requests while their responses are sent at once"""
+        while self.state == self.READING:
+            end = self.in_buffer.find(b'\r\n\r\n')
+            if end == -1:
+                if len(self.in_buffer) > MAX_REQUEST_SIZE:
+                    logging.error("request of {0} is too large".format(
+                        self.client_address))
+                    self.close_socket()
+                return
+            head = self.in_buffer[:end + 4]
+            self.in_buffer = self.in_buffer[end + 4:]
+            self.state = self.WRITING
+            try:
+                self.handler.handle_request(head)
+            except Exception as e:
+                logging.exception(str(e))
+                self.close_socket()
+                return
+            self.finish_response()
+        if self.state == self.WRITING and self.waiting is None:
+            self.server.modify(self, selectors.EVENT_WRITE)
+
+    def wait(self, reader):
+        """Stop writing until data of reader is ready"""
+        self.waiting = reader
+        self.server.register_file(reader)
+        self.server.modify(self, selectors.EVENT_READ)
+
+    def resume(self):
+        """Continue writing when data of the waited reader is ready"""
+        self.server.unregister_file(self.waiting)
+        self.waiting = None
+        self.server.modify(self, selectors.EVENT_WRITE)
+
+    def finish_response(self):
+        """Send the buffered response, start reading when it is sent"""
+        if not self.flush():
+            return
+        if self.closing:
+            self.close_socket()
+        else:
+            self.state = self.READING
+
+    def sendall(self, data):
+        if self.output and isinstance(self.output[-1], bytearray):
+            self.output[-1] += data
+        else:
+            self.output.append(bytearray(data))
+        self.flush()
+
+    def sendfile(self, file, offset=0, count=None):
+        self.output.append(FileRange(file, offset, count))
+        self.flush()
+
+    def sendstream(self, file):
+        self.output.append(FileReader(self, file))
+        self.flush()
+
+    def close(self):
+        self.closing = True
+
+    def flush(self):
+        """Send queued data as much as the socket accepts, a file range
+        by a chunk at a time so other connections are not starved.
+
+        Return True if all data is sent.
+        """
+        if self.state == self.CLOSED or self.waiting is not None:
+            return False
+        try:
+            while self.output:
+                item = self.output[0]
+                if isinstance(item, FileRange):
+                    if item.count and not item.send(self.sock):
+                        logging.error("file is shorter than the response")
+                        self.closing = True
+                        item.count = 0
+                    if item.count:
+                        return False
+                    self.output.popleft().close()
+                elif isinstance(item, FileReader):
+                    sent = item.send(self.sock)
+                    if sent is None:
+                        self.wait(item)
+                        return False
+                    if sent:
+                        # the next chunk is read on the next event
+                        self.last_active = time.time()
+                        return False
+                    self.output.popleft().close()
+                else:
+                    sent = self.sock.send(item)
+                    del item[:sent]
+                    if not item:
+                        self.output.popleft()
+                self.last_active = time.time()
+        except BlockingIOError:
+            return False
+        except OSError as e:
+            logging.info("send to {0} failed: {1}".format(
+                self.client_address, e))
+            self.close_socket()
+            return False
+        return True
+
+    def close_socket(self):
+        if self.state == self.CLOSED:
+            return
+        self.state = self.CLOSED
+        if self.waiting is not None:
+            self.server.unregister_file(self.waiting)
+            self.waiting = None
+        self.server.unregister(self)
+        self.sock.close()
+        for item in self.output:
+            if isinstance(item, (FileRange, FileReader)):
+                item.close()
+        self.output.clear()
+
+
+class EventLoopHTTPServer(HTTPServer):
+    """HTTP server serving all connections in one thread
+
+    Non-blocking sockets are polled by the best selector of the platform
+    (epoll on Linux), so the number of open connections is limited by the
+    number of file descriptors only, not by the number of workers.
+    Connections without activity for keep_alive_timeout of the handler
+    class are closed.
+    """
+
+    request_queue_size = 1024
+    keep_alive_timeout = 15
+    # Interval in seconds to look for idle connections
+    idle_check_interval = 1
+
+    def __init__(self, server_address, RequestHandlerClass,
+                 max_workers,
+                 document_root):
+        super().__init__(server_address, RequestHandlerClass, max_workers,
+                         document_root)
+        self.socket.setblocking(False)
+        self.selector = selectors.DefaultSelector()
+        self.connections = {}
+        self.last_idle_check = time.time()
+
+    def serve_forever(self):
+        logging.info("Server is running on {0} with {1}".format(
+            self.server_address, type(self.selector).__name__))
+        print("\nPress Ctrl+C to shut down server")
+        self.selector.register(self.socket, selectors.EVENT_READ)
+        while True:
+            events = self.selector.select(self.idle_check_interval)
+            for key, mask in events:
+                conn = key.data
+                if conn is None:
+                    self.accept_connections()
+                elif mask & selectors.EVENT_READ:
+                    conn.on_readable()
+                elif mask & selectors.EVENT_WRITE:
+                    conn.on_writable()
+            self.close_idle_connections()
+
+    def accept_connections(self):
+        while True:
+            try:
+                sock, client_address = self.socket.accept()
+            except (BlockingIOError, InterruptedError):
+                return
+            except OSError as e:
+                # e.g. out of file descriptors, try on the next event
+                logging.error("accept failed: {0}".format(e))
+                return
+            logging.info("Recived connection {0}".format(client_address))
+            sock.setblocking(False)
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            conn = Connection(self, sock, client_address)
+            self.connections[sock.fileno()] = conn
+            self.selector.register(sock, selectors.EVENT_READ, conn)
+
+    def close_idle_connections(self):
+        now = time.time()
+        if now - self.last_idle_check < self.idle_check_interval:
+            return
+        self.last_idle_check = now
+        deadline = now - self.RequestHandlerClass.keep_alive_timeout
+        for conn in list(self.connections.values()):
+            if conn.last_active < deadline:
+                logging.info("Close idle connection {0}".format(
+                    conn.client_address))
+                conn.close_socket()
+
+    def modify(self, conn, events):
+        self.selector.modify(conn.sock, events, conn)
+
+    def unregister(self, conn):
+        self.selector.unregister(conn.sock)
+        del self.connections[conn.sock.fileno()]
+
+    def register_file(self, reader):
+        self.selector.register(reader.fd, selectors.EVENT_READ, reader)
+
+    def unregister_file(self, reader):
+        self.selector.unregister(reader.fd)
+
+    def server_close(self):
+        for conn in list(self.connections.values()):
+            conn.close_socket()
+        self.selector.close()
+        super().server_close()
+
+
+class CacheEntry:
+    """File of a FileCache: content and header fields of a response"""
+
+    def __init__(self, path, mimetype, content, headers, fs):
+        self.path = path
+        self.mimetype = mimetype
+        self.content = content
+        self.headers = headers
+        self.stat = fs
+        self.size = len(content) + len(headers)
+        self.checked = time.time()
+
+    def is_valid(self):
+        """Check if the file is not changed since it is cached"""
+        try:
+            fs = os.stat(self.path)
+        except OSError:
+            return False
+        return (fs.st_mtime_ns == self.stat.st_mtime_ns and
+                fs.st_size == self.stat.st_size and
+                fs.st_ino == self.stat.st_ino)
+
+
+class FileCache:
+    """LRU cache of small files
+
+    Entries are stored by paths translated from request locations, so a hit
+    needs no filesystem calls. An entry is checked against the file by stat
+    when it was not checked for revalidate_interval seconds. Least recently
+    used entries are evicted to keep the total size in max_size bytes,
+    files larger than max_file_size are not cached.
+    """
+
+    def __init__(self, max_size, max_file_size, revalidate_interval):
+        self.max_size = max_size
+        self.max_file_size = max_file_size
+        self.revalidate_interval = revalidate_interval
+        self.entries = collections.OrderedDict()
+        self.size = 0
+        self.lock = threading.Lock()
+
+    def fits(self, size):
+        return size <= min(self.max_file_size, self.max_size)
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return None
+            self.entries.move_to_end(key)
+        now = time.time()
+        if now - entry.checked >= self.revalidate_interval:
+            if not entry.is_valid():
+                logging.info("Cached file {0} is changed".format(entry.path))
+                self.remove(key, entry)
+                return None
+            entry.checked = now
+        return entry
+
+    def put(self, key, entry):
+        with self.lock:
+            old = self.entries.pop(key, None)
+            if old is not None:
+                self.size -= old.size
+            self.entries[key] = entry
+            self.size += entry.size
+            while self.size > self.max_size:
+                _, evicted = self.entries.popitem(last=False)
+                self.size -= evicted.size
+
+    def remove(self, key, entry):
+        with self.lock:
+            if self.entries.get(key) is entry:
+                del self.entries[key]
+                self.size -= entry.size
+
+
 class MainHTTPHandler:
     """
     The order to create a response:
         1. call start_response
         2. call set_header (a function to set one header)
         3. call end_headers
-        3. set value of self.body
+        3. set value of self.body, or self.body_file and self.body_parts
+           (bytes or (offset, count) of the file to send after the head)
         3. call build_response
         4. call send_response
 
@@ -120,6 +560,15 @@ class MainHTTPHandler:
     protocol_version = "HTTP/1.1"
     error_message = DEFAULT_ERROR_MESSAGE
     error_content_type = DEFAULT_ERROR_CONTENT_TYPE
+    # Seconds to wait for the next request on a persistent connection
+    keep_alive_timeout = 15
+    # Seconds to wait for the client to accept a response by the threaded
+    # engine
+    send_timeout = 15
+    # Max number of requests served on a persistent connection
+    max_keep_alive_requests = 100
+    # FileCache of small files, files are not cached if it is None
+    file_cache = None
 
     def __init__(self, conn, document_root):
         self.conn = conn
@@ -127,11 +576,73 @@ class MainHTTPHandler:
         self.headers = []
         self.response = b""
         self.body = b""
+        self.body_file = None
+        self.body_parts = []
+        self.buffer = b""
+        self.requests = 0
+        self.close_connection = False
+        self.response_started = False
 
     def handle(self):
+        """Serve requests of the connection until it is closed"""
+        while not self.close_connection:
+            try:
+                self.conn.settimeout(self.keep_alive_timeout)
+                data = self.read_request()
+                self.conn.settimeout(self.send_timeout)
+            except socket.timeout:
+                logging.info("connection is idle, close it")
+                self.conn.close()
+                return
+            except OSError as e:
+                logging.info("connection is broken: {0}".format(e))
+                self.conn.close()
+                return
+            if not data:
+                self.conn.close()
+                return
+            try:
+                self.handle_request(data)
+            except OSError as e:
+                logging.info("connection is broken: {0}".format(e))
+                self.conn.close()
+                return
+
+    def handle_request(self, data):
+        """Parse a request head read from the client and send a response.
+
+        An unexpected error is answered with 500 if the response is not
+        started, the connection is closed after it.
+        """
+        self.requests += 1
+        self.response_started = False
+        try:
+            self.handle_one_request(data)
+        except OSError:
+            raise
+        except Exception as e:
+            logging.exception(str(e))
+            self.close_connection = True
+            if self.response_started:
+                self.conn.close()
+                return
+            self.reset_response()
+            self.send_error(500, 'Internal Server Error')
+
+    def reset_response(self):
+        self.headers = []
+        self.response = b""
+        self.body = b""
+        self.body_file = None
+        self.body_parts = []
+
+    def handle_one_request(self, data):
+        self.reset_response()
+        self.close_connection = True
         try:
-            self.read_request()
+            self.request_line = data.splitlines()[0]
         except Exception as e:
+            logging.error("recieved data:{0}".format(data))
             logging.exception(str(e))
             self.send_error(400, 'Bad Request')
             return
@@ -139,6 +650,7 @@ class MainHTTPHandler:
         logging.info("Request line: {0}".format(self.request_line))
         try:
             self.parse_request()
+            self.request_headers = self.parse_headers(data)
         except Exception as e:
             logging.exception(str(e))
             self.send_error(400, 'Bad Request')
@@ -148,6 +660,8 @@ class MainHTTPHandler:
                      (self.method, self.location, self.protocol_version))
 
         if self.method in ('GET', 'HEAD'):
+            # other methods may have a body which is not read
+            self.close_connection = not self.should_keep_alive()
             self.process_location()
         else:
             self.send_error(405, 'Method Not Allowed')
@@ -156,6 +670,14 @@ class MainHTTPHandler:
         """Common code for GET and HEAD commands"""
         path = self.translate_path(self.location)
         logging.info("Path: {0}".format(path))
+        key = path
+        if self.file_cache is not None:
+            entry = self.file_cache.get(key)
+            if entry is not None:
+                logging.info("Path {0} is cached".format(key))
+                self.send_file_response(entry.mimetype, entry.stat,
+                                        entry.headers, content=entry.content)
+                return
         f = None
         if os.path.isdir(path):
             index = os.path.join(path, "index.html")
@@ -170,25 +692,223 @@ class MainHTTPHandler:
 
         mimetype = self.get_mimetype(path)
         try:
-            f = open(path, 'rb')
+            # opening a pipe without a writer blocks unless it is
+            # non-blocking
+            fd = os.open(path, os.O_RDONLY | os.O_NONBLOCK)
         except OSError:
             logging.error("file {0} not found".format(path))
             self.send_error(404, 'File not found')
             return
-        try:
-            self.start_response(self.protocol_version, 200, 'OK')
-            self.set_header("Content-Type", mimetype)
-            content = f.read()
-            self.set_header("Content-Length", str(len(content)))
+        if not isinstance(self.conn, Connection):
+            os.set_blocking(fd, True)
+        with open(fd, 'rb') as f:
+            fs = os.fstat(f.fileno())
+            headers = self.file_headers(mimetype, fs)
+            content = None
+            if (stat.S_ISREG(fs.st_mode) and self.file_cache is not None and
+                    self.file_cache.fits(fs.st_size)):
+                content = f.read()
+                if len(content) == fs.st_size:
+                    self.file_cache.put(key, CacheEntry(
+                        path, mimetype, content, headers, fs))
+                else:
+                    content = None
+            self.send_file_response(mimetype, fs, headers, f, content)
+
+    def send_file_response(self, mimetype, fs, headers, f=None,
+                           content=None):
+        """Send a file opened as f or cached as content.
+
+        Arguments are
+        * mimetype: Content-Type of the file
+        * fs: stat result of the file
+        * headers: header fields of the file made by file_headers
+
+        Answers 304 to a conditional request if the file is not modified,
+        206 to a satisfiable Range request and 416 to an unsatisfiable one.
+        """
+        regular = stat.S_ISREG(fs.st_mode)
+        if regular and self.is_not_modified(fs):
+            self.start_response(self.protocol_version, 304, 'Not Modified')
+            self.set_validators(fs)
             self.end_headers()
-            if self.method == 'GET':
+            self.build_response()
+            self.send_response()
+            return
+
+        ranges = self.get_ranges(fs) if regular else None
+        if ranges == []:
+            self.start_response(self.protocol_version, 416,
+                                'Range Not Satisfiable')
+            self.set_header("Content-Range", "bytes */{0}".format(fs.st_size))
+            self.set_header("Content-Length", "0")
+            self.end_headers()
+            self.build_response()
+            self.send_response()
+            return
+        if ranges:
+            self.send_ranges(mimetype, fs, ranges, f, content)
+            return
+
+        if not regular:
+            # the size is unknown, the end of body is the end of
+            # connection
+            self.close_connection = True
+        self.start_response(self.protocol_version, 200, 'OK')
+        self.headers.append(headers)
+        self.end_headers()
+        if self.method == 'GET':
+            if content is not None:
                 self.body = content
+            else:
+                self.body_file = f
+                self.body_parts = [(0, None)]
+        self.build_response()
+        self.send_response()
+
+    def send_ranges(self, mimetype, fs, ranges, f=None, content=None):
+        """Send 206 response with ranges of a file, a list of
+        (offset, count), as multipart/byteranges if there are several"""
+        self.start_response(self.protocol_version, 206, 'Partial Content')
+        self.set_validators(fs)
+        if content is None:
+            self.body_file = f
+        if len(ranges) == 1:
+            offset, count = ranges[0]
+            self.set_header("Content-Type", mimetype)
+            self.set_header("Content-Range", "bytes {0}-{1}/{2}".format(
+                offset, offset + count - 1, fs.st_size))
+            self.set_header("Content-Length", str(count))
+            self.end_headers()
+            if content is not None:
+                self.body = content[offset:offset + count]
+            else:
+                self.body_parts = [(offset, count)]
             self.build_response()
             self.send_response()
-            f.close()
-        except Exception:
-            f.close()
-            raise
+            return
+
+        boundary = uuid.uuid4().hex
+        length = 0
+        for offset, count in ranges:
+            part_head = ("\r\n--{0}\r\nContent-Type: {1}\r\n"
+                         "Content-Range: bytes {2}-{3}/{4}\r\n\r\n").format(
+                boundary, mimetype, offset, offset + count - 1,
+                fs.st_size).encode("utf-8")
+            self.body_parts.append(part_head)
+            if content is not None:
+                self.body_parts.append(content[offset:offset + count])
+            else:
+                self.body_parts.append((offset, count))
+            length += len(part_head) + count
+        tail = "\r\n--{0}--\r\n".format(boundary).encode("utf-8")
+        self.body_parts.append(tail)
+        length += len(tail)
+        self.set_header("Content-Type",
+                        "multipart/byteranges; boundary=" + boundary)
+        self.set_header("Content-Length", str(length))
+        self.end_headers()
+        self.build_response()
+        self.send_response()
+
+    def is_not_modified(self, fs):
+        """Check If-None-Match or, if it is absent, If-Modified-Since
+        of the request against a file with stat result fs"""
+        if_none_match = self.request_headers.get("if-none-match")
+        if if_none_match is not None:
+            etag = self.make_etag(fs)
+            for tag in if_none_match.split(","):
+                tag = tag.strip()
+                # weak comparison
+                if tag.startswith("W/"):
+                    tag = tag[2:]
+                if tag == "*" or tag == etag:
+                    return True
+            return False
+        if_modified_since = self.request_headers.get("if-modified-since")
+        if if_modified_since is None:
+            return False
+        since = self.parse_date(if_modified_since)
+        return since is not None and int(fs.st_mtime) <= since
+
+    def get_ranges(self, fs):
+        """Parse Range header of the request for a file with stat result fs.
+
+        Return a list of (offset, count) of satisfiable ranges, an empty
+        list if no range is satisfiable or None if the whole file is sent:
+        the header is absent, invalid or If-Range doesn't match the file.
+        """
+        value = self.request_headers.get("range")
+        if value is None or self.method != 'GET':
+            return None
+        if_range = self.request_headers.get("if-range")
+        if if_range is not None:
+            if if_range.startswith('"') or if_range.startswith("W/"):
+                # strong comparison
+                if if_range != self.make_etag(fs):
+                    return None
+            elif self.parse_date(if_range) != int(fs.st_mtime):
+                return None
+        unit, sep, specs = value.partition("=")
+        if unit.strip().lower() != "bytes" or not sep:
+            return None
+        specs = specs.split(",")
+        if len(specs) > MAX_RANGES:
+            return None
+        size = fs.st_size
+        ranges = []
+        for spec in specs:
+            first, sep, last = spec.strip().partition("-")
+            if not sep or not (first or last):
+                return None
+            # str.isdigit accepts digits int() doesn't parse, like "²"
+            if ((first and not re.fullmatch("[0-9]+", first)) or
+                    (last and not re.fullmatch("[0-9]+", last))):
+                return None
+            if not first:
+                # suffix range: last bytes of the file
+                start, end = max(size - int(last), 0), size - 1
+                if not int(last):
+                    continue
+            else:
+                start = int(first)
+                end = min(int(last), size - 1) if last else size - 1
+                if last and int(last) < start:
+                    return None
+            if start >= size:
+                continue
+            ranges.append((start, end - start + 1))
+        return ranges
+
+    def parse_date(self, value):
+        """Return timestamp of HTTP date, None if it is invalid"""
+        try:
+            date = email.utils.parsedate_to_datetime(value)
+        except (TypeError, ValueError, IndexError):
+            return None
+        if date.tzinfo is None:
+            date = date.replace(tzinfo=datetime.timezone.utc)
+        return int(date.timestamp())
+
+    def set_validators(self, fs):
+        self.set_header("Last-Modified", self.date_time_string(fs.st_mtime))
+        self.set_header("ETag", self.make_etag(fs))
+
+    def file_headers(self, mimetype, fs):
+        """Return header fields of a file with stat result fs as bytes"""
+        headers = [self.format_header("Content-Type", mimetype)]
+        if stat.S_ISREG(fs.st_mode):
+            headers.append(self.format_header("Content-Length",
+                                              str(fs.st_size)))
+            headers.append(self.format_header("Accept-Ranges", "bytes"))
+        headers.append(self.format_header(
+            "Last-Modified", self.date_time_string(fs.st_mtime)))
+        headers.append(self.format_header("ETag", self.make_etag(fs)))
+        return b"".join(headers)
+
+    def make_etag(self, fs):
+        """Return an entity tag of a file by its modification time and size"""
+        return '"{0:x}-{1:x}"'.format(int(fs.st_mtime), fs.st_size)
 
     def get_mimetype(self, path):
         """Guess mimetype of a file by its extension."""
@@ -205,10 +925,37 @@ class MainHTTPHandler:
             self.response += self.body
 
     def send_response(self):
-        """Send rensponse and close client socket"""
+        """Send rensponse, then body parts if they are set, and close client
+        socket if the connection is not persistent"""
         logging.info("Response first line: {0}".format(self.headers[0]))
+        self.response_started = True
         self.conn.sendall(self.response)
-        self.conn.close()
+        for part in self.body_parts:
+            if isinstance(part, tuple):
+                self.send_file(self.body_file, *part)
+            else:
+                self.conn.sendall(part)
+        if self.close_connection:
+            self.conn.close()
+
+    def send_file(self, f, offset=0, count=None):
+        """Send count bytes of file f from offset, up to the end by default.
+
+        Regular files are sent by sendfile from the file descriptor without
+        copying into user space, other files are copied by chunks, by the
+        event loop a chunk when the socket is writable.
+        """
+        if stat.S_ISREG(os.fstat(f.fileno()).st_mode):
+            self.conn.sendfile(f, offset, count)
+            return
+        if isinstance(self.conn, Connection):
+            self.conn.sendstream(f)
+            return
+        while True:
+            chunk = f.read(RECV_SIZE)
+            if not chunk:
+                break
+            self.conn.sendall(chunk)
 
     def send_error(self, code, message):
         """Send an error replay.
@@ -231,20 +978,29 @@ class MainHTTPHandler:
         self.send_response()
 
     def read_request(self):
-        """Read request from the client socket"""
-        data = b''
+        """Read head of the next request from the client socket.
+
+        Data after the head is kept in self.buffer for pipelined requests.
+        Empty data is returned if the head is larger than MAX_REQUEST_SIZE,
+        so the connection is closed.
+        """
+        data = self.buffer
         while data.find(b'\r\n\r\n') == -1:
-            r = self.conn.recv(1024)
+            if len(data) > MAX_REQUEST_SIZE:
+                logging.error("request is too large")
+                self.buffer = b''
+                return b''
+            r = self.conn.recv(RECV_SIZE)
             # r is empty if socket is closed
             if not r:
-                logging.error("socket is closed")
-                break
+                if data:
+                    logging.error("socket is closed")
+                self.buffer = b''
+                return data
             data += r
-        try:
-            self.request_line = data.splitlines()[0]
-        except Exception as e:
-            logging.error("recieved data:{0}".format(data))
-            raise e
+        end = data.find(b'\r\n\r\n') + 4
+        self.buffer = data[end:]
+        return data[:end]
 
     def parse_request(self):
         """Parse a request.
@@ -253,6 +1009,40 @@ class MainHTTPHandler:
         self.method, self.location, self.http_version = \
             self.request_line.decode("utf-8").split()
 
+    def parse_headers(self, data):
+        """Parse header fields of a request head.
+        Return a dict of values by lowercased field names, values of
+        repeated fields are joined by commas."""
+        headers = {}
+        name = None
+        for line in data.decode("iso-8859-1").splitlines()[1:]:
+            if not line:
+                break
+            if line[0] in " \t":
+                # obsolete line folding continues the previous field
+                if name is None:
+                    raise ValueError("Invalid header line: {0}".format(line))
+                headers[name] = (headers[name] + " " + line.strip()).strip()
+                continue
+            name, sep, value = line.partition(":")
+            if not sep or not name or name != name.strip():
+                raise ValueError("Invalid header line: {0}".format(line))
+            name = name.lower()
+            if name in headers:
+                headers[name] += ", " + value.strip()
+            else:
+                headers[name] = value.strip()
+        return headers
+
+    def should_keep_alive(self):
+        """Check if the connection persists after the response"""
+        if self.requests >= self.max_keep_alive_requests:
+            return False
+        connection = self.request_headers.get("connection", "").lower()
+        if self.http_version == "HTTP/1.1":
+            return connection != "close"
+        return connection == "keep-alive"
+
     def translate_path(self, path):
         """Translate a /-separated PATH to the local filename syntax."""
         path = path.split('?', 1)[0]
@@ -273,11 +1063,20 @@ class MainHTTPHandler:
         self.headers.append(("%s %d %s\r\n" % (http_version, code,
                                                message)).encode("utf-8"))
         self.set_header("Server", self.version_string())
-        self.set_header("Connection", "Close")
+        if self.close_connection:
+            self.set_header("Connection", "close")
+        else:
+            self.set_header("Connection", "keep-alive")
+            self.set_header("Keep-Alive", "timeout={0:g}, max={1}".format(
+                self.keep_alive_timeout,
+                self.max_keep_alive_requests - self.requests))
         self.set_header("Date", self.date_time_string())
 
     def set_header(self, keyword, value):
-        self.headers.append(("%s: %s\r\n" % (keyword, value)).encode("utf-8"))
+        self.headers.append(self.format_header(keyword, value))
+
+    def format_header(self, keyword, value):
+        return ("%s: %s\r\n" % (keyword, value)).encode("utf-8")
 
     def end_headers(self):
         self.headers.append(b"\r\n")
@@ -293,6 +1092,25 @@ class MainHTTPHandler:
         return self.server_version + ' ' + self.sys_version
 
 
+SERVERS = {
+    'threads': HTTPServer,
+    'epoll': EventLoopHTTPServer,
+}
+
+
+def raise_nofile_limit():
+    """Raise the soft limit of open files to the hard one"""
+    try:
+        import resource
+    except ImportError:
+        return
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft < hard:
+        resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+        logging.info("Open files limit raised from {0} to {1}".format(
+            soft, hard))
+
+
 if __name__ == "__main__":
 
     parser = argparse.ArgumentParser()
@@ -308,6 +1126,24 @@ if __name__ == "__main__":
                         help='Specify path for logfile')
     parser.add_argument('--workers', '-w', type=int, default=30,
                         help='Specify max value of workers')
+    parser.add_argument('--engine', '-e', choices=sorted(SERVERS),
+                        default='threads',
+                        help='Specify server engine [default: threads]')
+    parser.add_argument('--keep-alive-timeout', type=float, default=None,
+                        help='Specify seconds to keep idle connections '
+                        '[default: 2 for threads, 15 for epoll]')
+    parser.add_argument('--max-requests', type=int, default=100,
+                        help='Specify max requests per connection '
+                        '[default: 100]')
+    parser.add_argument('--cache-size', type=int, default=0,
+                        help='Specify megabytes of memory to cache files '
+                        '[default: 0, no cache]')
+    parser.add_argument('--cache-max-file', type=int, default=1024,
+                        help='Specify kilobytes of the largest cached file '
+                        '[default: 1024]')
+    parser.add_argument('--cache-revalidate', type=float, default=1,
+                        help='Specify seconds to check cached files '
+                        'for changes [default: 1]')
 
     args = parser.parse_args()
     server_address = (args.bind, args.port)
@@ -316,10 +1152,21 @@ if __name__ == "__main__":
                         format='[%(asctime)s] %(levelname).1s %(message)s',
                         datefmt='%Y.%m.%d %H:%M:%S')
 
-    with HTTPServer(server_address,
-                    MainHTTPHandler,
-                    args.workers,
-                    args.root) as httpd:
+    if args.keep_alive_timeout is None:
+        args.keep_alive_timeout = SERVERS[args.engine].keep_alive_timeout
+    MainHTTPHandler.keep_alive_timeout = args.keep_alive_timeout
+    MainHTTPHandler.max_keep_alive_requests = args.max_requests
+    if args.cache_size > 0:
+        MainHTTPHandler.file_cache = FileCache(args.cache_size * 1024 * 1024,
+                                               args.cache_max_file * 1024,
+                                               args.cache_revalidate)
+    if args.engine == 'epoll':
+        raise_nofile_limit()
+
+    with SERVERS[args.engine](server_address,
+                              MainHTTPHandler,
+                              args.workers,
+                              args.root) as httpd:
         try:
             httpd.serve_forever()
         except KeyboardInterrupt:
@@ -1,6 +1,8 @@
 #!/usr/bin/env python
 
+import os
 import re
+import time
 import socket
 import httplib
 import unittest
@@ -266,6 +268,244 @@ class HttpServer(unittest.TestCase):
     self.assertEqual(len(data), 35344)
     self.assertEqual(ctype, "application/x-shockwave-flash")
 
+  def test_concurrent_connections(self):
+    """requests of interleaved connections"""
+    socks = []
+    for n in range(10):
+      s = socket.create_connection((self.host, self.port), 10)
+      s.sendall("GET /httptest/dir2/page.html HTTP/1.0\r\n")
+      socks.append(s)
+    for s in reversed(socks):
+      s.sendall("\r\n")
+      data = ""
+      while 1:
+        buf = s.recv(1024)
+        if not buf: break
+        data += buf
+      s.close()
+      self.assertTrue(data.startswith("HTTP/1.1 200"))
+      self.assertTrue(data.endswith("<html><body>Page Sample</body></html>\n"))
+
+  def test_keep_alive(self):
+    """requests on a persistent connection"""
+    self.conn.request("GET", "/httptest/dir2/page.html")
+    r = self.conn.getresponse()
+    data = r.read()
+    sock = self.conn.sock
+    self.assertEqual(r.getheader("Connection"), "keep-alive")
+    self.conn.request("GET", "/httptest/dir2/")
+    r = self.conn.getresponse()
+    data = r.read()
+    self.assertEqual(int(r.status), 200)
+    self.assertIs(self.conn.sock, sock)
+    self.assertEqual(data, "<html>Directory index file</html>\n")
+
+  def test_connection_close(self):
+    """connection closed on request"""
+    self.conn.request("GET", "/httptest/dir2/page.html",
+                      headers={"Connection": "close"})
+    r = self.conn.getresponse()
+    data = r.read()
+    self.assertEqual(r.getheader("Connection"), "close")
+    self.assertTrue(r.will_close)
+
+  def test_pipelining(self):
+    """pipelined requests answered in order"""
+    s = socket.create_connection((self.host, self.port), 10)
+    s.sendall("GET /httptest/dir2/page.html HTTP/1.1\r\nHost: localhost\r\n\r\n"
+              "HEAD /httptest/dir2/ HTTP/1.1\r\nHost: localhost\r\n\r\n"
+              "GET /httptest/dir2/ HTTP/1.1\r\nConnection: close\r\n\r\n")
+    r = httplib.HTTPResponse(s)
+    r.begin()
+    self.assertEqual(r.read(), "<html><body>Page Sample</body></html>\n")
+    r = httplib.HTTPResponse(s, method="HEAD")
+    r.begin()
+    self.assertEqual(int(r.getheader("Content-Length")), 34)
+    self.assertEqual(r.read(), "")
+    r = httplib.HTTPResponse(s)
+    r.begin()
+    self.assertEqual(r.read(), "<html>Directory index file</html>\n")
+    self.assertEqual(s.recv(1024), "")
+    s.close()
+
+  def test_large_request(self):
+    """connection with too large request closed"""
+    s = socket.create_connection((self.host, self.port), 10)
+    try:
+      s.sendall("GET /httptest/dir2/page.html HTTP/1.1\r\nX: " + "x" * 100000)
+      data = s.recv(1024)
+    except socket.error:
+      data = ""
+    s.close()
+    self.assertEqual(data, "")
+
+  def test_large_files_on_connection(self):
+    """large files sent one after another on a connection"""
+    for path in ("/httptest/wikipedia_russia.html", "/httptest/160313.jpg",
+                 "/httptest/wikipedia_russia.html"):
+      self.conn.request("GET", path)
+      r = self.conn.getresponse()
+      data = r.read()
+      self.assertEqual(int(r.status), 200)
+      self.assertEqual(len(data), int(r.getheader("Content-Length")))
+    self.assertIn("Wikimedia Foundation, Inc.", data)
+
+  def test_head_large_file(self):
+    """head of large file has no body"""
+    self.conn.request("HEAD", "/httptest/wikipedia_russia.html")
+    r = self.conn.getresponse()
+    data = r.read()
+    self.assertEqual(int(r.getheader("Content-Length")), 954824)
+    self.assertEqual(data, "")
+    self.conn.request("GET", "/httptest/dir2/page.html")
+    r = self.conn.getresponse()
+    self.assertEqual(r.read(), "<html><body>Page Sample</body></html>\n")
+
+  def test_repeated_requests(self):
+    """file is the same on repeated requests"""
+    responses = []
+    for n in range(3):
+      self.conn.request("GET", "/httptest/splash.css")
+      r = self.conn.getresponse()
+      responses.append((r.status, r.getheader("Content-Length"),
+                        r.getheader("ETag"), r.getheader("Last-Modified"),
+                        r.read()))
+    self.assertEqual(responses[0], responses[1])
+    self.assertEqual(responses[0], responses[2])
+    self.assertEqual(len(responses[0][4]), 98620)
+
+  def test_changed_file(self):
+    """changed file is served after revalidation"""
+    path = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                        "httptest", "changed.txt")
+    try:
+      with open(path, "w") as f:
+        f.write("old")
+      self.conn.request("GET", "/httptest/changed.txt")
+      self.assertEqual(self.conn.getresponse().read(), "old")
+      with open(path, "w") as f:
+        f.write("new content")
+      time.sleep(1.5)
+      self.conn.request("GET", "/httptest/changed.txt")
+      self.assertEqual(self.conn.getresponse().read(), "new content")
+    finally:
+      os.remove(path)
+
+  def test_pipe(self):
+    """pipe is sent up to its end without blocking other requests"""
+    path = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                        "httptest", "pipe.txt")
+    os.mkfifo(path)
+    try:
+      # a reading and writing descriptor doesn't wait for a reader
+      fd = os.open(path, os.O_RDWR)
+      os.write(fd, "first ")
+      self.conn.request("GET", "/httptest/pipe.txt")
+      r = self.conn.getresponse()
+      self.assertEqual(int(r.status), 200)
+      self.assertEqual(r.getheader("Connection"), "close")
+      other = httplib.HTTPConnection(self.host, self.port, timeout=5)
+      other.request("GET", "/httptest/dir2/page.html")
+      self.assertEqual(other.getresponse().read(),
+                       "<html><body>Page Sample</body></html>\n")
+      other.close()
+      os.write(fd, "second")
+      os.close(fd)
+      self.assertEqual(r.read(), "first second")
+    finally:
+      os.remove(path)
+
+  def get_page(self, headers):
+    self.conn.request("GET", "/httptest/dir2/page.html", headers=headers)
+    r = self.conn.getresponse()
+    return r, r.read()
+
+  def test_if_none_match(self):
+    """304 for matching If-None-Match"""
+    r, data = self.get_page({})
+    etag = r.getheader("ETag")
+    self.assertIsNotNone(etag)
+    r, data = self.get_page({"If-None-Match": etag})
+    self.assertEqual(int(r.status), 304)
+    self.assertEqual(data, "")
+    self.assertEqual(r.getheader("ETag"), etag)
+    r, data = self.get_page({"If-None-Match": '"other"'})
+    self.assertEqual(int(r.status), 200)
+    self.assertEqual(len(data), 38)
+
+  def test_if_modified_since(self):
+    """304 for If-Modified-Since not before modification"""
+    r, data = self.get_page({})
+    modified = r.getheader("Last-Modified")
+    r, data = self.get_page({"If-Modified-Since": modified})
+    self.assertEqual(int(r.status), 304)
+    self.assertEqual(data, "")
+    r, data = self.get_page({"If-Modified-Since": "Thu, 01 Jan 1970 00:00:00 GMT"})
+    self.assertEqual(int(r.status), 200)
+    r, data = self.get_page({"If-Modified-Since": "not a date"})
+    self.assertEqual(int(r.status), 200)
+
+  def test_range(self):
+    """206 for single range"""
+    r, data = self.get_page({"Range": "bytes=6-11"})
+    self.assertEqual(int(r.status), 206)
+    self.assertEqual(r.getheader("Content-Range"), "bytes 6-11/38")
+    self.assertEqual(data, "<body>")
+    r, data = self.get_page({"Range": "bytes=-8"})
+    self.assertEqual(data, "</html>\n")
+    r, data = self.get_page({"Range": "bytes=30-100"})
+    self.assertEqual(r.getheader("Content-Range"), "bytes 30-37/38")
+    self.assertEqual(data, "</html>\n")
+
+  def test_range_of_large_file(self):
+    """206 for range of large file"""
+    self.conn.request("GET", "/httptest/wikipedia_russia.html",
+                      headers={"Range": "bytes=900000-"})
+    r = self.conn.getresponse()
+    data = r.read()
+    self.assertEqual(int(r.status), 206)
+    self.assertEqual(len(data), 54824)
+    self.assertIn("Wikimedia Foundation, Inc.", data)
+
+  def test_multiple_ranges(self):
+    """multipart/byteranges for several ranges"""
+    r, data = self.get_page({"Range": "bytes=0-5,-8"})
+    self.assertEqual(int(r.status), 206)
+    ctype = r.getheader("Content-Type")
+    self.assertTrue(ctype.startswith("multipart/byteranges; boundary="))
+    boundary = ctype.split("=", 1)[1]
+    self.assertEqual(len(data), int(r.getheader("Content-Length")))
+    parts = data.split("--" + boundary)
+    self.assertEqual(parts[-1], "--\r\n")
+    self.assertIn("Content-Range: bytes 0-5/38\r\n\r\n<html>\r\n", parts[1])
+    self.assertIn("Content-Range: bytes 30-37/38\r\n\r\n</html>\n\r\n",
+                  parts[2])
+
+  def test_unsatisfiable_range(self):
+    """416 for unsatisfiable range"""
+    r, data = self.get_page({"Range": "bytes=100-200"})
+    self.assertEqual(int(r.status), 416)
+    self.assertEqual(r.getheader("Content-Range"), "bytes */38")
+    self.assertEqual(data, "")
+
+  def test_malformed_range(self):
+    """whole file for malformed Range"""
+    for value in ("bytes=\xc2\xb2-5", "bytes=abc", "bytes=5-1", "bytes=-",
+                  "bytes", "items=0-5", "bytes=0-1,x"):
+      r, data = self.get_page({"Range": value})
+      self.assertEqual(int(r.status), 200, value)
+      self.assertEqual(len(data), 38)
+
+  def test_if_range(self):
+    """whole file for not matching If-Range"""
+    r, data = self.get_page({})
+    etag = r.getheader("ETag")
+    r, data = self.get_page({"Range": "bytes=0-5", "If-Range": etag})
+    self.assertEqual(int(r.status), 206)
+    r, data = self.get_page({"Range": "bytes=0-5", "If-Range": '"other"'})
+    self.assertEqual(int(r.status), 200)
+    self.assertEqual(len(data), 38)
+
 loader = unittest.TestLoader()
 suite = unittest.TestSuite()
 a = loader.loadTestsFromTestCase(HttpServer)